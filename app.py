@@ -1,16 +1,47 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, make_response, Response, stream_with_context, get_template_attribute
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
+import cloudinary.utils
 import os
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont, features
 import io
 import logging
-from functools import wraps
-from datetime import datetime, timedelta
+from functools import wraps, lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 import json
 import unicodedata
+import hashlib
+import threading
+import fcntl
+import gzip
+import zipfile
+import itertools
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+import base64
+import sqlite3
+import uuid
+import random
+import shutil
+from contextlib import contextmanager
+import sys
+import re
+import socket
+from array import array
+import atexit
+import time
+
+try:
+    import brotli  # optional - ถ้าไม่มีจะส่งแค่ gzip
+except ImportError:
+    brotli = None
 
 # Load environment variables from .env file
 load_dotenv()
@@ -35,17 +66,148 @@ MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
 ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
 ALLOWED_MIME_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp'}
 
-# Cache สำหรับเก็บข้อมูลรูปภาพ
-image_cache = {'data': None, 'timestamp': None}
+# Cache สำหรับเก็บข้อมูลรูปภาพ (key 'images' ใน cache backend)
 CACHE_DURATION = timedelta(minutes=5)
 
-# Cache สำหรับ metadata (แก้ปัญหา Rate Limit)
-metadata_cache = {'data': None, 'timestamp': None}
-METADATA_CACHE_DURATION = timedelta(minutes=10)
+# Metadata store บนดิสก์ (snapshot + journal) - แชร์ทุก worker บนเครื่องเดียวกัน
+METADATA_DIR = os.environ.get('METADATA_DIR', '/tmp/drink-menu-metadata')
+METADATA_COMPACT_EVERY = 200  # จำนวนรายการใน journal ก่อนรวมเป็น snapshot ใหม่
+METADATA_UPLOAD_DELAY = float(os.environ.get('METADATA_UPLOAD_DELAY', 5))  # วินาที - รวมหลายการแก้ไขเป็นการอัปโหลดครั้งเดียว
+METADATA_REMOTE_CHECK = timedelta(minutes=10)  # ตรวจ snapshot บน Cloudinary ซ้ำ (conditional GET - ไม่เปลี่ยนได้ 304)
+
+# Catalog snapshot บนดิสก์ (รายการรูป + metadata แบบ gzip) - worker ที่เพิ่งเริ่มใช้ตอบ request แรกได้ทันที
+CATALOG_SNAPSHOT = os.environ.get('CATALOG_SNAPSHOT', '/tmp/drink-menu-catalog.json.gz')
+CATALOG_SNAPSHOT_DELAY = float(os.environ.get('CATALOG_SNAPSHOT_DELAY', 30))  # วินาที - รวมหลายการแก้ไขเป็นการเขียนครั้งเดียว
+CATALOG_SNAPSHOT_FORMAT = 1
+CATALOG_FIELDS = ('public_id', 'secure_url', 'version', 'created_at', 'format', 'width', 'height', 'alias_of')  # field ที่แอปใช้จริง
+
+# Cache backend: 'memory' (เฉพาะ worker ตัวเอง), 'file' (แชร์ทุก worker บนเครื่องเดียวกัน), 'redis'
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+CACHE_DIR = os.environ.get('CACHE_DIR', '/tmp/drink-menu-cache')
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+# HTTP cache ของหน้าเมนู (หน้าบ้าน) - browser ตรวจ ETag ทุกครั้ง, CDN เก็บได้สั้นๆ
+PAGE_CACHE_CONTROL = os.environ.get('PAGE_CACHE_CONTROL', 'public, max-age=0, must-revalidate, s-maxage=60, stale-while-revalidate=300')
+
+# Image processing pool - ย้ายงาน Pillow (CPU หนัก) ออกจาก event loop ของ eventlet
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+IMAGE_QUEUE_LIMIT = int(os.environ.get('IMAGE_QUEUE_LIMIT', 4))  # งานที่รอคิวได้ (นอกเหนือจากที่กำลังทำ)
+IMAGE_QUEUE_TIMEOUT = 10  # วินาทีที่ยอมรอคิวว่าง ก่อนตอบ 503
+IMAGE_MAX_SIDE = 2048  # ด้านยาวสุดของรูปที่เก็บใน Cloudinary
+IMAGE_MAX_DECODE_MB = int(os.environ.get('IMAGE_MAX_DECODE_MB', 128))  # memory สูงสุดของรูปที่ถอดรหัสแล้ว (ต่อรูป)
+
+# ลายน้ำที่สร้างจากรูปต้นฉบับ (clean) - 1 style ต่อโฟลเดอร์ปลายทาง
+# โซน normal-wm / premium-wm ใช้รูปจากโฟลเดอร์ watermarked ร่วมกัน; แก้/เพิ่มได้ผ่าน WATERMARK_STYLES (JSON)
+WATERMARK_FONT_CANDIDATES = (
+    'fonts/NotoSansThai-Bold.ttf',
+    '/usr/share/fonts/truetype/noto/NotoSansThai-Bold.ttf',
+    '/usr/share/fonts/opentype/noto/NotoSansThai-Bold.ttf',
+    '/usr/share/fonts/truetype/tlwg/Garuda-Bold.ttf',
+    '/usr/share/fonts/truetype/tlwg/Loma-Bold.ttf'
+)
+WATERMARK_DEFAULT_STYLE = {
+    'text': os.environ.get('WATERMARK_TEXT', ''),
+    'logo': os.environ.get('WATERMARK_LOGO', ''),  # PNG โปร่งใส (ถ้ามี)
+    'font': os.environ.get('WATERMARK_FONT', ''),  # .ttf/.otf ที่มีอักษรไทย (ว่าง = หาจาก WATERMARK_FONT_CANDIDATES)
+    'position': 'tile',  # tile / center / bottom-right
+    'scale': 0.05,       # ความสูงตัวอักษรเทียบกับด้านสั้นของรูป
+    'opacity': 0.35,
+    'angle': 30,         # องศาที่เอียง (เฉพาะ tile)
+    'color': [255, 255, 255]
+}
+WATERMARK_STYLES = {
+    folder: {**WATERMARK_DEFAULT_STYLE, **style}
+    for folder, style in json.loads(os.environ.get('WATERMARK_STYLES', '{"watermarked": {}}')).items()
+}
+
+# ZIP export - จำนวนรูปที่ดึงจาก Cloudinary พร้อมกัน (จำกัด memory ด้วย)
+ZIP_FETCH_CONCURRENCY = int(os.environ.get('ZIP_FETCH_CONCURRENCY', 6))
+# ZIP เปิดให้ดาวน์โหลดโดยไม่ login - จำกัดจำนวนครั้งต่อ IP (ครั้ง/ชั่วโมง และจำนวนที่ขอติดกันได้)
+ZIP_RATE_PER_HOUR = float(os.environ.get('ZIP_RATE_PER_HOUR', 20))
+ZIP_BURST = int(os.environ.get('ZIP_BURST', 3))
+# HTTP session กลาง (keep-alive) - จำนวน host ที่เก็บ pool และ connection สูงสุดต่อ host
+HTTP_POOL_CONNECTIONS = 4
+HTTP_POOL_MAXSIZE = max(ZIP_FETCH_CONCURRENCY, 10)
+HTTP_TIMEOUT = 10
 
-# Metadata file path
+ZIP_NAMES = {
+    'normal-wm': 'Menu_Normal_Watermarked.zip',
+    'normal-cl': 'Menu_Normal_Clean.zip',
+    'premium-wm': 'Menu_Premium_Watermarked.zip',
+    'premium-cl': 'Menu_Premium_Clean.zip'
+}
+
+# หน้าเมนู: จำนวนรูปต่อหน้า (infinite scroll) และโซนที่ render มากับ HTML
+MENU_PAGE_SIZE = 40
+MENU_PAGE_SIZE_MAX = 100
+DEFAULT_MENU_ZONE = 'normal-wm'
+
+# Background jobs - คิวงาน bulk ของแอดมินใน SQLite (แชร์ทุก worker, อยู่รอดหลัง restart)
+JOBS_DB = os.environ.get('JOBS_DB', '/tmp/drink-menu-jobs.sqlite3')
+JOBS_SPOOL_DIR = os.environ.get('JOBS_SPOOL_DIR', '/tmp/drink-menu-spool')  # ไฟล์อัปโหลดที่รอทำ
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))  # thread ต่อ gunicorn worker
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_BASE = 2  # วินาที - backoff 2, 4, 8, ... (มี jitter)
+JOB_RETRY_MAX = 60
+JOB_LEASE = 300  # วินาที - item ที่ค้าง 'running' นานกว่านี้ (worker ตาย) จะถูกหยิบไปทำใหม่
+JOB_POLL_INTERVAL = 2
+JOB_RETENTION = timedelta(days=7)
+DIRECT_UPLOAD_RECONCILE = 3600 + 300  # วินาที - ลายเซ็นอัปโหลดตรงใช้ได้ 1 ชม. (+ เผื่อเวลาส่งไฟล์) แล้วค่อยตรวจกับ Cloudinary เอง
+
+# ขนาดรูปย่อ (px) ที่สร้างเป็น srcset ให้ browser เลือกตามหน้าจอ
+THUMBNAIL_WIDTHS = (240, 360, 480, 720, 960)
+
+# Metadata file path (รูปแบบเดิม - ใช้ย้ายข้อมูลเข้า metadata store ครั้งแรก)
 METADATA_FILE = 'metadata.json'
 
+# โฟลเดอร์รูปใน Cloudinary (key ตรงกับข้อมูลใน cache 'images')
+IMAGE_FOLDERS = {
+    'watermarked': 'menu/watermarked/',
+    'clean': 'menu/clean/',
+    'premium': 'menu/premium/'
+}
+LIST_PAGE_SIZE = 500  # สูงสุดที่ Admin API ให้ต่อหน้า
+
+# Cloudinary client - จำกัดอัตราต่อ worker (Admin API มีโควต้ารายชั่วโมง) + retry แบบ backoff
+CLOUDINARY_ADMIN_RATE = float(os.environ.get('CLOUDINARY_ADMIN_RATE', 500)) / 3600  # ครั้ง/วินาที
+CLOUDINARY_ADMIN_BURST = int(os.environ.get('CLOUDINARY_ADMIN_BURST', 20))
+CLOUDINARY_UPLOAD_RATE = float(os.environ.get('CLOUDINARY_UPLOAD_RATE', 10))  # ครั้ง/วินาที
+CLOUDINARY_UPLOAD_BURST = int(os.environ.get('CLOUDINARY_UPLOAD_BURST', 20))
+CLOUDINARY_RATE_WAIT = 30  # วินาทีที่ยอมรอ token ก่อนถือว่าโดน rate limit
+CLOUDINARY_BUCKET_BATCH = 5  # token ที่ worker จองจาก bucket กลางต่อครั้ง (ไม่ต้อง lock/เขียน backend ทุก request)
+CLOUDINARY_BUCKET_LEASE = 1.0  # วินาที - token ที่จองไว้แล้วไม่ได้ใช้ภายในเวลานี้คืนเข้า bucket กลาง
+CLOUDINARY_MAX_ATTEMPTS = 3
+CLOUDINARY_RETRY_BASE = 0.5  # วินาที
+CLOUDINARY_RETRY_MAX = 8
+# โควต้าใช้ร่วมกันทุก worker ผ่าน cache backend (file/redis) - ถ้าเป็น memory จะแบ่งโควต้าให้แต่ละ worker
+# เท่าๆ กันตามจำนวน worker (WEB_CONCURRENCY ตั้งให้ตรงกับ gunicorn -w)
+CLOUDINARY_WORKERS = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# ค่า visibility เริ่มต้นของเมนูที่ยังไม่มี metadata
+VISIBILITY_DEFAULTS = {
+    'show_normal_watermark': True,
+    'show_normal_clean': True,
+    'show_premium_watermark': False,
+    'show_premium_clean': False
+}
+
+# visibility เก็บเป็น mask 4 bit ต่อเมนู (1 bit ต่อโซน)
+VISIBILITY_BITS = {
+    'show_normal_watermark': 1,
+    'show_normal_clean': 2,
+    'show_premium_watermark': 4,
+    'show_premium_clean': 8
+}
+DEFAULT_VISIBILITY_MASK = sum(bit for key, bit in VISIBILITY_BITS.items() if VISIBILITY_DEFAULTS[key])
+
+# โซนหน้าบ้าน 4 โซน: zone -> (โฟลเดอร์รูป, key ของ visibility)
+MENU_ZONES = {
+    'normal-wm': ('watermarked', 'show_normal_watermark'),
+    'normal-cl': ('clean', 'show_normal_clean'),
+    'premium-wm': ('watermarked', 'show_premium_watermark'),
+    'premium-cl': ('clean', 'show_premium_clean')
+}
+
 # ตั้งค่า Cloudinary - ตรวจสอบ required variables
 # ในโหมด development จะข้ามการตรวจสอบถ้าไม่มีค่า
 if os.environ.get('CLOUD_NAME') and os.environ.get('CLOUD_API_KEY') and os.environ.get('CLOUD_API_SECRET'):
@@ -55,10 +217,208 @@ if os.environ.get('CLOUD_NAME') and os.environ.get('CLOUD_API_KEY') and os.envir
         api_secret = os.environ.get('CLOUD_API_SECRET'),
         secure = True
     )
+    # ชี้ไป Cloudinary ปลอมบนเครื่องได้ (ใช้ทดสอบ) - ทั้ง Admin API และ Upload API
+    if os.environ.get('CLOUDINARY_UPLOAD_PREFIX'):
+        cloudinary.config(upload_prefix=os.environ.get('CLOUDINARY_UPLOAD_PREFIX'))
     logger.info("Cloudinary configured successfully")
 else:
     logger.warning("Cloudinary credentials not found - running in demo mode")
 
+# ==========================================
+# Cache Backend (แชร์ cache ระหว่าง gunicorn workers)
+# ==========================================
+# entry = {'data': ..., 'timestamp': datetime, 'version': int}
+# ทุกครั้งที่ set/delete จะเพิ่ม version - worker อื่นเห็น version ใหม่แล้วโหลดตามทันที
+class MemoryCacheBackend:
+    """Cache ใน process เดียว (ค่าเดิมของระบบ - เหมาะกับ dev / worker เดียว)"""
+
+    def __init__(self):
+        self._entries = {}
+        self._versions = {}
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def version(self, key):
+        return self._versions.get(key, 0)
+
+    def set(self, key, data, timestamp=None):
+        with self._lock:
+            version = self._versions.get(key, 0) + 1
+            self._versions[key] = version
+            self._entries[key] = {'data': data, 'timestamp': timestamp or datetime.now(), 'version': version}
+
+    def delete(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._entries.pop(key, None)
+
+    def update(self, key, fn, timestamp=None):
+        """อ่าน-แก้-เขียนแบบ atomic: fn(entry) คืน data ใหม่ หรือ None ถ้าไม่ต้องเปลี่ยน (timestamp เดิม ถ้าไม่ระบุ)"""
+        with self._lock:
+            entry = self.get(key)
+            data = fn(entry)
+            if data is not None:
+                self.set(key, data, timestamp or (entry['timestamp'] if entry else None))
+
+class FileCacheBackend(MemoryCacheBackend):
+    """Cache เป็นไฟล์ JSON ใน CACHE_DIR - ทุก worker บนเครื่องเดียวกันใช้ร่วมกัน
+
+    ไฟล์ถูกเขียนแบบ atomic (เขียน temp แล้ว os.replace) และแต่ละ worker
+    จำผลที่ parse แล้วไว้ตาม (inode, mtime) จะอ่านไฟล์ใหม่ก็ต่อเมื่อมีคนเขียนทับเท่านั้น
+    """
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._memo = {}
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _locked(self, key):
+        # lock ข้าม process ด้วย flock (ใช้ตอนเขียนเท่านั้น)
+        lock_file = open(os.path.join(self.directory, f"{key}.lock"), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        memo = self._memo.get(key)
+        if memo and memo[0] == stamp:
+            return memo[1]
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                raw = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read cache file {path}: {e}")
+            return None
+        entry = {'data': raw['data'], 'timestamp': datetime.fromisoformat(raw['timestamp']), 'version': raw['version']}
+        self._memo[key] = (stamp, entry)
+        return entry
+
+    def version(self, key):
+        entry = self.get(key)
+        if entry:
+            return entry['version']
+        return self._read_tombstone(key)
+
+    def _read_tombstone(self, key):
+        try:
+            with open(os.path.join(self.directory, f"{key}.version"), 'r') as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_atomic(self, path, text):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def _set_unlocked(self, key, data, timestamp):
+        version = max(self.version(key), self._read_tombstone(key)) + 1
+        payload = {'data': data, 'timestamp': (timestamp or datetime.now()).isoformat(), 'version': version}
+        self._write_atomic(self._path(key), json.dumps(payload, ensure_ascii=False))
+        self._write_atomic(os.path.join(self.directory, f"{key}.version"), str(version))
+
+    def set(self, key, data, timestamp=None):
+        with self._lock, self._locked(key):
+            self._set_unlocked(key, data, timestamp)
+
+    def delete(self, key):
+        with self._lock, self._locked(key):
+            version = max(self.version(key), self._read_tombstone(key)) + 1
+            self._write_atomic(os.path.join(self.directory, f"{key}.version"), str(version))
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            self._memo.pop(key, None)
+
+    def update(self, key, fn, timestamp=None):
+        with self._lock, self._locked(key):
+            entry = self.get(key)
+            data = fn(entry)
+            if data is not None:
+                self._set_unlocked(key, data, timestamp or (entry['timestamp'] if entry else None))
+
+class RedisCacheBackend(MemoryCacheBackend):
+    """Cache บน Redis (หรือ server ที่คุย protocol เดียวกัน) - ใช้ได้ข้ามเครื่อง
+
+    worker อ่านแค่ key version (เล็กมาก) ทุก request และดึง payload เต็มเฉพาะตอน version เปลี่ยน
+    """
+
+    def __init__(self, url):
+        super().__init__()
+        import redis  # optional dependency - ใช้เฉพาะตอน CACHE_BACKEND=redis
+        self.client = redis.Redis.from_url(url)
+        self._memo = {}
+
+    def _key(self, key):
+        return f"drink-menu:{key}"
+
+    def version(self, key):
+        return int(self.client.get(self._key(f"{key}:version")) or 0)
+
+    def get(self, key):
+        version = self.version(key)
+        memo = self._memo.get(key)
+        if memo and memo['version'] == version:
+            return memo
+        raw = self.client.get(self._key(key))
+        if not raw:
+            return None
+        raw = json.loads(raw)
+        entry = {'data': raw['data'], 'timestamp': datetime.fromisoformat(raw['timestamp']), 'version': raw['version']}
+        self._memo[key] = entry
+        return entry
+
+    def _set_unlocked(self, key, data, timestamp):
+        version = self.client.incr(self._key(f"{key}:version"))
+        payload = {'data': data, 'timestamp': (timestamp or datetime.now()).isoformat(), 'version': version}
+        self.client.set(self._key(key), json.dumps(payload, ensure_ascii=False))
+
+    def set(self, key, data, timestamp=None):
+        with self.client.lock(self._key(f"{key}:lock"), timeout=30):
+            self._set_unlocked(key, data, timestamp)
+
+    def delete(self, key):
+        with self.client.lock(self._key(f"{key}:lock"), timeout=30):
+            self.client.incr(self._key(f"{key}:version"))
+            self.client.delete(self._key(key))
+
+    def update(self, key, fn, timestamp=None):
+        with self.client.lock(self._key(f"{key}:lock"), timeout=30):
+            entry = self.get(key)
+            data = fn(entry)
+            if data is not None:
+                self._set_unlocked(key, data, timestamp or (entry['timestamp'] if entry else None))
+
+def create_cache_backend():
+    """เลือก cache backend ตาม CACHE_BACKEND (ถ้าใช้ไม่ได้จะถอยกลับไปใช้ memory)"""
+    try:
+        if CACHE_BACKEND == 'file':
+            backend = FileCacheBackend(CACHE_DIR)
+        elif CACHE_BACKEND == 'redis':
+            backend = RedisCacheBackend(CACHE_REDIS_URL)
+        else:
+            backend = MemoryCacheBackend()
+    except Exception as e:
+        logger.warning(f"Could not create '{CACHE_BACKEND}' cache backend, using memory: {e}")
+        backend = MemoryCacheBackend()
+    logger.info(f"Using {type(backend).__name__}")
+    return backend
+
+cache_backend = create_cache_backend()
+
 # Helper Functions
 def normalize_thai_filename(filename):
     """แก้ปัญหาสระภาษาไทย - normalize Unicode"""
@@ -66,6 +426,10 @@ def normalize_thai_filename(filename):
     normalized = unicodedata.normalize('NFC', filename)
     return normalized
 
+def normalize_search_term(text):
+    """normalize ชื่อสำหรับค้นหา (รวมสระไทยที่แยกกัน + ไม่สนตัวพิมพ์เล็ก/ใหญ่)"""
+    return normalize_thai_filename(text or '').casefold().strip()
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -75,223 +439,2473 @@ def validate_file_size(file):
     file.seek(0)
     return size <= MAX_FILE_SIZE
 
+# ==========================================
+# Image Processing Pool (encode รูปใน process แยก)
+# ==========================================
+class ImagePoolBusy(Exception):
+    """คิว encode รูปเต็ม - ให้ client ลองใหม่ภายหลัง"""
+
+class ImageTooLarge(ValueError):
+    """รูปที่ถอดรหัสแล้วจะใช้ memory เกิน IMAGE_MAX_DECODE_MB"""
+
+class WatermarkNotConfigured(ValueError):
+    """ไม่มี style ลายน้ำที่ใช้ได้ (ไม่มีข้อความ/โลโก้ หรือหาไฟล์ฟอนต์/โลโก้ไม่เจอ)"""
+
+# EXIF orientation -> การหมุน/กลับด้าน (ชุดเดียวกับ ImageOps.exif_transpose)
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90
+}
+
+def decode_menu_image(raw_bytes):
+    """ถอดรหัสรูปแล้วย่อไม่เกิน IMAGE_MAX_SIDE เป็นภาพ RGB (รันใน worker process)
+
+    JPEG ถอดรหัสแบบย่อ (draft 1/2, 1/4, 1/8) ตั้งแต่ตอนโหลด ก่อนแปลงสีใดๆ, ย่อก่อนแล้วค่อยหมุนตาม EXIF
+    และแปลงเป็น RGB บนรูปที่เล็กแล้ว - รูปที่ถอดรหัสแล้วเกิน IMAGE_MAX_DECODE_MB จะถูกปฏิเสธก่อนโหลดจริง
+    """
+    with Image.open(io.BytesIO(raw_bytes)) as img:
+        orientation = img.getexif().get(0x0112)
+        
+        # ขอ libjpeg ถอดรหัสเล็กสุดที่ยังไม่ต่ำกว่าขนาดปลายทาง (รูปอื่นไม่มีผล)
+        scale = IMAGE_MAX_SIDE / max(img.size)
+        if scale < 1:
+            img.draft('RGB', (max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+        
+        # Pillow เก็บภาพหลาย channel เป็น 4 byte ต่อ pixel
+        decoded_bytes = img.width * img.height * (4 if len(img.getbands()) > 1 else 1)
+        if decoded_bytes > IMAGE_MAX_DECODE_MB * 1024 * 1024:
+            raise ImageTooLarge(f"ภาพใหญ่เกินไป ({img.width}x{img.height} px)")
+        
+        # palette / 1-bit ย่อแบบ LANCZOS ไม่ได้ ต้องแปลงก่อน
+        if img.mode in ('P', '1'):
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        if img.width > IMAGE_MAX_SIDE or img.height > IMAGE_MAX_SIDE:
+            img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+        else:
+            img.load()
+        
+        if orientation in EXIF_TRANSPOSE:
+            img = img.transpose(EXIF_TRANSPOSE[orientation])
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return img
+
+def save_menu_jpeg(img):
+    byte_arr = io.BytesIO()
+    img.save(byte_arr, format='JPEG', quality=85, optimize=True)
+    return byte_arr.getvalue()
+
+def encode_menu_image(raw_bytes):
+    """ย่อรูปไม่เกิน IMAGE_MAX_SIDE แล้ว encode เป็น JPEG (รันใน worker process)"""
+    return save_menu_jpeg(decode_menu_image(raw_bytes))
+
+def find_watermark_font(path):
+    """ไฟล์ฟอนต์ที่จะใช้ (WATERMARK_FONT หรือตัวแรกใน WATERMARK_FONT_CANDIDATES ที่มีอยู่) - None ถ้าไม่เจอ"""
+    for candidate in ((path,) if path else WATERMARK_FONT_CANDIDATES):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+def watermark_style_problem(style):
+    """เหตุผลที่ style นี้ใช้สร้างลายน้ำไม่ได้ - None ถ้าใช้ได้"""
+    if not style['text'] and not style['logo']:
+        return 'ไม่ได้ตั้ง WATERMARK_TEXT หรือ WATERMARK_LOGO'
+    if style['logo'] and not os.path.exists(style['logo']):
+        return f"ไม่พบไฟล์โลโก้ {style['logo']}"
+    # ไม่ใช้ฟอนต์ default ของ Pillow - ไม่มีอักษรไทย จะได้ลายน้ำเป็นกล่องสี่เหลี่ยม
+    if style['text'] and find_watermark_font(style['font']) is None:
+        return f"ไม่พบไฟล์ฟอนต์ {style['font'] or ' / '.join(WATERMARK_FONT_CANDIDATES)}"
+    return None
+
+def usable_watermark_styles():
+    """style ใน WATERMARK_STYLES ที่ใช้ได้จริง - ถ้าไม่มีเลยจะ raise WatermarkNotConfigured พร้อมเหตุผล"""
+    styles = {}
+    problems = []
+    for folder, style in WATERMARK_STYLES.items():
+        problem = watermark_style_problem(style)
+        if problem:
+            problems.append(f"{folder}: {problem}")
+        else:
+            styles[folder] = style
+    if not styles:
+        raise WatermarkNotConfigured(f"ไม่ได้ตั้งค่าลายน้ำ ({'; '.join(problems) or 'WATERMARK_STYLES ว่าง'})")
+    return styles
+
+# แจ้งตั้งแต่เริ่มว่า style ไหนใช้ไม่ได้ (หน้าแอดมินจะซ่อนปุ่มลายน้ำ และ API ลายน้ำตอบ 400)
+for _folder, _style in WATERMARK_STYLES.items():
+    if watermark_style_problem(_style):
+        logger.warning(f"Watermark style '{_folder}' disabled: {watermark_style_problem(_style)}")
+
+@lru_cache(maxsize=16)
+def load_watermark_font(path, size):
+    """โหลดฟอนต์ลายน้ำ - ใช้ raqm (จัดวางสระ/วรรณยุกต์ไทยถูกตำแหน่ง) ถ้า Pillow มี"""
+    layout = ImageFont.Layout.RAQM if features.check('raqm') else ImageFont.Layout.BASIC
+    font_path = find_watermark_font(path)
+    if font_path is None:
+        raise WatermarkNotConfigured(f"ไม่พบไฟล์ฟอนต์ลายน้ำ ({path or 'WATERMARK_FONT'})")
+    return ImageFont.truetype(font_path, size, layout_engine=layout)
+
+@lru_cache(maxsize=4)
+def load_watermark_logo(path, mtime_ns):
+    # mtime_ns อยู่ใน key ของ cache - เปลี่ยนไฟล์โลโก้แล้วโหลดใหม่เอง
+    with Image.open(path) as logo:
+        return logo.convert('RGBA')
+
+def render_watermark(style, short_side):
+    """สร้างลายน้ำ 1 ชิ้น (โลโก้ + ข้อความ) เป็นภาพ RGBA ขนาดตามด้านสั้นของรูป"""
+    problem = watermark_style_problem(style)
+    if problem:
+        raise WatermarkNotConfigured(problem)
+    
+    size = max(12, int(short_side * style['scale']))
+    parts = []
+    if style['logo']:
+        logo = load_watermark_logo(style['logo'], os.stat(style['logo']).st_mtime_ns)
+        height = int(size * 1.5)
+        parts.append(logo.resize((max(1, logo.width * height // logo.height), height), Image.Resampling.LANCZOS))
+    if style['text']:
+        font = load_watermark_font(style['font'], size)
+        stroke = max(1, size // 16)
+        left, top, right, bottom = font.getbbox(style['text'], stroke_width=stroke)
+        text = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+        ImageDraw.Draw(text).text((-left, -top), style['text'], font=font, fill=tuple(style['color']),
+                                  stroke_width=stroke, stroke_fill=(0, 0, 0))
+        parts.append(text)
+    
+    gap = size // 2
+    mark = Image.new('RGBA', (sum(part.width for part in parts) + gap * (len(parts) - 1),
+                              max(part.height for part in parts)), (0, 0, 0, 0))
+    x = 0
+    for part in parts:
+        mark.alpha_composite(part, (x, (mark.height - part.height) // 2))
+        x += part.width + gap
+    mark.putalpha(mark.getchannel('A').point(lambda a: int(a * style['opacity'])))
+    return mark
+
+def apply_watermark(img, style):
+    """วางลายน้ำบนภาพ RGB ที่ถอดรหัสแล้ว (คืนภาพใหม่ ไม่แก้ภาพเดิม) - style ที่ใช้ไม่ได้จะ raise WatermarkNotConfigured"""
+    mark = render_watermark(style, min(img.size))
+    
+    overlay = Image.new('RGBA', img.size, (0, 0, 0, 0))
+    if style['position'] == 'center':
+        overlay.alpha_composite(mark, ((img.width - mark.width) // 2, (img.height - mark.height) // 2))
+    elif style['position'] == 'bottom-right':
+        margin = mark.height
+        overlay.alpha_composite(mark, (max(0, img.width - mark.width - margin), max(0, img.height - mark.height - margin)))
+    else:
+        # ปูทั้งรูปแบบเยื้องแถว แล้วเอียงทั้งแผ่น (แผ่นใหญ่กว่ารูป กันขอบว่างหลังหมุน)
+        side = int((img.width ** 2 + img.height ** 2) ** 0.5)
+        step_x, step_y = mark.width + mark.height * 2, mark.height * 4
+        tiles = Image.new('RGBA', (side + step_x, side), (0, 0, 0, 0))
+        for row, y in enumerate(range(0, side, step_y)):
+            for x in range((row % 2) * step_x // 2, side + step_x, step_x):
+                tiles.alpha_composite(mark, (x, y))
+        tiles = tiles.crop((step_x // 2, 0, step_x // 2 + side, side)).rotate(style['angle'], resample=Image.Resampling.BICUBIC)
+        overlay.alpha_composite(tiles, source=((side - img.width) // 2, (side - img.height) // 2))
+    
+    marked = img.convert('RGBA')
+    marked.alpha_composite(overlay)
+    return marked.convert('RGB')
+
+def encode_menu_variants(raw_bytes, styles):
+    """ถอดรหัสครั้งเดียว แล้ว encode ทั้งรูปต้นฉบับและรูปลายน้ำทุก style - คืน {'clean': bytes, folder: bytes}"""
+    img = decode_menu_image(raw_bytes)
+    variants = {'clean': save_menu_jpeg(img)}
+    for folder, style in styles.items():
+        variants[folder] = save_menu_jpeg(apply_watermark(img, style))
+    return variants
+
+def watermark_menu_image(raw_bytes, style):
+    """สร้างรูปลายน้ำจากรูปต้นฉบับที่เก็บไว้แล้ว (ใช้ตอน re-watermark ทั้งแคตตาล็อก)"""
+    return save_menu_jpeg(apply_watermark(decode_menu_image(raw_bytes), style))
+
+def watermark_signature(style):
+    """ค่าที่เปลี่ยนเมื่อ style หรือไฟล์โลโก้/ฟอนต์เปลี่ยน - ใช้ต่อท้าย hash ของต้นฉบับใน content index"""
+    files = [(path, os.stat(path).st_mtime_ns) for path in (style['logo'], style['font']) if path and os.path.exists(path)]
+    return json.dumps([style, files], sort_keys=True).encode()
+
+image_pool = {'executor': None}
+image_pool_lock = threading.Lock()
+image_pool_slots = threading.BoundedSemaphore(IMAGE_WORKERS + IMAGE_QUEUE_LIMIT)
+image_pool_reserve_lock = threading.Lock()
+
+def get_image_pool():
+    with image_pool_lock:
+        if image_pool['executor'] is None:
+            # spawn แทน fork - ไม่พา hub ของ eventlet ติดไปกับ process ลูก (process ลูก import app ใหม่ ไม่มี monkey patch)
+            # ทดสอบกับ gunicorn -k eventlet แล้ว: รอผลผ่าน threading ที่ถูก patch จึงไม่บล็อก request อื่น
+            image_pool['executor'] = ProcessPoolExecutor(max_workers=IMAGE_WORKERS,
+                                                         mp_context=multiprocessing.get_context('spawn'))
+        return image_pool['executor']
+
+class ImagePoolReservation:
+    """จองคิว image pool ล่วงหน้าสำหรับหลายงานของ request เดียว - ได้ครบทุกช่องหรือ raise ImagePoolBusy โดยไม่ค้างช่องไหนไว้
+
+    ใช้กับ with - ช่องที่จองแล้วไม่ได้ส่งงานคืนตอนออกจาก block
+    """
+
+    def __init__(self, count):
+        # ขอเกินขนาดคิวทั้งหมดไม่มีวันได้ - ส่วนที่เกินรอคิวตามปกติตอนส่งงาน
+        count = min(count, IMAGE_WORKERS + IMAGE_QUEUE_LIMIT)
+        self.remaining = 0
+        deadline = time.monotonic() + IMAGE_QUEUE_TIMEOUT
+        # จองทีละ request - สอง request ที่จองคนละครึ่งจะไม่รอกันจนหมดเวลา
+        with image_pool_reserve_lock:
+            while self.remaining < count:
+                if not image_pool_slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                    self.release()
+                    raise ImagePoolBusy('ระบบกำลังประมวลผลรูปจำนวนมาก กรุณาลองใหม่อีกครั้ง')
+                self.remaining += 1
+
+    def take(self):
+        """ใช้ 1 ช่องที่จองไว้ - คืน False ถ้าใช้หมดแล้ว"""
+        if self.remaining < 1:
+            return False
+        self.remaining -= 1
+        return True
+
+    def release(self):
+        for _ in range(self.remaining):
+            image_pool_slots.release()
+        self.remaining = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def submit_image_task(fn, *args, reservation=None):
+    """ส่งงานรูปเข้าคิว - ถ้าคิวเต็มเกิน IMAGE_QUEUE_TIMEOUT วินาทีจะ raise ImagePoolBusy
+
+    reservation = ImagePoolReservation ที่จองช่องไว้แล้ว (ใช้ช่องนั้นแทนการรอคิว)
+    """
+    if not (reservation and reservation.take()) and not image_pool_slots.acquire(timeout=IMAGE_QUEUE_TIMEOUT):
+        raise ImagePoolBusy('ระบบกำลังประมวลผลรูปจำนวนมาก กรุณาลองใหม่อีกครั้ง')
+    try:
+        future = get_image_pool().submit(fn, *args)
+    except Exception:
+        image_pool_slots.release()
+        raise
+    future.add_done_callback(lambda _: image_pool_slots.release())
+    return future
+
+def image_task_result(future, fn, *args):
+    """รอผลงานรูป - ถ้า pool พัง (worker ตาย) ให้สร้างใหม่แล้วทำใน request นี้แทน"""
+    try:
+        return future.result()
+    except BrokenProcessPool as e:
+        logger.error(f"Image pool broken, encoding inline: {e}")
+        with image_pool_lock:
+            image_pool['executor'] = None
+        return fn(*args)
+
+def run_image_task(fn, *args):
+    return image_task_result(submit_image_task(fn, *args), fn, *args)
+
+def shutdown_image_pool():
+    """ปิด image pool ตอน worker ปิดตัว (gunicorn.conf.py) - งานที่ยังไม่เริ่มถูกยกเลิก
+
+    ใต้ eventlet ถ้าปล่อยให้ interpreter ปิด pool เอง จะรอ thread จัดการ pool ค้างจนโดน kill หลัง graceful timeout
+    """
+    with image_pool_lock:
+        executor, image_pool['executor'] = image_pool['executor'], None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+# ==========================================
+# Cloudinary Client (rate limit + retry + รวม read ซ้ำ) - ทุกการเรียก Cloudinary ผ่านตรงนี้
+# ==========================================
+class SingleFlight:
+    """รวม request ที่ขอของชิ้นเดียวกันพร้อมกันให้เหลือการเรียกจริงครั้งเดียว"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def in_flight(self, key):
+        return key in self._calls
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+        
+        if not leader:
+            # มีคนกำลังดึงอยู่แล้ว - รอผลเดียวกัน
+            call['event'].wait()
+        else:
+            try:
+                call['result'] = fn()
+            except Exception as e:
+                call['error'] = e
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call['event'].set()
+        
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+
+class TokenBucket:
+    """token bucket - เติม rate token ต่อวินาที เก็บได้สูงสุด capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, timeout=None):
+        """รอจนได้ token - คืน False ถ้ารอเกิน timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def limit(self, remaining):
+        """ไม่ให้ token เกินโควต้าที่ Cloudinary บอกว่าเหลือจริง (header X-FeatureRateLimit-Remaining)"""
+        with self._lock:
+            self.tokens = min(self.tokens, remaining)
+
+class SharedTokenBucket(TokenBucket):
+    """token bucket ที่เก็บ state ใน cache backend - ทุก worker ที่ใช้ backend เดียวกัน (file/redis) ใช้โควต้าร่วมกัน
+
+    worker จองครั้งละ batch token (ไม่เกินครึ่ง capacity) มาใช้เองก่อน - ส่วนที่ไม่ได้ใช้ภายใน CLOUDINARY_BUCKET_LEASE
+    คืนเข้า bucket กลางตอนจองรอบถัดไป (ใน update เดียวกัน) จึงไม่ต้อง lock/เขียน backend ทุกครั้งที่เรียก API
+    self.tokens เป็นค่าล่าสุดที่ worker นี้เห็น (ใช้แสดงใน metrics)
+    """
+
+    def __init__(self, key, rate, capacity, batch=CLOUDINARY_BUCKET_BATCH):
+        super().__init__(rate, capacity)
+        self.key = key
+        self.batch = max(1, min(batch, capacity // 2))
+        self.allowance = 0  # token ที่จองไว้แล้วยังไม่ได้ใช้
+        self.allowance_until = 0.0
+
+    def _update(self, fn):
+        """เติม token ตามเวลาที่ผ่านไปแล้วแก้ state แบบ atomic ข้าม worker - fn(tokens) คืน (tokens ใหม่, ผลลัพธ์)"""
+        result = []
+        
+        def apply(entry):
+            now = time.time()
+            state = entry['data'] if entry and entry['data'] else {'tokens': float(self.capacity), 'updated': now}
+            tokens = min(self.capacity, state['tokens'] + max(0.0, now - state['updated']) * self.rate)
+            tokens, value = fn(tokens)
+            result.append(value)
+            self.tokens = tokens
+            return {'tokens': tokens, 'updated': now}
+        
+        cache_backend.update(self.key, apply)
+        return result[0]
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.allowance >= 1 and now < self.allowance_until:
+                    self.allowance -= 1
+                    return True
+                leftover, self.allowance = self.allowance, 0
+                
+                def reserve(tokens):
+                    # คืน token ที่จองไว้รอบก่อนแล้วจองใหม่ - คืน (จำนวนที่ได้, วินาทีที่ต้องรอถ้าไม่ได้เลย)
+                    tokens = min(self.capacity, tokens + leftover)
+                    if tokens < 1:
+                        return tokens, (0, (1 - tokens) / self.rate)
+                    granted = min(self.batch, int(tokens))
+                    return tokens - granted, (granted, 0.0)
+                
+                granted, wait = self._update(reserve)
+                if granted:
+                    self.allowance = granted - 1
+                    self.allowance_until = now + CLOUDINARY_BUCKET_LEASE
+                    return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def limit(self, remaining):
+        with self._lock:
+            # token ที่จองไว้ก็ถือว่าหมดไปด้วย
+            self.allowance = 0
+            self._update(lambda tokens: (min(tokens, remaining), None))
+
+# SDK แยก class ให้เฉพาะ 420/429 (RateLimited) และ 500/503 (GeneralError) - socket error, 502/504
+# และ body ที่ไม่ใช่ JSON จาก gateway เป็น Error/Exception ธรรมดา ต้องดูจากข้อความ
+TRANSIENT_CLOUDINARY_MESSAGE = re.compile(
+    r'^(Socket error|Unexpected error|Error parsing server response \((?:420|429|5\d\d)\)|Error (?:420|429|5\d\d) - )',
+    re.IGNORECASE
+)
+
+def is_transient_cloudinary_error(error):
+    """error จาก Cloudinary ที่ลองใหม่แล้วมีโอกาสผ่าน (rate limit / 5xx / network)"""
+    if isinstance(error, (cloudinary.exceptions.RateLimited, cloudinary.exceptions.GeneralError,
+                          Urllib3HTTPError, socket.timeout, ConnectionError)):
+        return True
+    if isinstance(error, cloudinary.exceptions.Error) or type(error) is Exception:
+        return bool(TRANSIENT_CLOUDINARY_MESSAGE.match(str(error)))
+    return False
+
+class CloudinaryClient:
+    """ห่อ cloudinary.api / cloudinary.uploader - token bucket แยก Admin/Upload API,
+    retry แบบ jitter เมื่อเจอ 420/429/5xx/socket error, รวม read ที่เหมือนกันที่กำลังวิ่งอยู่ และเก็บ metrics ต่อ operation
+    """
+
+    def __init__(self):
+        # memory backend แชร์ข้าม worker ไม่ได้ - แบ่งโควต้าตามจำนวน worker แทน (ดู CLOUDINARY_WORKERS)
+        share = CLOUDINARY_WORKERS if type(cache_backend) is MemoryCacheBackend else 1
+        self.buckets = {
+            'admin': SharedTokenBucket('cloudinary-admin-bucket', CLOUDINARY_ADMIN_RATE / share,
+                                       max(1, CLOUDINARY_ADMIN_BURST // share)),
+            'upload': SharedTokenBucket('cloudinary-upload-bucket', CLOUDINARY_UPLOAD_RATE / share,
+                                        max(1, CLOUDINARY_UPLOAD_BURST // share))
+        }
+        self.reads = SingleFlight()
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+
+    def _record(self, op, field, elapsed=None, error=None):
+        with self._metrics_lock:
+            stats = self._metrics.setdefault(op, {'calls': 0, 'errors': 0, 'retries': 0, 'coalesced': 0,
+                                                  'total_ms': 0.0, 'max_ms': 0.0, 'last_error': None})
+            stats[field] += 1
+            if elapsed is not None:
+                elapsed_ms = elapsed * 1000
+                stats['total_ms'] += elapsed_ms
+                stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            if error is not None:
+                stats['last_error'] = f"{type(error).__name__}: {error}"
+
+    def _call(self, op, bucket, fn):
+        for attempt in range(1, CLOUDINARY_MAX_ATTEMPTS + 1):
+            if not self.buckets[bucket].acquire(CLOUDINARY_RATE_WAIT):
+                error = cloudinary.exceptions.RateLimited(f"Local rate limit reached for {op}")
+                self._record(op, 'errors', error=error)
+                raise error
+            
+            started = time.perf_counter()
+            try:
+                result = fn()
+            except Exception as e:
+                self._record(op, 'errors', time.perf_counter() - started, e)
+                if attempt == CLOUDINARY_MAX_ATTEMPTS or not is_transient_cloudinary_error(e):
+                    raise
+                delay = min(CLOUDINARY_RETRY_BASE * 2 ** (attempt - 1), CLOUDINARY_RETRY_MAX) * random.uniform(0.5, 1.5)
+                logger.warning(f"Cloudinary {op} failed ({e}), retry {attempt} in {delay:.1f}s")
+                self._record(op, 'retries')
+                time.sleep(delay)
+                continue
+            
+            self._record(op, 'calls', time.perf_counter() - started)
+            remaining = getattr(result, 'rate_limit_remaining', None)
+            if remaining is not None:
+                self.buckets[bucket].limit(remaining)
+            return result
+
+    def _read(self, op, key, fn):
+        """read ที่ key เดียวกันกำลังวิ่งอยู่ - รอผลเดียวกันแทนการยิงซ้ำ"""
+        if self.reads.in_flight(key):
+            self._record(op, 'coalesced')
+        return self.reads.do(key, lambda: self._call(op, 'admin', fn))
+
+    # --- Admin API (อ่าน) ---
+    def resource(self, public_id, **options):
+        key = ('resource', public_id, tuple(sorted(options.items())))
+        return self._read('resource', key, lambda: cloudinary.api.resource(public_id, **options))
+
+    def resources(self, **options):
+        key = ('resources', tuple(sorted(options.items())))
+        return self._read('resources', key, lambda: cloudinary.api.resources(**options))
+
+    # --- Upload API ---
+    def upload(self, file, **options):
+        def send():
+            # retry ต้องอ่านไฟล์ใหม่ตั้งแต่ต้น
+            if hasattr(file, 'seek'):
+                file.seek(0)
+            return cloudinary.uploader.upload(file, **options)
+        return self._call('upload', 'upload', send)
+
+    def rename(self, from_public_id, to_public_id, **options):
+        return self._call('rename', 'upload', lambda: cloudinary.uploader.rename(from_public_id, to_public_id, **options))
+
+    def destroy(self, public_id, **options):
+        return self._call('destroy', 'upload', lambda: cloudinary.uploader.destroy(public_id, **options))
+
+    def metrics(self):
+        with self._metrics_lock:
+            operations = {
+                op: {**stats,
+                     'total_ms': round(stats['total_ms'], 1),
+                     'max_ms': round(stats['max_ms'], 1),
+                     'avg_ms': round(stats['total_ms'] / max(stats['calls'] + stats['errors'], 1), 1)}
+                for op, stats in self._metrics.items()
+            }
+        return {
+            'pid': os.getpid(),
+            'operations': operations,
+            'tokens': {name: round(bucket.tokens, 2) for name, bucket in self.buckets.items()}
+        }
+
+cloudinary_client = CloudinaryClient()
+
+# ==========================================
+# HTTP Session (outbound HTTP ทั้งหมดที่ไม่ผ่าน Cloudinary SDK)
+# ==========================================
+def create_http_session():
+    """requests.Session เดียวต่อ process - keep-alive + pool จำกัดขนาด (ไม่ต้อง TLS handshake ใหม่ทุกครั้ง)"""
+    http = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        pool_block=True,  # connection เต็ม = รอคิว แทนการเปิด connection ทิ้งขว้าง
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=(502, 503, 504),
+                          allowed_methods=frozenset(['GET', 'HEAD']), raise_on_status=False)
+    )
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    return http
+
+http_session = create_http_session()
+atexit.register(http_session.close)
+
+# ==========================================
+# Derivative URLs (รูปย่อจาก Cloudinary แทนรูปเต็ม 2048px)
+# ==========================================
+@app.template_global()
+def image_url(img, width):
+    """URL รูปย่อกว้างไม่เกิน width - f_auto ให้ CDN เลือก WebP/AVIF ตาม browser, version กัน cache เก่า"""
+    try:
+        url, _ = cloudinary.utils.cloudinary_url(
+            img.get('alias_of', img['public_id']),  # alias ใช้รูปของ asset จริง
+            width=width,
+            crop='limit',
+            fetch_format='auto',
+            quality='auto',
+            version=img.get('version'),
+            secure=True
+        )
+        return url
+    except ValueError:
+        # demo mode (ไม่มี cloud_name) - ใช้รูปเต็มแทน
+        return img['secure_url']
+
+@app.template_global()
+def image_srcset(img, widths=THUMBNAIL_WIDTHS):
+    return ', '.join(f"{image_url(img, width)} {width}w" for width in widths)
+
+def iter_resource_pages(prefix):
+    """ดึงรายการรูปจาก Cloudinary ทีละหน้า - ตาม next_cursor จนครบทุกหน้า"""
+    next_cursor = None
+    while True:
+        params = {'type': 'upload', 'prefix': prefix, 'max_results': LIST_PAGE_SIZE}
+        if next_cursor:
+            params['next_cursor'] = next_cursor
+        result = cloudinary_client.resources(**params)
+        yield result.get('resources', [])
+        
+        next_cursor = result.get('next_cursor')
+        if not next_cursor:
+            break
+
+def list_all_resources(prefix):
+    """รวมรูปทุกหน้าของโฟลเดอร์เดียว"""
+    resources = []
+    for page in iter_resource_pages(prefix):
+        resources.extend(page)
+    return resources
+
+def fetch_all_images():
+    """ดึงรูปทั้ง 3 โฟลเดอร์พร้อมกัน (ใช้เวลาเท่ากับโฟลเดอร์ที่ช้าที่สุด ไม่ใช่ผลรวม)"""
+    with ThreadPoolExecutor(max_workers=len(IMAGE_FOLDERS)) as executor:
+        futures = {key: executor.submit(list_all_resources, prefix) for key, prefix in IMAGE_FOLDERS.items()}
+        return {key: future.result() for key, future in futures.items()}
+
+image_fetches = SingleFlight()
+
+# snapshot ล่าสุดที่ดึงสำเร็จ - ใช้แสดงแทนถ้า Cloudinary ล่ม
+last_good_images = {'data': None}
+
+def _refresh_images():
+    """ดึงรายการรูปจาก Cloudinary แล้วเก็บลง cache (เรียกผ่าน image_fetches เท่านั้น)"""
+    # worker อื่นอาจรีเฟรชไปแล้วระหว่างรอ
+    entry = cache_backend.get('images')
+    if entry and entry['data'] and datetime.now() - entry['timestamp'] < CACHE_DURATION:
+        return entry['data']
+    
+    now = datetime.now()
+    data = resolve_aliases(fetch_all_images(), load_metadata()['aliases'])
+    written = []
+    
+    def replace(current):
+        # index_* แก้ cache ระหว่างที่ดึงอยู่ - ใส่การแก้นั้นซ้ำลงในรายการที่ดึงมา ไม่ให้ถูกเขียนทับกลับเป็นของเก่า
+        if entry and current and current['version'] != entry['version']:
+            written.append(merge_index_patches(data, entry['data'], current['data']))
+        else:
+            written.append(data)
+        return written[-1]
+    
+    cache_backend.update('images', replace, now)
+    data = written[-1]
+    last_good_images['data'] = data
+    schedule_catalog_snapshot()
+    logger.info(f"Updated image cache ({', '.join(f'{k}={len(v)}' for k, v in data.items())})")
+    return data
+
+def merge_index_patches(data, base, current):
+    """ใส่ความต่างระหว่าง cache รุ่น base กับ current (รูปที่ถูกลบ/เพิ่ม/แทนที่) ลงใน data ที่ดึงมาใหม่"""
+    merged = {}
+    for key, images in data.items():
+        before = {img['public_id']: img for img in base.get(key, [])}
+        after = {img['public_id']: img for img in current.get(key, [])}
+        removed = before.keys() - after.keys()
+        changed = {public_id: img for public_id, img in after.items() if before.get(public_id) != img}
+        merged[key] = [img for img in images if img['public_id'] not in removed and img['public_id'] not in changed]
+        merged[key] += changed.values()
+    return merged
+
+def _refresh_images_in_background():
+    """Stale-while-revalidate: รีเฟรชเบื้องหลัง ถ้ามีตัวอื่นรีเฟรชอยู่แล้วก็ไม่ต้องทำซ้ำ"""
+    if image_fetches.in_flight('images'):
+        return
+    
+    def run():
+        try:
+            image_fetches.do('images', _refresh_images)
+        except Exception as e:
+            logger.warning(f"Background image refresh failed, keep serving stale data: {e}")
+    
+    threading.Thread(target=run, daemon=True).start()
+
 def get_cached_images():
     """ดึงข้อมูลรูปจาก cache หรือ Cloudinary"""
-    global image_cache
     now = datetime.now()
     
-    # ตรวจสอบ cache
-    if image_cache['data'] and image_cache['timestamp']:
-        if now - image_cache['timestamp'] < CACHE_DURATION:
+    # ตรวจสอบ cache (worker เพิ่งเริ่ม - ใช้ catalog snapshot บนดิสก์แทน)
+    entry = cache_backend.get('images') or warm_start_images()
+    if entry and entry['data']:
+        last_good_images['data'] = entry['data']
+        if now - entry['timestamp'] < CACHE_DURATION:
             logger.info("Using cached image data")
-            return image_cache['data']
+            return entry['data']
+        
+        # หมดอายุ - ส่งของเก่าไปก่อน แล้วรีเฟรชเบื้องหลัง
+        logger.info("Image cache stale, serving stale data while refreshing")
+        _refresh_images_in_background()
+        return entry['data']
     
-    # ดึงข้อมูลใหม่
+    # ไม่มี cache เลย - ดึงใหม่ (request ที่เข้ามาพร้อมกันจะรอผลเดียวกัน)
     try:
-        res_wm = cloudinary.api.resources(type="upload", prefix="menu/watermarked/", max_results=500)
-        res_cl = cloudinary.api.resources(type="upload", prefix="menu/clean/", max_results=500)
-        res_pm = cloudinary.api.resources(type="upload", prefix="menu/premium/", max_results=500)
-        
-        data = {
-            'watermarked': res_wm.get('resources', []),
-            'clean': res_cl.get('resources', []),
-            'premium': res_pm.get('resources', [])
+        return image_fetches.do('images', _refresh_images)
+    except Exception as e:
+        if last_good_images['data'] is not None:
+            logger.error(f"Could not refresh images, using last good snapshot: {e}")
+            return last_good_images['data']
+        if isinstance(e, cloudinary.exceptions.Error):
+            logger.error(f"Cloudinary API error: {e}")
+        else:
+            logger.error(f"Unexpected error fetching images: {e}")
+        raise
+
+def clear_cache():
+    """ล้าง cache (ใช้ตอนแอดมินกดรีเฟรชเท่านั้น - mutation ปกติใช้ index_* แทน)"""
+    cache_backend.delete('images')
+    # snapshot ก็ทิ้งด้วย ไม่ให้ worker อื่นหยิบของเก่ากลับมาใช้ (โหลดใหม่แล้วจะเขียนให้เอง)
+    try:
+        os.remove(CATALOG_SNAPSHOT)
+    except FileNotFoundError:
+        pass
+    logger.info("Cache cleared")
+
+# ==========================================
+# Catalog Snapshot (รายการรูป + metadata บนดิสก์ - warm start หลัง deploy/restart)
+# ==========================================
+catalog_snapshot = {'timer': None}
+catalog_snapshot_lock = threading.Lock()
+
+def load_catalog_snapshot():
+    """อ่าน catalog snapshot จากดิสก์ (None ถ้าไม่มี/อ่านไม่ได้/คนละรูปแบบ)"""
+    try:
+        with gzip.open(CATALOG_SNAPSHOT, 'rt', encoding='utf-8') as f:
+            raw = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read catalog snapshot: {e}")
+        return None
+    if raw.get('format') != CATALOG_SNAPSHOT_FORMAT:
+        return None
+    return raw
+
+def warm_start_images():
+    """ใส่รายการรูปจาก snapshot เข้า cache - คืน entry (None ถ้าไม่มี snapshot)
+
+    timestamp ของ entry คือเวลาที่ดึงรายการจาก Cloudinary จริง ถ้าเก่ากว่า CACHE_DURATION
+    get_cached_images จะตอบจาก snapshot แล้วรีเฟรชเบื้องหลังตามปกติ (stale-while-revalidate)
+    """
+    snapshot = load_catalog_snapshot()
+    if snapshot is None or not snapshot.get('images'):
+        return None
+    
+    timestamp = datetime.fromisoformat(snapshot['images_at'])
+    # ถ้า worker อื่นโหลดของใหม่ไปพร้อมกัน ของที่เขียนทับเป็นข้อมูลเก่า (timestamp เก่า) จะถูกรีเฟรชทันที
+    cache_backend.set('images', snapshot['images'], timestamp)
+    logger.info(f"Warm start from catalog snapshot ({snapshot['images_at']})")
+    return {'data': snapshot['images'], 'timestamp': timestamp}
+
+def write_catalog_snapshot():
+    """เขียน snapshot ของรายการรูปใน cache + metadata ลงดิสก์ (gzip, เขียน temp แล้ว os.replace)"""
+    with catalog_snapshot_lock:
+        catalog_snapshot['timer'] = None
+    
+    entry = cache_backend.get('images')
+    if not entry or not entry['data']:
+        return
+    snapshot = {
+        'format': CATALOG_SNAPSHOT_FORMAT,
+        'images_at': entry['timestamp'].isoformat(),
+        'images': {
+            folder: [{field: img[field] for field in CATALOG_FIELDS if field in img} for img in images]
+            for folder, images in entry['data'].items()
         }
+    }
+    # store ยังว่าง (ยังไม่เคยโหลด metadata) - ไม่เขียน metadata ว่างทับให้ worker ถัดไปเข้าใจผิด
+    if not metadata_store.is_empty():
+        snapshot['metadata'] = json.loads(MetadataStore.serialize(metadata_store.read()))
+    
+    tmp_path = f"{CATALOG_SNAPSHOT}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, CATALOG_SNAPSHOT)
+        logger.info(f"Wrote catalog snapshot ({os.path.getsize(CATALOG_SNAPSHOT)} bytes)")
+    except OSError as e:
+        logger.warning(f"Could not write catalog snapshot: {e}")
+
+def schedule_catalog_snapshot():
+    """ตั้งเวลาเขียน snapshot - การแก้ไขที่ตามมาภายใน CATALOG_SNAPSHOT_DELAY จะรวมไปรอบเดียวกัน"""
+    with catalog_snapshot_lock:
+        if catalog_snapshot['timer'] is not None:
+            return
+        timer = threading.Timer(CATALOG_SNAPSHOT_DELAY, write_catalog_snapshot)
+        timer.daemon = True
+        catalog_snapshot['timer'] = timer
+        timer.start()
+
+def flush_catalog_snapshot():
+    """เขียน snapshot ที่ค้างอยู่ทันที (ตอน worker ปิดตัว)"""
+    with catalog_snapshot_lock:
+        timer = catalog_snapshot['timer']
+        if timer is None:
+            return
+        timer.cancel()
+    write_catalog_snapshot()
+
+atexit.register(flush_catalog_snapshot)
+
+# ==========================================
+# Incremental image index (แก้ไข cache ตรงจุด ไม่ต้องโหลดใหม่ทั้งหมด)
+# ==========================================
+def folder_key_for(public_id):
+    """หาว่า public_id อยู่ในโฟลเดอร์ไหน (watermarked/clean/premium)"""
+    for key, prefix in IMAGE_FOLDERS.items():
+        if public_id.startswith(prefix):
+            return key
+    return None
+
+def _index_discard(data, public_id):
+    # สร้าง list ใหม่แทนการแก้ของเดิม - request ที่กำลังวนลูปอยู่จะไม่พัง
+    key = folder_key_for(public_id)
+    if key:
+        data[key] = [img for img in data[key] if img['public_id'] != public_id]
+
+def _index_patch(discard=(), add=None):
+    """แก้ข้อมูลใน cache 'images' แบบ atomic (ถ้ายังไม่มี cache ก็ไม่ต้องทำอะไร)"""
+    def patch(entry):
+        # ยังไม่มี cache - รอบหน้าจะโหลดใหม่ทั้งหมดอยู่แล้ว
+        if not entry or not entry['data']:
+            return None
+        data = dict(entry['data'])
+        for public_id in discard:
+            _index_discard(data, public_id)
+        if add is not None:
+            key = folder_key_for(add['public_id'])
+            data[key] = data[key] + [add]
+        return data
+    
+    before = cache_backend.version('images')
+    cache_backend.update('images', patch)
+    # อัปเดต search index ตามไปด้วย (ถ้ายังตรงกับ cache รุ่นก่อนหน้า)
+    after = cache_backend.version('images')
+    if after != before:
+        menu_search.apply_patch(before, after, discard, add)
+        schedule_catalog_snapshot()
+
+def index_upsert(resource):
+    """เพิ่ม/แทนที่รูปใน cache จากผลลัพธ์ upload"""
+    if not folder_key_for(resource.get('public_id', '')):
+        return
+    _index_patch(discard=[resource['public_id']], add=resource)
+    # hash ของ version ก่อนหน้า (ถูกแทนที่แล้ว)
+    prune_content_hashes(resource['public_id'], resource.get('version'))
+    logger.info(f"Index upsert: {resource['public_id']}")
+
+def index_remove(public_id):
+    """ลบรูปออกจาก cache"""
+    _index_patch(discard=[public_id])
+    prune_content_hashes(public_id)
+    logger.info(f"Index remove: {public_id}")
+
+def index_rename(old_public_id, resource):
+    """เปลี่ยนชื่อรูปใน cache (ลบของเดิม + ของที่ถูกทับ แล้วใส่ของใหม่)"""
+    if not folder_key_for(resource.get('public_id', '')):
+        index_remove(old_public_id)
+        return
+    _index_patch(discard=[old_public_id, resource['public_id']], add=resource)
+    prune_content_hashes(old_public_id)
+    prune_content_hashes(resource['public_id'], resource.get('version'))
+    logger.info(f"Index rename: {old_public_id} -> {resource['public_id']}")
+
+def alias_resource(alias_id, alias, source):
+    """resource ของ alias ใน image index - รูป/ขนาด/version ของ source แต่ชื่อและวันที่เป็นของ alias"""
+    return {**source, 'public_id': alias_id, 'alias_of': alias['source'], 'created_at': alias['created_at']}
+
+def resolve_aliases(data, aliases):
+    """ใส่ alias (เมนูที่คัดลอกแบบไม่อัปโหลดซ้ำ) ลงในรายการรูปจาก Cloudinary - asset จริงชื่อเดียวกันมาก่อน alias"""
+    if not aliases:
+        return data
+    resolved = {}
+    for key, images in data.items():
+        by_id = {img['public_id']: img for img in images}
+        resolved[key] = images + [
+            alias_resource(alias_id, alias, by_id[alias['source']]) for alias_id, alias in aliases.items()
+            if folder_key_for(alias_id) == key and alias['source'] in by_id and alias_id not in by_id
+        ]
+    return resolved
+
+def cached_image(public_id):
+    """resource ของ public_id ใน image index (None ถ้าไม่มี)"""
+    for img in get_cached_images().get(folder_key_for(public_id), []):
+        if img['public_id'] == public_id:
+            return img
+    return None
+
+# ==========================================
+# Menu Search Index (n-gram ของชื่อเมนู - รองรับสระ/วรรณยุกต์ไทย)
+# ==========================================
+class MenuSearchIndex:
+    """ดัชนีค้นหาชื่อเมนูแบบ substring
+
+    ชื่อถูก normalize (NFC + casefold) แล้วเก็บ posting ของตัวอักษรเดี่ยวและคู่ตัวอักษรที่ติดกัน
+    ตาม code point (สระบน/ล่างและวรรณยุกต์ไทยนับเป็นตัวอักษรแยก) - term ที่เป็น substring ของชื่อ
+    มีทุก gram อยู่ในชื่อนั้นเสมอ ตอนค้นหาจะ intersect posting แล้วตรวจ substring จริงอีกรอบ
+    """
+
+    def __init__(self):
+        self.version = None  # version ของ cache 'images' ที่ index นี้สะท้อนอยู่
+        self._lock = threading.Lock()
+        self._entries = {}   # name -> {'key', 'created_at', 'ids'}
+        self._grams = {}     # gram -> set(name)
+
+    @staticmethod
+    def grams_for(key):
+        return set(key) | {key[i:i + 2] for i in range(len(key) - 1)}
+
+    def _add(self, public_id, created_at):
+        name = public_id.split('/')[-1]
+        entry = self._entries.get(name)
+        if entry is None:
+            entry = {'key': normalize_search_term(name), 'created_at': created_at, 'ids': set()}
+            self._entries[name] = entry
+            for gram in self.grams_for(entry['key']):
+                self._grams.setdefault(gram, set()).add(name)
+        entry['ids'].add(public_id)
+        entry['created_at'] = max(entry['created_at'], created_at)
+
+    def _discard(self, public_id):
+        name = public_id.split('/')[-1]
+        entry = self._entries.get(name)
+        if entry is None:
+            return
+        entry['ids'].discard(public_id)
+        # ยังมีรูปโฟลเดอร์อื่นใช้ชื่อนี้อยู่ - เก็บไว้
+        if entry['ids']:
+            return
+        del self._entries[name]
+        for gram in self.grams_for(entry['key']):
+            names = self._grams.get(gram)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._grams[gram]
+
+    def rebuild(self, data, version):
+        with self._lock:
+            self._entries = {}
+            self._grams = {}
+            for folder in IMAGE_FOLDERS:
+                for img in data.get(folder, []):
+                    self._add(img['public_id'], img['created_at'])
+            self.version = version
+        logger.info(f"Rebuilt menu search index ({len(self._entries)} names)")
+
+    def apply_patch(self, old_version, new_version, discard=(), add=None):
+        """แก้ index ตรงจุดตาม _index_patch - ถ้า version ไม่ต่อกัน ปล่อยให้ rebuild รอบหน้า"""
+        with self._lock:
+            if self.version is None or self.version != old_version:
+                return
+            for public_id in discard:
+                self._discard(public_id)
+            if add is not None:
+                self._add(add['public_id'], add['created_at'])
+            self.version = new_version
+
+    @staticmethod
+    def _rank(key, term):
+        if key == term:
+            return 0
+        if key.startswith(term):
+            return 1
+        # ขึ้นต้นคำ (หลังช่องว่าง / - / _)
+        if any(key[i - 1] in ' -_' for i in range(1, len(key)) if key.startswith(term, i)):
+            return 2
+        return 3
+
+    def search(self, term, limit=None):
+        """คืนรายชื่อเมนูที่มี term อยู่ - เรียงตาม ตรงทั้งหมด > ขึ้นต้น > ขึ้นต้นคำ > อยู่ตรงกลาง แล้วชื่อสั้น/ใหม่ก่อน"""
+        term = normalize_search_term(term)
+        if not term:
+            return []
+        grams = [term] if len(term) == 1 else [term[i:i + 2] for i in range(len(term) - 1)]
         
-        # อัปเดต cache
-        image_cache['data'] = data
-        image_cache['timestamp'] = now
-        logger.info("Updated image cache")
+        with self._lock:
+            postings = sorted((self._grams.get(gram, set()) for gram in set(grams)), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:]) if postings else set()
+            matches = [(name, self._entries[name]) for name in candidates if term in self._entries[name]['key']]
         
+        matches.sort(key=lambda item: item[1]['created_at'], reverse=True)
+        matches.sort(key=lambda item: (self._rank(item[1]['key'], term), len(item[1]['key'])))
+        names = [name for name, _ in matches]
+        return names[:limit] if limit else names
+
+menu_search = MenuSearchIndex()
+
+def get_search_index():
+    """search index ที่ตรงกับ cache 'images' ล่าสุด (rebuild เฉพาะตอนมีการเปลี่ยนจากที่อื่น เช่น worker อื่น/รีเฟรช)"""
+    data = get_cached_images()
+    version = cache_backend.version('images')
+    if menu_search.version != version:
+        menu_search.rebuild(data, version)
+    return menu_search
+
+def filter_images_by_search(images, term):
+    """กรองรูปด้วย search index - คงลำดับเดิมของ images ไว้"""
+    if not term:
+        return images
+    names = set(get_search_index().search(term))
+    return [img for img in images if img['public_id'].split('/')[-1] in names]
+
+def run_per_folder(fn, folders=tuple(IMAGE_FOLDERS)):
+    """รัน fn(folder) ทุกโฟลเดอร์พร้อมกัน - คืน {folder: (ผลลัพธ์, exception)} ตามลำดับโฟลเดอร์"""
+    if not folders:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(folders)) as executor:
+        futures = {folder: executor.submit(fn, folder) for folder in folders}
+    
+    results = {}
+    for folder, future in futures.items():
+        try:
+            results[folder] = (future.result(), None)
+        except Exception as e:
+            results[folder] = (None, e)
+    return results
+
+# ==========================================
+# Visibility (4-bit mask ต่อเมนู)
+# ==========================================
+def visibility_mask(flags):
+    """แปลง dict แบบเดิม (show_* 4 ค่า) เป็น mask - key ที่ไม่มีใช้ค่า default"""
+    return sum(bit for key, bit in VISIBILITY_BITS.items() if flags.get(key, VISIBILITY_DEFAULTS[key]))
+
+# dict ของแต่ละ mask สร้างไว้ครั้งเดียว (16 แบบ) - ใช้ร่วมกัน ห้ามแก้ตรงๆ
+VISIBILITY_FLAGS = tuple({key: bool(mask & bit) for key, bit in VISIBILITY_BITS.items()} for mask in range(16))
+
+# ตาราง translate: mask -> 1/0 ตาม bit ของแต่ละโซน (ใช้กรองทั้งโซนทีเดียวด้วย bytes.translate)
+VISIBILITY_SELECTORS = {bit: bytes(1 if mask & bit else 0 for mask in range(256)) for bit in VISIBILITY_BITS.values()}
+
+# serialized form: 1 ตัวอักษร hex ต่อเมนู
+MASK_TO_HEX = bytes.maketrans(bytes(range(16)), b'0123456789abcdef')
+HEX_TO_MASK = bytes.maketrans(b'0123456789abcdef', bytes(range(16)))
+
+class VisibilityTable:
+    """visibility ของทุกเมนูใน array('B') 1 byte ต่อเมนู - index ด้วย id ของชื่อเมนู (intern ไว้)
+
+    ใน state ของ metadata store ถือเป็น immutable - จะแก้ต้อง copy() ก่อน
+    """
+
+    def __init__(self, names=(), masks=b''):
+        self.names = [sys.intern(name) for name in names]
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        self.masks = array('B', masks)
+
+    def __len__(self):
+        return len(self.names)
+
+    def copy(self):
+        table = VisibilityTable()
+        table.names = list(self.names)
+        table.ids = dict(self.ids)
+        table.masks = array('B', self.masks)
+        return table
+
+    def get(self, name):
+        i = self.ids.get(name)
+        return DEFAULT_VISIBILITY_MASK if i is None else self.masks[i]
+
+    def flags(self, name):
+        return VISIBILITY_FLAGS[self.get(name)]
+
+    def set(self, name, mask):
+        i = self.ids.get(name)
+        if i is None:
+            name = sys.intern(name)
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.masks.append(mask)
+        else:
+            self.masks[i] = mask
+
+    def masks_for(self, names):
+        """mask ของหลายเมนูเรียงตาม names เป็น bytes (ไว้ translate/compress ต่อ)"""
+        get = self.ids.get
+        masks = self.masks
+        return bytes(DEFAULT_VISIBILITY_MASK if i is None else masks[i] for i in map(get, names))
+
+    def to_json(self):
+        # เมนูที่ยังเป็นค่า default ไม่ต้องเก็บ
+        keep = [mask != DEFAULT_VISIBILITY_MASK for mask in self.masks]
+        names = list(itertools.compress(self.names, keep))
+        masks = bytes(itertools.compress(self.masks, keep))
+        return {'names': names, 'masks': masks.translate(MASK_TO_HEX).decode('ascii')}
+
+    @classmethod
+    def from_json(cls, raw):
+        """อ่านได้ทั้งรูปแบบ mask และ schema เดิม {'menus': {name: {show_*: bool}}}"""
+        if 'menus' in raw:
+            menus = raw['menus']
+            return cls(menus.keys(), bytes(visibility_mask(flags) for flags in menus.values()))
+        return cls(raw.get('names', []), raw.get('masks', '').encode('ascii').translate(HEX_TO_MASK))
+
+class MetadataConflict(Exception):
+    """version ที่อ้างถึงไม่ใช่ version ล่าสุด (มีคนแก้ metadata ไปก่อนแล้ว)"""
+
+class MetadataStore:
+    """ที่เก็บ metadata แบบ snapshot + journal (append-only) บนดิสก์ - ใช้ร่วมกันทุก worker
+
+    การแก้ไขแต่ละครั้งต่อท้าย journal 1 บรรทัด (เฉพาะเมนูที่เปลี่ยน) ภายใต้ flock แล้ว fsync
+    เมื่อ journal ยาวถึง compact_every จะรวมเป็น snapshot ใหม่ (เขียน temp แล้ว os.replace)
+    แต่ละ worker จำ state ไว้ และอ่านเฉพาะบรรทัดที่ต่อท้าย journal มาใหม่เท่านั้น
+
+    state: visibility + version (นับเฉพาะการแก้ visibility ใช้ตรวจ conflict),
+    hashes = content index {sha256: {public_id: version ของ asset}},
+    aliases = รูปที่คัดลอกแบบชี้ไปที่ asset อื่น {public_id: {'source': public_id ของ asset จริง, 'created_at': ...}}
+    และ seq (นับทุกรายการใน journal)
+    """
+
+    def __init__(self, directory, compact_every=METADATA_COMPACT_EVERY):
+        self.directory = directory
+        self.compact_every = compact_every
+        os.makedirs(directory, exist_ok=True)
+        self.snapshot_path = os.path.join(directory, 'snapshot.json')
+        self.journal_path = os.path.join(directory, 'journal.jsonl')
+        self._lock = threading.Lock()
+        self._state = self.empty_state()
+        self._snapshot_stamp = None
+        self._journal_ino = None
+        self._offset = 0
+        self._journal_lines = 0
+
+    def _locked(self):
+        lock_file = open(os.path.join(self.directory, 'metadata.lock'), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _write_atomic(self, path, text):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def empty_state():
+        return {'visibility': VisibilityTable(), 'version': 0, 'hashes': {}, 'aliases': {}, 'seq': 0}
+
+    @staticmethod
+    def state_from_json(raw):
+        version = raw.get('version', 0)
+        # snapshot รุ่นก่อนไม่มี seq/hashes/aliases
+        return {'visibility': VisibilityTable.from_json(raw), 'version': version,
+                'hashes': raw.get('hashes', {}), 'aliases': raw.get('aliases', {}), 'seq': raw.get('seq', version)}
+
+    def _load_snapshot(self, stamp):
+        if stamp is None:
+            self._state = self.empty_state()
+        else:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                self._state = self.state_from_json(json.load(f))
+        self._snapshot_stamp = stamp
+        # snapshot เปลี่ยน = journal ถูกรวมไปแล้ว เริ่มอ่าน journal ใหม่ตั้งแต่ต้น
+        self._journal_ino = None
+
+    def _read_journal(self):
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            self._journal_ino, self._offset, self._journal_lines = None, 0, 0
+            return
+        if stat.st_ino != self._journal_ino or stat.st_size < self._offset:
+            self._journal_ino, self._offset, self._journal_lines = stat.st_ino, 0, 0
+        if stat.st_size == self._offset:
+            return
+        
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self._offset)
+            chunk = f.read()
+        # บรรทัดสุดท้ายที่ยังเขียนไม่จบ (ไม่มี newline) ไว้อ่านรอบหน้า
+        end = chunk.rfind(b'\n') + 1
+        table = hashes = aliases = None
+        version, seq = self._state['version'], self._state['seq']
+        for line in chunk[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning(f"Skip corrupt metadata journal line: {line[:80]!r}")
+                continue
+            self._journal_lines += 1
+            # รายการที่รวมอยู่ใน snapshot แล้ว (journal รุ่นก่อนไม่มี seq)
+            record_seq = record.get('seq', record['version'])
+            if record_seq <= seq:
+                continue
+            if record.get('hashes'):
+                if hashes is None:
+                    hashes = dict(self._state['hashes'])
+                for digest, assets in record['hashes'].items():
+                    # version None = asset ถูกลบ/แทนที่/เปลี่ยนชื่อไปแล้ว
+                    merged = {**hashes.get(digest, {}), **assets}
+                    merged = {asset_id: version for asset_id, version in merged.items() if version is not None}
+                    if merged:
+                        hashes[digest] = merged
+                    else:
+                        hashes.pop(digest, None)
+            if record.get('aliases'):
+                if aliases is None:
+                    aliases = dict(self._state['aliases'])
+                for alias_id, alias in record['aliases'].items():
+                    # None = alias ถูกลบ/กลายเป็น asset จริงแล้ว
+                    if alias is None:
+                        aliases.pop(alias_id, None)
+                    else:
+                        aliases[alias_id] = alias
+            if table is None and record['changes']:
+                table = self._state['visibility'].copy()
+            for filename, value in record['changes'].items():
+                # None = กลับเป็นค่า default, dict = journal รูปแบบเดิม
+                if value is None:
+                    value = DEFAULT_VISIBILITY_MASK
+                elif isinstance(value, dict):
+                    value = visibility_mask(value)
+                table.set(filename, value)
+            version, seq = record['version'], record_seq
+        self._offset += end
+        
+        # state เป็น immutable - สร้าง dict ใหม่เฉพาะตอนมีการเปลี่ยน
+        if seq != self._state['seq']:
+            self._state = {'visibility': table or self._state['visibility'], 'version': version,
+                           'hashes': self._state['hashes'] if hashes is None else hashes,
+                           'aliases': self._state['aliases'] if aliases is None else aliases, 'seq': seq}
+
+    def _refresh(self):
+        for _ in range(3):
+            stamp = self._stamp(self.snapshot_path)
+            if stamp != self._snapshot_stamp:
+                self._load_snapshot(stamp)
+            self._read_journal()
+            # ถ้า compaction เกิดขึ้นระหว่างอ่าน ให้อ่านใหม่อีกรอบ
+            if self._stamp(self.snapshot_path) == self._snapshot_stamp:
+                return
+
+    def is_empty(self):
+        return self._stamp(self.snapshot_path) is None and self._stamp(self.journal_path) is None
+
+    def read(self):
+        """state ล่าสุด {'visibility': VisibilityTable, 'version': n, 'hashes': {...}, 'aliases': {...}, 'seq': n} (ห้ามแก้ที่ได้ไปตรงๆ)"""
+        with self._lock:
+            self._refresh()
+            return self._state
+
+    def commit(self, changes, expected_version=None, hashes=None, aliases=None):
+        """บันทึกการเปลี่ยนแปลง {filename: mask หรือ None = ค่า default} เป็น 1 รายการใน journal
+
+        ถ้าระบุ expected_version แล้วไม่ตรงกับ version ปัจจุบัน จะ raise MetadataConflict
+        hashes {sha256: {public_id: version หรือ None = ลบออก}} รวมเข้า content index (ไม่นับเป็นการแก้ visibility)
+        aliases {public_id: alias หรือ None = ลบออก} ก็เช่นกัน
+        """
+        with self._lock, self._locked():
+            self._refresh()
+            version = self._state['version']
+            if expected_version is not None and expected_version != version:
+                raise MetadataConflict(f"metadata version {expected_version} is stale (current {version})")
+            
+            record = {'seq': self._state['seq'] + 1, 'version': version + 1 if changes else version,
+                      'at': datetime.now(timezone.utc).isoformat(), 'changes': changes}
+            if hashes:
+                record['hashes'] = hashes
+            if aliases:
+                record['aliases'] = aliases
+            line = (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+            
+            fd = os.open(self.journal_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                # ตัดบรรทัดที่เขียนค้างไว้ (process ตายกลางทาง) ทิ้งก่อนต่อท้าย
+                if self._journal_ino == os.fstat(fd).st_ino and os.fstat(fd).st_size > self._offset:
+                    os.ftruncate(fd, self._offset)
+                os.lseek(fd, 0, os.SEEK_END)
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            
+            self._read_journal()
+            if self._journal_lines >= self.compact_every:
+                self._compact()
+            return self._state['version']
+
+    def _compact(self):
+        """รวม journal เข้า snapshot (เรียกภายใต้ flock)"""
+        self._write_atomic(self.snapshot_path, self.serialize(self._state))
+        self._write_atomic(self.journal_path, '')
+        self._load_snapshot(self._stamp(self.snapshot_path))
+        self._read_journal()
+        logger.info(f"Compacted metadata journal at seq {self._state['seq']}")
+
+    @staticmethod
+    def serialize(state):
+        return json.dumps({'version': state['version'], 'seq': state['seq'], **state['visibility'].to_json(),
+                           'hashes': state['hashes'], 'aliases': state['aliases']},
+                          ensure_ascii=False, separators=(',', ':'))
+
+    def seed(self, raw):
+        """ใส่ข้อมูลตั้งต้น (เช่น snapshot จาก Cloudinary) - ทำเฉพาะตอน store ยังว่างอยู่"""
+        with self._lock, self._locked():
+            if not self.is_empty():
+                return False
+            self._state = self.state_from_json(raw)
+            self._compact()
+            return True
+
+    def adopt(self, raw):
+        """แทนที่ด้วย snapshot จากที่อื่น - เฉพาะเมื่อใหม่กว่าของเรา"""
+        with self._lock, self._locked():
+            self._refresh()
+            state = self.state_from_json(raw)
+            if state['seq'] <= self._state['seq']:
+                return False
+            self._state = state
+            self._compact()
+            return True
+
+metadata_store = MetadataStore(METADATA_DIR)
+metadata_upload = {'timer': None}
+metadata_upload_lock = threading.Lock()
+
+metadata_fetches = SingleFlight()
+
+# validator ของ snapshot บน Cloudinary ที่โหลดล่าสุด (ใช้ทำ conditional GET)
+remote_metadata = {'etag': None, 'last_modified': None, 'checked_at': None}
+
+def remote_metadata_url():
+    # URL แบบไม่มี version - ชี้ไฟล์ล่าสุดเสมอ ไม่ต้องถาม Admin API ก่อน
+    url, _ = cloudinary.utils.cloudinary_url('menu_metadata_store', resource_type='raw', secure=True)
+    return url
+
+def fetch_remote_metadata(conditional=False):
+    """ดึง snapshot metadata จาก Cloudinary raw file (None ถ้าไม่มี/ไม่เปลี่ยน/โหลดไม่ได้)
+
+    conditional=True ส่ง ETag/Last-Modified ของรอบก่อนไปด้วย - ถ้าไม่เปลี่ยนจะได้ 304 ไม่ต้องโหลดและ parse ใหม่
+    """
+    headers = {}
+    if conditional and remote_metadata['etag']:
+        headers['If-None-Match'] = remote_metadata['etag']
+    if conditional and remote_metadata['last_modified']:
+        headers['If-Modified-Since'] = remote_metadata['last_modified']
+    
+    remote_metadata['checked_at'] = datetime.now()
+    try:
+        response = http_session.get(remote_metadata_url(), headers=headers, timeout=HTTP_TIMEOUT)
+        if response.status_code == 304:
+            logger.info("Metadata in Cloudinary not modified")
+            return None
+        if response.status_code == 404:
+            logger.info("Metadata not found in Cloudinary, will create new")
+            return None
+        response.raise_for_status()
+        data = response.json()
+        remote_metadata['etag'] = response.headers.get('ETag')
+        remote_metadata['last_modified'] = response.headers.get('Last-Modified')
+        logger.info("Loaded metadata from Cloudinary")
         return data
-    except cloudinary.exceptions.Error as e:
-        logger.error(f"Cloudinary API error: {e}")
-        raise
     except Exception as e:
-        logger.error(f"Unexpected error fetching images: {e}")
-        raise
+        logger.warning(f"Could not load from Cloudinary: {e}")
+    return None
+
+def revalidate_remote_metadata():
+    """ตรวจ snapshot บน Cloudinary เบื้องหลัง - ถ้ามีที่อื่นเขียน version ใหม่กว่าไว้ก็รับมาใช้"""
+    if metadata_fetches.in_flight('remote'):
+        return
+    
+    def check():
+        data = fetch_remote_metadata(conditional=True)
+        if data is not None and metadata_store.adopt(data):
+            logger.info(f"Adopted newer metadata from Cloudinary (seq {data.get('seq', data.get('version'))})")
+    
+    def run():
+        try:
+            metadata_fetches.do('remote', check)
+        except Exception as e:
+            logger.warning(f"Metadata revalidation failed: {e}")
+    
+    threading.Thread(target=run, daemon=True).start()
+
+def load_metadata():
+    """โหลด metadata จาก metadata store บนดิสก์ (ครั้งแรกดึง snapshot จาก Cloudinary)"""
+    try:
+        if metadata_store.is_empty():
+            # warm start จาก catalog snapshot ก่อน (Cloudinary ตรวจเบื้องหลังในรอบถัดไป)
+            snapshot = load_catalog_snapshot()
+            data = snapshot.get('metadata') if snapshot else None
+            if data is not None:
+                logger.info("Loaded metadata from catalog snapshot")
+                revalidate_remote_metadata()
+            else:
+                data = fetch_remote_metadata()
+            # ไม่มีใน Cloudinary ให้ลองไฟล์ local รูปแบบเดิม
+            if data is None and os.path.exists(METADATA_FILE):
+                with open(METADATA_FILE, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                logger.info("Loaded metadata from local file")
+            if metadata_store.seed(data or {'menus': {}}):
+                logger.info("Seeded metadata store")
+        elif remote_metadata['checked_at'] is None or datetime.now() - remote_metadata['checked_at'] > METADATA_REMOTE_CHECK:
+            revalidate_remote_metadata()
+        return metadata_store.read()
+    except Exception as e:
+        logger.error(f"Error loading metadata: {e}")
+        return MetadataStore.empty_state()
+
+def upload_metadata_snapshot():
+    """อัปโหลด metadata ล่าสุดขึ้น Cloudinary raw file (ไฟล์เดียว ทับของเดิม)"""
+    with metadata_upload_lock:
+        metadata_upload['timer'] = None
+    
+    state = metadata_store.read()
+    # worker อื่นอัปโหลด version นี้ (หรือใหม่กว่า) ไปแล้ว
+    uploaded_path = os.path.join(METADATA_DIR, 'uploaded.version')
+    try:
+        with open(uploaded_path, 'r') as f:
+            if int(f.read() or 0) >= state['seq']:
+                return
+    except (OSError, ValueError):
+        pass
+    
+    try:
+        metadata_json = MetadataStore.serialize(state)
+        cloudinary_client.upload(
+            f"data:application/json;base64,{base64.b64encode(metadata_json.encode()).decode()}",
+            public_id="menu_metadata_store",
+            resource_type="raw",
+            overwrite=True,
+            invalidate=True  # ให้ CDN ทิ้งไฟล์เก่า (อ่านกลับผ่าน URL ที่ไม่มี version)
+        )
+        metadata_store._write_atomic(uploaded_path, str(state['seq']))
+        logger.info(f"Metadata saved to Cloudinary (seq {state['seq']})")
+    except Exception as e:
+        logger.warning(f"Could not save to Cloudinary, using local only: {e}")
+
+def schedule_metadata_upload():
+    """ตั้งเวลาอัปโหลด snapshot - การแก้ไขที่ตามมาภายใน METADATA_UPLOAD_DELAY จะรวมไปรอบเดียวกัน"""
+    with metadata_upload_lock:
+        if metadata_upload['timer'] is not None:
+            return
+        timer = threading.Timer(METADATA_UPLOAD_DELAY, upload_metadata_snapshot)
+        timer.daemon = True
+        metadata_upload['timer'] = timer
+        timer.start()
+
+def flush_metadata_upload():
+    """อัปโหลดที่ค้างอยู่ทันที (ตอน worker ปิดตัว)"""
+    with metadata_upload_lock:
+        timer = metadata_upload['timer']
+        if timer is None:
+            return
+        timer.cancel()
+    upload_metadata_snapshot()
+
+atexit.register(flush_metadata_upload)
+
+def save_metadata(changes, expected_version=None):
+    """บันทึกการเปลี่ยนแปลง metadata ลง journal แล้วตั้งเวลาอัปโหลด snapshot (คืน version ใหม่)"""
+    load_metadata()  # ให้แน่ใจว่า store ถูก seed แล้วก่อนเขียนทับ
+    version = metadata_store.commit(changes, expected_version)
+    schedule_metadata_upload()
+    schedule_catalog_snapshot()
+    return version
+
+def save_content_hashes(hashes):
+    """เพิ่ม/ลบ {sha256: {public_id: version หรือ None}} ใน content index (ไม่เปลี่ยน version ของ visibility)"""
+    load_metadata()
+    metadata_store.commit({}, hashes=hashes)
+    schedule_metadata_upload()
+    schedule_catalog_snapshot()
+
+def save_aliases(aliases):
+    """เพิ่ม/ลบ {public_id: {'source', 'created_at'} หรือ None} ใน alias index (ไม่เปลี่ยน version ของ visibility)"""
+    load_metadata()
+    metadata_store.commit({}, aliases=aliases)
+    schedule_metadata_upload()
+    schedule_catalog_snapshot()
+
+def prune_content_hashes(public_id, keep_version=None):
+    """ลบ hash ที่ชี้ไปที่ asset นี้ออกจาก content index (เก็บไว้เฉพาะที่ตรงกับ keep_version)
+
+    ใช้ตอนลบ/แทนที่/เปลี่ยนชื่อ - ไม่งั้น index จะโตไปเรื่อยๆ ด้วย hash ของ asset ที่ไม่มีอยู่แล้ว
+    """
+    stale = {digest: {public_id: None} for digest, assets in load_metadata()['hashes'].items()
+             if public_id in assets and assets[public_id] != keep_version}
+    if stale:
+        save_content_hashes(stale)
+
+def get_menu_visibility(filename):
+    """ดึงข้อมูล visibility ของเมนู - รองรับ 4 โซน"""
+    return dict(load_metadata()['visibility'].flags(filename))
+
+def get_all_menu_visibility(filenames):
+    """ดึง visibility ของหลายเมนูในครั้งเดียว (โหลด metadata ครั้งเดียว)"""
+    table = load_metadata()['visibility']
+    return {filename: VISIBILITY_FLAGS[mask] for filename, mask in zip(filenames, table.masks_for(filenames))}
+
+def set_menu_visibility(filename, show_normal_watermark=True, show_normal_clean=True, 
+                       show_premium_watermark=False, show_premium_clean=False):
+    """ตั้งค่า visibility ของเมนู - รองรับ 4 โซน"""
+    return save_metadata({
+        filename: visibility_mask({
+            'show_normal_watermark': show_normal_watermark,
+            'show_normal_clean': show_normal_clean,
+            'show_premium_watermark': show_premium_watermark,
+            'show_premium_clean': show_premium_clean
+        })
+    })
+
+def set_menus_visibility_bulk(changes, expected_version=None):
+    """ตั้งค่า visibility หลายเมนูพร้อมกัน - บันทึกเป็นรายการเดียวใน journal"""
+    return save_metadata({filename: visibility_mask(visibility) for filename, visibility in changes.items()},
+                         expected_version)
+
+def parse_visibility_flag(value):
+    """แปลงค่า visibility จาก JSON (รองรับทั้ง bool และ 'true'/'false')"""
+    if isinstance(value, str):
+        return value.lower() == 'true'
+    return bool(value)
+
+# ==========================================
+# Menu View Model (สร้างครั้งเดียวต่อ generation ของ cache)
+# ==========================================
+menu_model_cache = {'generation': None, 'model': None}
+menu_model_lock = threading.Lock()
+
+def build_menu_model(data, metadata):
+    """จับคู่รูป 3 โฟลเดอร์ตามชื่อเมนู + แยก 4 โซนตาม visibility (เรียงตามวันที่ล่าสุดแล้ว)"""
+    table = metadata['visibility']
+    by_name = {}
+    
+    for folder, short in (('watermarked', 'wm'), ('clean', 'cl'), ('premium', 'pm')):
+        for img in data[folder]:
+            filename = img['public_id'].split('/')[-1]
+            record = by_name.get(filename)
+            if record is None:
+                record = {
+                    'name': filename, 'wm': None, 'cl': None, 'pm': None,
+                    'created_at': img['created_at'],
+                    'images': {},
+                    'visibility': table.flags(filename)
+                }
+                by_name[filename] = record
+            record[short] = img['secure_url']
+            record['images'][folder] = img
+    
+    items = sorted(by_name.values(), key=lambda x: x['created_at'], reverse=True)
+    
+    # เรียงรูปแต่ละโฟลเดอร์ครั้งเดียว + ดึง mask เรียงตามกัน แล้วกรองทั้งโซนด้วย translate/compress
+    folder_images = {}
+    folder_masks = {}
+    for folder in {folder for folder, _ in MENU_ZONES.values()}:
+        images = sorted(data[folder], key=lambda x: x['created_at'], reverse=True)
+        folder_images[folder] = images
+        folder_masks[folder] = table.masks_for(img['public_id'].split('/')[-1] for img in images)
+    
+    zones = {}
+    for zone, (folder, visibility_key) in MENU_ZONES.items():
+        selector = folder_masks[folder].translate(VISIBILITY_SELECTORS[VISIBILITY_BITS[visibility_key]])
+        zones[zone] = list(itertools.compress(folder_images[folder], selector))
+    
+    return {
+        'items': items,
+        'by_name': by_name,
+        'zones': zones,
+        'visibility': {name: record['visibility'] for name, record in by_name.items()}
+    }
+
+def encode_page_cursor(img):
+    """cursor = รูปสุดท้ายของหน้า (public_id + created_at) - ยังใช้ได้แม้มีรูปเพิ่ม/ลบระหว่างเลื่อน"""
+    raw = json.dumps({'id': img['public_id'], 'at': img['created_at']}, ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+class InvalidCursor(ValueError):
+    """cursor จาก client อ่านไม่ได้ (ถูกแก้/ตัดมา)"""
+
+def decode_page_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        last_id, last_at = data['id'], data['at']
+    except (ValueError, KeyError, TypeError) as e:
+        raise InvalidCursor(f"cannot decode cursor {cursor[:40]!r}: {e}") from e
+    if not isinstance(last_id, str) or not isinstance(last_at, str):
+        raise InvalidCursor(f"malformed cursor {cursor[:40]!r}")
+    return last_id, last_at
+
+def paginate_zone(model, zone, cursor=None, limit=MENU_PAGE_SIZE, term=''):
+    """ดึงรูปของโซนทีละหน้า (เรียงล่าสุดก่อน) - คืน (รูปในหน้านี้, cursor หน้าถัดไป, จำนวนทั้งหมด)"""
+    images = filter_images_by_search(model['zones'][zone], term)
+    
+    start = 0
+    if cursor:
+        last_id, last_at = decode_page_cursor(cursor)
+        position = next((i for i, img in enumerate(images) if img['public_id'] == last_id), None)
+        if position is not None:
+            start = position + 1
+        else:
+            # รูปสุดท้ายถูกลบไปแล้ว - ต่อจากรูปแรกที่เก่ากว่า
+            start = next((i for i, img in enumerate(images) if img['created_at'] < last_at), len(images))
+    
+    page = images[start:start + limit]
+    next_cursor = encode_page_cursor(page[-1]) if page and start + limit < len(images) else None
+    return page, next_cursor, len(images)
+
+def get_menu_model():
+    """ดึง view model - สร้างใหม่เฉพาะตอนรูปหรือ metadata เปลี่ยน"""
+    data = get_cached_images()
+    metadata = load_metadata()
+    # metadata['version'] นับเฉพาะการแก้ visibility - commit ที่เพิ่มแค่ content hash ไม่ต้องสร้าง model ใหม่
+    generation = (cache_backend.version('images'), metadata['version'], id(data))
+    
+    if menu_model_cache['generation'] == generation:
+        return menu_model_cache['model']
+    
+    with menu_model_lock:
+        if menu_model_cache['generation'] != generation:
+            model = build_menu_model(data, metadata)
+            model['generation'] = generation
+            model['metadata_version'] = metadata['version']
+            model['built_at'] = datetime.now(timezone.utc).replace(microsecond=0)
+            menu_model_cache['model'] = model
+            menu_model_cache['generation'] = generation
+            logger.info(f"Built menu model ({len(menu_model_cache['model']['items'])} menus)")
+        return menu_model_cache['model']
+
+# ==========================================
+# Menu Operations (ใช้ทั้ง API รายตัว และ background jobs)
+# ==========================================
+def upload_folder_for(upload_type):
+    """เลือกโฟลเดอร์ตาม type ของฟอร์มอัปโหลด"""
+    if upload_type == 'watermarked':
+        return "menu/watermarked"
+    elif upload_type == 'premium':
+        return "menu/premium"
+    return "menu/clean"
+
+def menu_upload_name(original_filename, custom_name='', index=0):
+    """ตั้งชื่อไฟล์ที่อัปโหลด (ชื่อนำหน้า_ลำดับ หรือชื่อไฟล์เดิม) + normalize/sanitize"""
+    if custom_name:
+        final_name = f"{custom_name}_{index}" if int(index) > 0 else custom_name
+    else:
+        final_name = os.path.splitext(original_filename)[0]
+    
+    # Normalize Thai characters (แก้ปัญหาสระแยก)
+    final_name = normalize_thai_filename(final_name)
+    
+    # Sanitize filename - รองรับภาษาไทย
+    return "".join(c for c in final_name if c.isalnum() or c in (' ', '-', '_') or '\u0E00' <= c <= '\u0E7F').strip()
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def find_content_asset(digest, public_id):
+    """หารูปใน cache ที่มีเนื้อหาตรงกับ hash นี้ (ลอง public_id เป้าหมายก่อน)
+
+    นับเฉพาะ asset ที่ยังอยู่และ version ตรงกับตอนบันทึก hash - ถ้าถูกแทนที่/ลบ/เปลี่ยนชื่อไปแล้วถือว่าไม่เจอ
+    """
+    assets = load_metadata()['hashes'].get(digest)
+    if not assets:
+        return None
+    data = get_cached_images()
+    for asset_id in sorted(assets, key=lambda asset_id: asset_id != public_id):
+        for img in data.get(folder_key_for(asset_id), []):
+            if img['public_id'] == asset_id and img.get('version') == assets[asset_id]:
+                return img
+    return None
+
+def store_menu_image(public_id, source_hash, encode, **options):
+    """encode รูปแล้วอัปโหลด + อัปเดต cache เฉพาะรูปนี้ โดยข้ามงานที่ซ้ำด้วย content index
+
+    ตรวจ hash ของต้นฉบับ (source_hash) ก่อนเรียก encode() และ hash ของรูปที่ encode แล้วก่อนอัปโหลด
+    คืน (resource, dedup) - dedup: None = อัปโหลดใหม่, 'unchanged' = รูปเดิมตรงกันอยู่แล้ว ไม่ทำอะไร,
+    'copied' = ใช้รูปที่ encode แล้วจาก asset อื่น (Cloudinary ดึงจาก URL เอง ไม่ต้อง encode/ส่งไฟล์)
+    """
+    hashes = [source_hash]
+    existing = find_content_asset(source_hash, public_id)
+    if existing is None:
+        encoded = encode()
+        output_hash = content_hash(encoded)
+        hashes.append(output_hash)
+        existing = find_content_asset(output_hash, public_id)
+    
+    if existing is not None and existing['public_id'] == public_id:
+        result, dedup = existing, 'unchanged'
+    else:
+        # alias ที่ชี้มาที่รูปนี้ต้องเห็นรูปเดิมต่อไป
+        detach_aliases(public_id, keep=True)
+        if existing is not None:
+            result, dedup = cloudinary_client.upload(existing['secure_url'], public_id=public_id, **options), 'copied'
+        else:
+            result, dedup = cloudinary_client.upload(io.BytesIO(encoded), public_id=public_id, **options), None
+        index_upsert(result)
+        drop_alias(public_id)
+    
+    # จำ hash ที่ยังไม่ชี้มาที่ asset นี้ (เช่น ต้นฉบับใหม่ที่ encode แล้วได้รูปเดิม)
+    index = load_metadata()['hashes']
+    new_hashes = {digest: {public_id: result['version']} for digest in hashes
+                  if index.get(digest, {}).get(public_id) != result['version']}
+    if new_hashes:
+        save_content_hashes(new_hashes)
+    if dedup:
+        logger.info(f"Dedup hit ({dedup}): {public_id}")
+    return result, dedup
+
+def plan_menu_uploads(raw_bytes, name, folders, watermarks=(), reservation=None):
+    """เตรียมงานอัปโหลดของรูป 1 ไฟล์ - คืน {folder: (public_id, source_hash, encode)}
+
+    folders = โฟลเดอร์ที่ใช้รูปนี้ตรงๆ, watermarks = โฟลเดอร์ที่สร้างลายน้ำจากรูปนี้ (style ตาม WATERMARK_STYLES)
+    ทุกโฟลเดอร์ใช้ผลถอดรหัสครั้งเดียวกันใน image pool และไม่ส่งเข้า pool เลยถ้าทุกโฟลเดอร์เจอใน content index
+    reservation = ช่องใน image pool ที่จองไว้แล้ว (ดู ImagePoolReservation)
+    """
+    source_hash = content_hash(raw_bytes)
+    styles = {folder: WATERMARK_STYLES[folder] for folder in watermarks}
+    plan = {folder: (f"menu/{folder}/{name}", source_hash) for folder in folders}
+    # รูปลายน้ำนับ style เป็นส่วนหนึ่งของต้นฉบับ - เปลี่ยนโลโก้แล้วไม่ถือว่าซ้ำ
+    plan.update({folder: (f"menu/{folder}/{name}", content_hash(raw_bytes + watermark_signature(style)))
+                 for folder, style in styles.items()})
+    
+    task = (encode_menu_variants, raw_bytes, styles) if styles else (encode_menu_image, raw_bytes)
+    missing = [folder for folder, (public_id, digest) in plan.items() if find_content_asset(digest, public_id) is None]
+    future = submit_image_task(*task, reservation=reservation) if missing else None
+    
+    def encoder(folder):
+        def encode():
+            result = image_task_result(future, *task) if future else run_image_task(*task)
+            if not styles:
+                return result
+            return result[folder if folder in styles else 'clean']
+        return encode
+    
+    return {folder: (public_id, digest, encoder(folder)) for folder, (public_id, digest) in plan.items()}
+
+def upload_menu_image(raw_bytes, upload_type, final_name, watermark=False):
+    """encode รูปใน image pool แล้วอัปโหลด - คืน dedup ของโฟลเดอร์ที่อัปโหลด (ดู store_menu_image)
+
+    watermark=True กับรูปต้นฉบับ (clean) จะสร้างรูปลายน้ำทุกโฟลเดอร์ที่ตั้ง style ไว้จากไฟล์เดียวกันด้วย
+    """
+    folder = upload_folder_for(upload_type).split('/')[-1]
+    watermarks = ()
+    if watermark and folder == 'clean':
+        watermarks = tuple(target for target in usable_watermark_styles() if target != folder)
+    dedup = None
+    for target, (public_id, digest, encode) in plan_menu_uploads(raw_bytes, final_name, (folder,), watermarks).items():
+        _, target_dedup = store_menu_image(public_id, digest, encode)
+        if target == folder:
+            dedup = target_dedup
+        logger.info(f"Uploaded {final_name} to menu/{target}")
+    return dedup
+
+def rewatermark_menu(filename):
+    """สร้างรูปลายน้ำใหม่จากรูปต้นฉบับที่เก็บไว้แล้ว (เช่น หลังเปลี่ยนโลโก้) - คืน {folder: dedup}
+
+    ต้นฉบับระบุด้วย public_id + version ของรูป clean จึงไม่ต้องโหลดรูปถ้า style ไม่ได้เปลี่ยน
+    """
+    record = get_menu_model()['by_name'].get(filename)
+    clean = record['images'].get('clean') if record else None
+    if clean is None:
+        return None
+    
+    fetched = {}
+    def clean_bytes():
+        if 'raw' not in fetched:
+            fetched['raw'] = fetch_image_bytes(clean['secure_url'])
+        return fetched['raw']
+    
+    results = {}
+    source = f"{clean['public_id']}@{clean['version']}".encode()
+    for folder, style in usable_watermark_styles().items():
+        _, results[folder] = store_menu_image(
+            f"menu/{folder}/{filename}",
+            content_hash(source + watermark_signature(style)),
+            lambda style=style: run_image_task(watermark_menu_image, clean_bytes(), style),
+            overwrite=True, invalidate=True
+        )
+    return results
+
+def direct_upload_params(public_id, source_hash=None):
+    """พารามิเตอร์อัปโหลดตรงจาก browser ไป Cloudinary พร้อมลายเซ็น (อายุตาม timestamp - Cloudinary รับภายใน 1 ชม.)
+
+    การย่อ/แปลงเป็น JPEG แบบเดียวกับ encode_menu_image ทำที่ Cloudinary ตอนรับไฟล์ (incoming transformation)
+    source_hash (sha256 ของไฟล์ต้นฉบับ) เก็บเป็น context ของ asset - อยู่ในลายเซ็น แก้ทีหลังไม่ได้
+    """
+    config = cloudinary.config()
+    params = {
+        'public_id': public_id,
+        'timestamp': str(int(time.time())),
+        'overwrite': 'true',
+        'invalidate': 'true',
+        'transformation': f"c_limit,w_{IMAGE_MAX_SIDE},h_{IMAGE_MAX_SIDE},q_85",
+        'format': 'jpg'
+    }
+    if source_hash:
+        params['context'] = f"source_sha256={source_hash}"
+    params['signature'] = cloudinary.utils.api_sign_request(params, config.api_secret,
+                                                            config.signature_algorithm or cloudinary.utils.SIGNATURE_SHA1)
+    params['api_key'] = config.api_key
+    return {'upload_url': cloudinary.utils.cloudinary_api_url('upload'), 'fields': params}
+
+def complete_direct_upload(response):
+    """รับผลอัปโหลดตรงจาก browser - ตรวจลายเซ็นของ Cloudinary ก่อนใส่เข้า image index
+
+    ลายเซ็นครอบคลุมแค่ public_id + version จึงอ่านขนาด/format/hash จาก Admin API เองแทนค่าที่ browser ส่งมา
+    คืน resource ที่ใส่ index แล้ว หรือ None ถ้าลายเซ็นไม่ถูกต้อง/ไม่ใช่รูปเมนู
+    """
+    public_id = str(response.get('public_id') or '')
+    version = response.get('version')
+    signature = str(response.get('signature') or '')
+    if not folder_key_for(public_id) or not version or not signature:
+        return None
+    if not cloudinary.utils.verify_api_response_signature(public_id, version, signature):
+        return None
+    
+    stored = cloudinary_client.resource(public_id)
+    if stored.get('resource_type', 'image') != 'image':
+        return None
+    return index_direct_upload(stored, version)
+
+def index_direct_upload(stored, version):
+    """ใส่รูปที่อัปโหลดตรง (resource จาก Admin API) เข้า image index + content index - คืน resource"""
+    public_id = stored['public_id']
+    resource = {key: stored.get(key) for key in ('public_id', 'version', 'format', 'secure_url', 'created_at',
+                                                  'width', 'height', 'bytes')}
+    index_upsert(resource)
+    drop_alias(public_id)
+    
+    # hash ต้นฉบับจาก context ที่ลงลายเซ็นไว้ (direct_upload_params) - นับเฉพาะ version ที่อัปโหลดรอบนี้
+    source_hash = (stored.get('context') or {}).get('custom', {}).get('source_sha256')
+    if source_hash and int(stored['version']) == int(version):
+        save_content_hashes({source_hash: {public_id: stored['version']}})
+    logger.info(f"Direct upload completed: {public_id} ({stored.get('bytes')} bytes, etag {stored.get('etag')})")
+    return resource
+
+def dedup_direct_upload(public_id, source_hash):
+    """ไฟล์ที่ browser จะอัปโหลดตรงมีอยู่แล้วใน content index - คืน dedup ('unchanged' / 'copied') หรือ None ถ้าต้องอัปโหลดจริง"""
+    existing = find_content_asset(source_hash, public_id)
+    if existing is None:
+        return None
+    # asset ถูกลบระหว่างทาง - ใช้ไฟล์ที่ encode แล้วของ asset นั้นแทน (ไม่ต้องให้ browser ส่งใหม่)
+    _, dedup = store_menu_image(public_id, source_hash, lambda: fetch_image_bytes(existing['secure_url']),
+                                overwrite=True, invalidate=True)
+    return dedup
+
+def drop_alias(public_id):
+    """ลบ record ของ alias (เช่น มี asset จริงชื่อนี้แล้ว) - คืน True ถ้า public_id เป็น alias"""
+    if public_id not in load_metadata()['aliases']:
+        return False
+    save_aliases({public_id: None})
+    return True
+
+def repoint_aliases(source_id, resource, changes=None):
+    """ให้ alias ที่ชี้ไปที่ source_id ชี้ไปที่ resource แทน (asset ถูกเปลี่ยนชื่อ) - changes = record อื่นที่บันทึกไปพร้อมกัน"""
+    changes = dict(changes or {})
+    for alias_id, alias in load_metadata()['aliases'].items():
+        if alias['source'] == source_id and alias_id not in changes:
+            changes[alias_id] = dict(alias, source=resource['public_id'])
+    if not changes:
+        return
+    save_aliases(changes)
+    for alias_id, alias in changes.items():
+        if alias is not None:
+            index_upsert(alias_resource(alias_id, alias, resource))
+
+def detach_aliases(public_id, keep=False):
+    """ก่อนลบ/เขียนทับ asset ที่มี alias ชี้อยู่ ย้าย asset ไปเป็นของ alias ตัวแรกด้วย rename (ไม่อัปโหลดซ้ำ)
+
+    alias ที่เหลือชี้ตามไป, keep=True ให้ public_id เองเป็น alias ของตัวนั้นไปก่อนจนกว่าจะมีรูปใหม่มาทับ
+    คืน resource ที่ย้ายไป หรือ None ถ้าไม่มี alias ชี้มาที่ asset นี้
+    """
+    dependents = sorted(alias_id for alias_id, alias in load_metadata()['aliases'].items() if alias['source'] == public_id)
+    if not dependents:
+        return None
+    current = cached_image(public_id)
+    result = cloudinary_client.rename(public_id, dependents[0], overwrite=True)
+    index_rename(public_id, result)
+    changes = {dependents[0]: None}
+    if keep:
+        changes[public_id] = {'source': result['public_id'],
+                              'created_at': current['created_at'] if current else result['created_at']}
+    repoint_aliases(public_id, result, changes)
+    logger.info(f"Detached aliases of {public_id} to {result['public_id']}")
+    return result
+
+def remove_menu_asset(public_id):
+    """ลบรูป 1 asset - alias ลบแค่ record, asset ที่มี alias ชี้อยู่ย้ายไปเป็นของ alias แทนการลบ"""
+    if drop_alias(public_id):
+        index_remove(public_id)
+    elif detach_aliases(public_id) is None:
+        cloudinary_client.destroy(public_id, invalidate=True)
+        index_remove(public_id)
+
+def rename_menu_asset(old_id, new_id):
+    """เปลี่ยนชื่อรูป 1 asset (ทับของเดิมชื่อ new_id) - alias ย้ายแค่ record, alias ที่ชี้มาที่ asset นี้ชี้ตามไป"""
+    aliases = load_metadata()['aliases']
+    alias = aliases.get(old_id)
+    if alias is None:
+        result = cloudinary_client.rename(old_id, new_id, overwrite=True)
+        index_rename(old_id, result)
+        repoint_aliases(old_id, result, {new_id: None} if new_id in aliases else None)
+        return
+    
+    current = cached_image(old_id)
+    if new_id != alias['source']:
+        target = cached_image(new_id)
+        # ทับ asset จริง - ลบก่อน ไม่งั้นจะบัง alias
+        if target is not None and 'alias_of' not in target:
+            remove_menu_asset(new_id)
+        save_aliases({old_id: None, new_id: alias})
+        if current is not None:
+            index_rename(old_id, {**current, 'public_id': new_id})
+    else:
+        # เปลี่ยนชื่อกลับเป็น asset ที่ตัวเองชี้อยู่ - เหลือแค่ asset นั้น
+        save_aliases({old_id: None})
+        index_remove(old_id)
+
+def rename_menu(old_name, new_name, folders=tuple(IMAGE_FOLDERS)):
+    """เปลี่ยนชื่อทุกโซนพร้อมกัน - คืน {folder: error} ของโซนที่ Cloudinary ตอบ error"""
+    def rename_folder(folder):
+        rename_menu_asset(f"menu/{folder}/{old_name}", f"menu/{folder}/{new_name}")
+    
+    errors = {}
+    for folder, (_, error) in run_per_folder(rename_folder, folders).items():
+        if error is None:
+            continue
+        if not isinstance(error, cloudinary.exceptions.Error):
+            raise error
+        logger.warning(f"Failed to rename {folder}/{old_name}: {error}")
+        errors[folder] = error
+    return errors
+
+def delete_menu(filename, folders=tuple(IMAGE_FOLDERS)):
+    """ลบทุกโซนพร้อมกัน - คืน {folder: error} ของโซนที่ Cloudinary ตอบ error"""
+    def delete_folder(folder):
+        remove_menu_asset(f"menu/{folder}/{filename}")
+    
+    errors = {}
+    for folder, (_, error) in run_per_folder(delete_folder, folders).items():
+        if error is None:
+            continue
+        if not isinstance(error, cloudinary.exceptions.Error):
+            raise error
+        logger.warning(f"Failed to delete {folder}/{filename}: {error}")
+        errors[folder] = error
+    return errors
+
+# ==========================================
+# Background Jobs (คิวงาน bulk ใน SQLite - ทำต่อได้แม้ปิดแท็บหรือ worker restart)
+# ==========================================
+class JobRetry(Exception):
+    """งานล้มเหลวชั่วคราว - ลองใหม่ภายหลังด้วย payload ใหม่ (เฉพาะส่วนที่ยังไม่สำเร็จ)"""
+
+    def __init__(self, error, payload):
+        super().__init__(str(error))
+        self.payload = payload
+
+def is_transient_error(error):
+    """error ที่ลองใหม่แล้วมีโอกาสผ่าน (rate limit / 5xx / network / image pool เต็ม)"""
+    return is_transient_cloudinary_error(error) or isinstance(error, (
+        ImagePoolBusy, requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError))
+
+class JobQueue:
+    """คิวงานใน SQLite - 1 job มีหลาย item, worker จอง item ทีละชิ้นแบบมี lease
+
+    item ที่ worker ตายกลางทาง (lease หมดอายุ) จะถูกหยิบไปทำใหม่โดย worker อื่นหรือหลัง restart
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            finished_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS job_items (
+            job_id TEXT NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+            idx INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_after REAL NOT NULL DEFAULT 0,
+            lease_until REAL,
+            result TEXT,
+            error TEXT,
+            PRIMARY KEY (job_id, idx)
+        );
+        CREATE INDEX IF NOT EXISTS job_items_ready ON job_items (status, run_after);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._db() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(self.SCHEMA)
+
+    @contextmanager
+    def _db(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA foreign_keys=ON')
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def create(self, kind, payloads, job_id=None, run_after=0):
+        """สร้าง job - run_after = เวลา (epoch) ที่ worker เริ่มหยิบ item ได้"""
+        job_id = job_id or uuid.uuid4().hex
+        now = time.time()
+        with self._db() as db:
+            db.execute('BEGIN IMMEDIATE')
+            # เก็บกวาด job เก่าที่จบไปนานแล้ว
+            db.execute('DELETE FROM jobs WHERE finished_at < ?', (now - JOB_RETENTION.total_seconds(),))
+            db.execute('INSERT INTO jobs (id, kind, total, created_at) VALUES (?, ?, ?, ?)',
+                       (job_id, kind, len(payloads), now))
+            db.executemany('INSERT INTO job_items (job_id, idx, payload, run_after) VALUES (?, ?, ?, ?)',
+                           [(job_id, idx, json.dumps(payload, ensure_ascii=False), run_after)
+                            for idx, payload in enumerate(payloads)])
+            db.execute('COMMIT')
+        return job_id
+
+    def claim(self):
+        """จอง item ถัดไปที่พร้อมทำ (หรือ lease หมดอายุ) - คืน None ถ้าไม่มีงาน"""
+        now = time.time()
+        with self._db() as db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute("""
+                SELECT i.job_id, i.idx, i.payload, i.attempts, j.kind
+                FROM job_items i JOIN jobs j ON j.id = i.job_id
+                WHERE (i.status = 'pending' AND i.run_after <= ?) OR (i.status = 'running' AND i.lease_until < ?)
+                ORDER BY j.created_at, i.idx LIMIT 1
+            """, (now, now)).fetchone()
+            if row is None:
+                db.execute('COMMIT')
+                return None
+            db.execute("UPDATE job_items SET status = 'running', attempts = attempts + 1, lease_until = ? WHERE job_id = ? AND idx = ?",
+                       (now + JOB_LEASE, row['job_id'], row['idx']))
+            db.execute('COMMIT')
+        return {'job_id': row['job_id'], 'idx': row['idx'], 'kind': row['kind'],
+                'payload': json.loads(row['payload']), 'attempts': row['attempts'] + 1}
+
+    def _finish_item(self, job_id, idx, **fields):
+        """อัปเดต item - คืน True ถ้า job นี้ทำครบทุก item แล้ว"""
+        assignments = ', '.join(f"{key} = ?" for key in fields)
+        with self._db() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute(f"UPDATE job_items SET {assignments}, lease_until = NULL WHERE job_id = ? AND idx = ?",
+                       (*fields.values(), job_id, idx))
+            remaining = db.execute("SELECT COUNT(*) FROM job_items WHERE job_id = ? AND status IN ('pending', 'running')",
+                                   (job_id,)).fetchone()[0]
+            if remaining == 0:
+                db.execute('UPDATE jobs SET finished_at = ? WHERE id = ? AND finished_at IS NULL', (time.time(), job_id))
+            db.execute('COMMIT')
+        return remaining == 0
+
+    def item(self, job_id, idx):
+        """item 1 ชิ้น {'kind', 'status', 'payload'} (None ถ้าไม่พบ)"""
+        with self._db() as db:
+            row = db.execute("""
+                SELECT j.kind, i.status, i.payload FROM job_items i JOIN jobs j ON j.id = i.job_id
+                WHERE i.job_id = ? AND i.idx = ?
+            """, (job_id, idx)).fetchone()
+        if row is None:
+            return None
+        return {'kind': row['kind'], 'status': row['status'], 'payload': json.loads(row['payload'])}
+
+    def complete(self, job_id, idx, result):
+        return self._finish_item(job_id, idx, status='done', result=json.dumps(result, ensure_ascii=False), error=None)
 
-def clear_cache():
-    """ล้าง cache"""
-    global image_cache
-    image_cache['data'] = None
-    image_cache['timestamp'] = None
-    logger.info("Cache cleared")
+    def fail(self, job_id, idx, error):
+        return self._finish_item(job_id, idx, status='failed', error=str(error))
 
-def load_metadata():
-    """โหลด metadata จาก cache/Cloudinary (แก้ปัญหา Rate Limit)"""
-    global metadata_cache
-    now = datetime.now()
-    
-    # ตรวจสอบ cache ก่อน (ลด API calls)
-    if metadata_cache['data'] and metadata_cache['timestamp']:
-        if now - metadata_cache['timestamp'] < METADATA_CACHE_DURATION:
-            logger.info("Using cached metadata")
-            return metadata_cache['data']
-    
-    try:
-        # ลองโหลดจาก Cloudinary raw file
-        try:
-            import requests
-            result = cloudinary.api.resource('menu_metadata_store', resource_type='raw')
-            metadata_url = result.get('secure_url')
-            if metadata_url:
-                response = requests.get(metadata_url, timeout=5)
-                if response.status_code == 200:
-                    data = response.json()
-                    logger.info("Loaded metadata from Cloudinary")
-                    # อัปเดต cache
-                    metadata_cache['data'] = data
-                    metadata_cache['timestamp'] = now
-                    # Sync ไป local file ด้วย
-                    with open(METADATA_FILE, 'w', encoding='utf-8') as f:
-                        json.dump(data, f, ensure_ascii=False, indent=2)
-                    return data
-        except cloudinary.exceptions.NotFound:
-            logger.info("Metadata not found in Cloudinary, will create new")
-        except Exception as e:
-            logger.warning(f"Could not load from Cloudinary: {e}")
+    def retry(self, job_id, idx, error, payload, delay):
+        return self._finish_item(job_id, idx, status='pending', error=str(error), run_after=time.time() + delay,
+                                 payload=json.dumps(payload, ensure_ascii=False))
+
+    def progress(self, job_id):
+        """สถานะของ job + ทุก item (None ถ้าไม่พบ)"""
+        with self._db() as db:
+            job = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if job is None:
+                return None
+            items = db.execute('SELECT idx, status, attempts, result, error FROM job_items WHERE job_id = ? ORDER BY idx',
+                               (job_id,)).fetchall()
         
-        # ถ้าไม่มีใน Cloudinary ให้ลองโหลดจากไฟล์ local
-        if os.path.exists(METADATA_FILE):
-            with open(METADATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                logger.info("Loaded metadata from local file")
-                # อัปเดต cache
-                metadata_cache['data'] = data
-                metadata_cache['timestamp'] = now
-                return data
-        
-        # ถ้าไม่มีเลย สร้างใหม่
-        data = {'menus': {}}
-        metadata_cache['data'] = data
-        metadata_cache['timestamp'] = now
-        return data
-    except Exception as e:
-        logger.error(f"Error loading metadata: {e}")
-        return {'menus': {}}
+        counts = {'pending': 0, 'running': 0, 'done': 0, 'failed': 0}
+        for item in items:
+            counts[item['status']] += 1
+        return {
+            'id': job['id'],
+            'kind': job['kind'],
+            'total': job['total'],
+            **counts,
+            'finished': job['finished_at'] is not None,
+            'items': [{
+                'idx': item['idx'],
+                'status': item['status'],
+                'attempts': item['attempts'],
+                'result': json.loads(item['result']) if item['result'] else None,
+                'error': item['error']
+            } for item in items]
+        }
 
-def save_metadata(metadata):
-    """บันทึก metadata ลง Cloudinary raw file (แก้ปัญหา ephemeral filesystem)"""
-    global metadata_cache
+def job_upload(payload):
+    with open(payload['spool'], 'rb') as f:
+        raw_bytes = f.read()
+    dedup = upload_menu_image(raw_bytes, payload['type'], payload['name'], payload.get('watermark', False))
+    return {'file': payload['name'], 'dedup': dedup}
+
+def job_direct_upload(payload):
+    """browser ไม่ได้แจ้งผลอัปโหลดตรง (ปิดแท็บ/หลุด) จนลายเซ็นหมดอายุ - ตรวจกับ Cloudinary เองว่าไฟล์มาถึงไหม"""
+    stored = cloudinary_client.resource(payload['public_id'])
+    # version ของ Cloudinary = เวลาที่อัปโหลด - ของที่เก่ากว่าลายเซ็นคือรูปเดิม (browser ไม่ได้อัปโหลด)
+    if stored.get('resource_type', 'image') != 'image' or int(stored['version']) < int(payload['timestamp']):
+        raise ValueError(f"ไม่พบรูปที่อัปโหลด: {payload['file']}")
+    index_direct_upload(stored, stored['version'])
+    return {'file': payload['file'], 'dedup': None}
+
+def job_watermark(payload):
+    results = rewatermark_menu(payload['filename'])
+    if results is None:
+        return {'file': payload['filename'], 'skipped': 'ไม่มีรูปต้นฉบับ'}
+    # dedup รวม: มีโฟลเดอร์ที่อัปโหลดจริง = None, คัดลอกจาก asset อื่นอย่างน้อย 1 โฟลเดอร์ = 'copied'
+    dedups = set(results.values())
+    dedup = None if None in dedups else 'copied' if 'copied' in dedups else 'unchanged'
+    return {'file': payload['filename'], 'dedup': dedup, 'folders': results}
+
+def job_per_folder(operation):
+    """ห่อ rename_menu/delete_menu ให้ลองใหม่เฉพาะโซนที่ล้มเหลวชั่วคราว"""
+    def handler(payload):
+        args = {key: value for key, value in payload.items() if key not in ('folders', 'errors')}
+        errors = operation(folders=tuple(payload.get('folders', IMAGE_FOLDERS)), **args)
+        # error ถาวร (เช่น ไม่มีรูปในโซนนั้น) เก็บไว้ตอบกลับ ส่วน error ชั่วคราวลองใหม่เฉพาะโซนนั้น
+        permanent = dict(payload.get('errors', {}))
+        permanent.update({folder: str(error) for folder, error in errors.items() if not is_transient_error(error)})
+        transient = [folder for folder, error in errors.items() if is_transient_error(error)]
+        if transient:
+            raise JobRetry(errors[transient[0]], dict(payload, folders=transient, errors=permanent))
+        return {'errors': permanent}
+    return handler
+
+def job_visibility(payload):
+    return {'version': set_menus_visibility_bulk(payload['changes'])}
+
+JOB_HANDLERS = {
+    'upload': job_upload,
+    'rename': job_per_folder(rename_menu),
+    'delete': job_per_folder(delete_menu),
+    'visibility': job_visibility,
+    'watermark': job_watermark,
+    'direct_upload': job_direct_upload
+}
+
+job_queue = JobQueue(JOBS_DB)
+job_wakeup = threading.Event()
+job_workers = {'pid': None}
+job_workers_lock = threading.Lock()
+
+def run_job_item(item):
+    """ทำ item 1 ชิ้น แล้วบันทึกผล (สำเร็จ / ลองใหม่แบบ backoff / ล้มเหลว)"""
+    job_id, idx, attempts = item['job_id'], item['idx'], item['attempts']
     try:
-        # บันทึกลงไฟล์ local ก่อน (สำหรับ dev)
-        with open(METADATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
-        
-        # อัปเดต cache ทันที (ไม่ต้องรอโหลดใหม่)
-        metadata_cache['data'] = metadata
-        metadata_cache['timestamp'] = datetime.now()
+        result = JOB_HANDLERS[item['kind']](item['payload'])
+        finished = job_queue.complete(job_id, idx, result)
+    except Exception as e:
+        error = e
+        payload = item['payload']
+        if isinstance(e, JobRetry):
+            payload = e.payload
+        elif not is_transient_error(e):
+            attempts = JOB_MAX_ATTEMPTS
         
-        # บันทึกลง Cloudinary เป็น raw JSON file (persistent)
+        if attempts < JOB_MAX_ATTEMPTS:
+            delay = min(JOB_RETRY_BASE * 2 ** (attempts - 1), JOB_RETRY_MAX) * random.uniform(0.5, 1.5)
+            logger.warning(f"Job {job_id}#{idx} failed (attempt {attempts}), retrying in {delay:.1f}s: {error}")
+            finished = job_queue.retry(job_id, idx, error, payload, delay)
+        else:
+            logger.error(f"Job {job_id}#{idx} failed: {error}")
+            finished = job_queue.fail(job_id, idx, error)
+    
+    if finished:
+        # ไฟล์ที่ spool ไว้ของ job นี้ไม่ต้องใช้แล้ว
+        shutil.rmtree(os.path.join(JOBS_SPOOL_DIR, job_id), ignore_errors=True)
+        logger.info(f"Job {job_id} finished")
+
+def job_worker_loop():
+    while True:
         try:
-            # สร้าง JSON string
-            metadata_json = json.dumps(metadata, ensure_ascii=False, indent=2)
-            
-            # อัปโหลดเป็น raw file
-            cloudinary.uploader.upload(
-                f"data:application/json;base64,{__import__('base64').b64encode(metadata_json.encode()).decode()}",
-                public_id="menu_metadata_store",
-                resource_type="raw",
-                overwrite=True
-            )
-            logger.info("Metadata saved to Cloudinary")
+            item = job_queue.claim()
         except Exception as e:
-            logger.warning(f"Could not save to Cloudinary, using local only: {e}")
-            
-    except Exception as e:
-        logger.error(f"Error saving metadata: {e}")
+            logger.error(f"Could not claim job item: {e}")
+            item = None
+        if item is None:
+            job_wakeup.wait(JOB_POLL_INTERVAL)
+            job_wakeup.clear()
+            continue
+        run_job_item(item)
 
-def get_menu_visibility(filename):
-    """ดึงข้อมูล visibility ของเมนู - รองรับ 4 โซน"""
-    metadata = load_metadata()
-    menu_data = metadata['menus'].get(filename, {})
-    return {
-        'show_normal_watermark': menu_data.get('show_normal_watermark', True),  # default: แสดง
-        'show_normal_clean': menu_data.get('show_normal_clean', True),  # default: แสดง
-        'show_premium_watermark': menu_data.get('show_premium_watermark', False),
-        'show_premium_clean': menu_data.get('show_premium_clean', False)
-    }
+def ensure_job_workers():
+    """เริ่ม job worker threads ใน process นี้ (ครั้งแรกที่มี request - หลัง gunicorn fork แล้ว)"""
+    if job_workers['pid'] == os.getpid():
+        return
+    with job_workers_lock:
+        if job_workers['pid'] == os.getpid():
+            return
+        for _ in range(JOB_WORKERS):
+            threading.Thread(target=job_worker_loop, daemon=True).start()
+        job_workers['pid'] = os.getpid()
+        logger.info(f"Started {JOB_WORKERS} job workers")
 
-def set_menu_visibility(filename, show_normal_watermark=True, show_normal_clean=True, 
-                       show_premium_watermark=False, show_premium_clean=False):
-    """ตั้งค่า visibility ของเมนู - รองรับ 4 โซน"""
-    metadata = load_metadata()
-    if 'menus' not in metadata:
-        metadata['menus'] = {}
-    
-    metadata['menus'][filename] = {
-        'show_normal_watermark': show_normal_watermark,
-        'show_normal_clean': show_normal_clean,
-        'show_premium_watermark': show_premium_watermark,
-        'show_premium_clean': show_premium_clean
-    }
-    save_metadata(metadata)
-    clear_cache()
+@app.before_request
+def start_job_workers():
+    ensure_job_workers()
 
 # ==========================================
 # โซนหน้าบ้าน (โชว์เมนู)
 # ==========================================
+rendered_page_cache = {'generation': None, 'page': None}
+
+def empty_menu_pages():
+    return {zone: {'items': [], 'next_cursor': None, 'total': 0, 'loaded': False} for zone in MENU_ZONES}
+
+def render_menu_page(model):
+    """render index.html + บีบอัดไว้ล่วงหน้า (ทำครั้งเดียวต่อ generation)"""
+    # render เฉพาะหน้าแรกของโซนเริ่มต้น - ที่เหลือ browser ดึงผ่าน /api/menu/<zone>
+    pages = empty_menu_pages()
+    items, next_cursor, total = paginate_zone(model, DEFAULT_MENU_ZONE)
+    pages[DEFAULT_MENU_ZONE] = {'items': items, 'next_cursor': next_cursor, 'total': total, 'loaded': True}
+    
+    html = render_template('index.html', pages=pages).encode('utf-8')
+    etag = hashlib.sha1(html).hexdigest()
+    
+    bodies = {'identity': html, 'gzip': gzip.compress(html, compresslevel=6)}
+    if brotli is not None:
+        bodies['br'] = brotli.compress(html, quality=5)
+    return {'bodies': bodies, 'etag': etag, 'last_modified': model['built_at']}
+
+def get_rendered_menu_page():
+    model = get_menu_model()
+    if rendered_page_cache['generation'] != model['generation']:
+        rendered_page_cache['page'] = render_menu_page(model)
+        rendered_page_cache['generation'] = model['generation']
+        logger.info("Rendered menu page")
+    return rendered_page_cache['page']
+
+def pick_content_encoding(page):
+    accepted = request.accept_encodings
+    for encoding in ('br', 'gzip'):
+        if encoding in page['bodies'] and accepted[encoding]:
+            return encoding
+    return 'identity'
+
 @app.route('/')
 def index():
     try:
-        data = get_cached_images()
-        metadata = load_metadata()
-        
-        # กรองรูปตาม visibility settings (4 โซน)
-        img_normal_wm = []      # ธรรมดา - มีชื่อเมนู
-        img_normal_cl = []      # ธรรมดา - ไม่มีชื่อเมนู
-        img_premium_wm = []     # พรีเมี่ยม - มีชื่อเมนู
-        img_premium_cl = []     # พรีเมี่ยม - ไม่มีชื่อเมนู
-        
-        # กรองรูปมีลายน้ำ
-        for img in data['watermarked']:
-            filename = img['public_id'].split('/')[-1]
-            visibility = metadata['menus'].get(filename, {})
-            
-            # default: แสดงในโซนธรรมดา ถ้าไม่มี metadata
-            if visibility.get('show_normal_watermark', True):
-                img_normal_wm.append(img)
-            if visibility.get('show_premium_watermark', False):
-                img_premium_wm.append(img)
-        
-        # กรองรูปไม่มีลายน้ำ
-        for img in data['clean']:
-            filename = img['public_id'].split('/')[-1]
-            visibility = metadata['menus'].get(filename, {})
-            
-            # default: แสดงในโซนธรรมดา ถ้าไม่มี metadata
-            if visibility.get('show_normal_clean', True):
-                img_normal_cl.append(img)
-            if visibility.get('show_premium_clean', False):
-                img_premium_cl.append(img)
-        
-        # เรียงตามวันที่ล่าสุด
-        img_normal_wm = sorted(img_normal_wm, key=lambda x: x['created_at'], reverse=True)
-        img_normal_cl = sorted(img_normal_cl, key=lambda x: x['created_at'], reverse=True)
-        img_premium_wm = sorted(img_premium_wm, key=lambda x: x['created_at'], reverse=True)
-        img_premium_cl = sorted(img_premium_cl, key=lambda x: x['created_at'], reverse=True)
-        
+        page = get_rendered_menu_page()
     except cloudinary.exceptions.Error as e:
         logger.error(f"Cloudinary error in index: {e}")
-        img_normal_wm = []
-        img_normal_cl = []
-        img_premium_wm = []
-        img_premium_cl = []
         flash('เกิดข้อผิดพลาดในการโหลดรูปภาพ', 'error')
+        page = None
     except Exception as e:
         logger.error(f"Unexpected error in index: {e}")
-        img_normal_wm = []
-        img_normal_cl = []
-        img_premium_wm = []
-        img_premium_cl = []
         flash('เกิดข้อผิดพลาดที่ไม่คาดคิด', 'error')
+        page = None
+    
+    # โหลดไม่ได้ - แสดงหน้าว่าง และห้าม cache
+    if page is None:
+        response = make_response(render_template('index.html', pages=empty_menu_pages()))
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    
+    # ETag แยกตาม encoding (เนื้อหาที่ส่งจริงต่างกัน)
+    encoding = pick_content_encoding(page)
+    etag = page['etag'] if encoding == 'identity' else f"{page['etag']}-{encoding}"
+    
+    response = make_response(page['bodies'][encoding])
+    response.content_type = 'text/html; charset=utf-8'
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = PAGE_CACHE_CONTROL
+    response.set_etag(etag)
+    response.last_modified = page['last_modified']
+    
+    # ถ้า ETag/Last-Modified ตรง จะกลายเป็น 304 ไม่มี body
+    return response.make_conditional(request)
+
+# --- API รูปเมนูทีละหน้า (infinite scroll + ค้นหาฝั่งเซิร์ฟเวอร์) ---
+@app.route('/api/menu/<string:zone>')
+def menu_page_api(zone):
+    if zone not in MENU_ZONES:
+        return {'status': 'error', 'message': 'ไม่พบโซนนี้'}, 404
+    
+    try:
+        limit = min(max(int(request.args.get('limit', MENU_PAGE_SIZE)), 1), MENU_PAGE_SIZE_MAX)
+    except ValueError:
+        return {'status': 'error', 'message': 'limit ไม่ถูกต้อง'}, 400
+    
+    try:
+        model = get_menu_model()
+        items, next_cursor, total = paginate_zone(model, zone,
+                                                  cursor=request.args.get('cursor'),
+                                                  limit=limit,
+                                                  term=normalize_search_term(request.args.get('q')))
+    except InvalidCursor as e:
+        logger.warning(f"Bad menu cursor: {e}")
+        return {'status': 'error', 'message': 'cursor ไม่ถูกต้อง'}, 400
+    except Exception as e:
+        logger.error(f"Error in menu page API: {e}")
+        return {'status': 'error', 'message': str(e)}, 500
+    
+    menu_card = get_template_attribute('_menu_card.html', 'menu_card')
+    return {
+        'status': 'success',
+        'zone': zone,
+        'items': [{'name': img['public_id'].split('/')[-1], 'public_id': img['public_id'], 'secure_url': img['secure_url']} for img in items],
+        'html': ''.join(str(menu_card(img, zone)) for img in items),
+        'next_cursor': next_cursor,
+        'total': total
+    }
+
+# --- API ค้นหาชื่อเมนู (ใช้ search index) ---
+@app.route('/api/search')
+def search_api():
+    term = request.args.get('q', '')
+    zone = request.args.get('zone')
+    
+    # ไม่ระบุโซน = ค้นทุกเมนู (รวมที่ซ่อนอยู่) - เฉพาะแอดมิน
+    if zone is None and not session.get('logged_in'):
+        return {'status': 'error', 'message': 'Unauthorized'}, 401
+    if zone is not None and zone not in MENU_ZONES:
+        return {'status': 'error', 'message': 'ไม่พบโซนนี้'}, 404
+    
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), MENU_PAGE_SIZE_MAX)
+    except ValueError:
+        return {'status': 'error', 'message': 'limit ไม่ถูกต้อง'}, 400
+    
+    try:
+        started = time.perf_counter()
+        names = get_search_index().search(term)
+        
+        if zone is not None:
+            folder, visibility_key = MENU_ZONES[zone]
+            by_name = get_menu_model()['by_name']
+            names = [name for name in names
+                     if name in by_name and folder in by_name[name]['images'] and by_name[name]['visibility'][visibility_key]]
         
-    return render_template('index.html', 
-                         normal_wm_images=img_normal_wm,
-                         normal_cl_images=img_normal_cl,
-                         premium_wm_images=img_premium_wm,
-                         premium_cl_images=img_premium_cl)
+        names = names[:limit]
+        took_ms = round((time.perf_counter() - started) * 1000, 3)
+        return {'status': 'success', 'query': term, 'results': names, 'took_ms': took_ms}
+    except Exception as e:
+        logger.error(f"Error in search API: {e}")
+        return {'status': 'error', 'message': str(e)}, 500
+
+# --- ดาวน์โหลดทั้งโซนเป็น ZIP (stream ทีละรูป ไม่ต้องรอครบ) ---
+
+class ZipStreamBuffer:
+    """ปลายทางของ ZipFile ที่ seek ไม่ได้ - เก็บ bytes ไว้ให้ generator ดึงออกไปส่งทีละช่วง"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def fetch_image_bytes(url):
+    response = http_session.get(url, timeout=30)
+    response.raise_for_status()
+    return response.content
+
+def iter_fetched_images(images):
+    """ดึงรูปพร้อมกันไม่เกิน ZIP_FETCH_CONCURRENCY รูป แล้วคืนตามลำดับที่โหลดเสร็จ"""
+    pending = iter(images)
+    with ThreadPoolExecutor(max_workers=ZIP_FETCH_CONCURRENCY) as executor:
+        in_flight = {}
+        for img in itertools.islice(pending, ZIP_FETCH_CONCURRENCY):
+            in_flight[executor.submit(fetch_image_bytes, img['secure_url'])] = img
+        
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                img = in_flight.pop(future)
+                # เติมคิวทันทีที่มีช่องว่าง
+                for next_img in itertools.islice(pending, 1):
+                    in_flight[executor.submit(fetch_image_bytes, next_img['secure_url'])] = next_img
+                try:
+                    yield img, future.result()
+                except Exception as e:
+                    logger.warning(f"Skip {img['public_id']} in ZIP: {e}")
+
+def client_ip():
+    """IP ของผู้ใช้ - หลัง proxy ของ Render ค่าท้ายสุดใน X-Forwarded-For คือค่าที่ proxy ใส่เอง (ปลอมไม่ได้)"""
+    return request.access_route[-1] if request.access_route else request.remote_addr
+
+def take_zip_token(ip):
+    """หัก token ZIP ของ IP นี้ - คืน 0 ถ้าได้ หรือจำนวนวินาทีที่ต้องรอ
+
+    เก็บทุก IP ใน key เดียวของ cache backend (แชร์ข้าม worker) และลบ IP ที่ token เต็มแล้วออกทุกครั้ง
+    """
+    rate = ZIP_RATE_PER_HOUR / 3600
+    ip_key = hashlib.sha1(ip.encode()).hexdigest()[:16]
+    result = []
+    
+    def apply(entry):
+        now = time.time()
+        buckets = {}
+        for key, (tokens, updated) in (entry['data'] if entry and entry['data'] else {}).items():
+            tokens = min(ZIP_BURST, tokens + max(0.0, now - updated) * rate)
+            if tokens < ZIP_BURST:
+                buckets[key] = (tokens, now)
+        tokens = buckets.get(ip_key, (float(ZIP_BURST), now))[0]
+        if tokens >= 1:
+            buckets[ip_key] = (tokens - 1, now)
+            result.append(0.0)
+        else:
+            result.append((1 - tokens) / rate)
+        return buckets
+    
+    cache_backend.update('zip-rate', apply)
+    return result[0]
+
+@app.route('/download_zip/<string:zone>')
+def download_zip(zone):
+    if zone not in MENU_ZONES:
+        return {'status': 'error', 'message': 'ไม่พบโซนนี้'}, 404
+    
+    # ZIP หนึ่งไฟล์ดึงรูปทั้งโซนจาก Cloudinary - กันการยิงซ้ำจาก IP เดียว
+    wait_seconds = take_zip_token(client_ip())
+    if wait_seconds:
+        logger.warning(f"ZIP rate limit hit for {client_ip()} ({zone})")
+        return {'status': 'error', 'message': 'ดาวน์โหลดบ่อยเกินไป กรุณาลองใหม่ภายหลัง'}, 429, {'Retry-After': str(int(wait_seconds) + 1)}
+    
+    try:
+        # ใช้ผลกรอง visibility ชุดเดียวกับหน้าเมนู
+        images = get_menu_model()['zones'][zone]
+    except Exception as e:
+        logger.error(f"Error preparing ZIP for {zone}: {e}")
+        return {'status': 'error', 'message': str(e)}, 500
+    
+    images = filter_images_by_search(images, request.args.get('q'))
+    
+    if not images:
+        return {'status': 'error', 'message': 'ไม่พบรูปภาพ'}, 404
+    
+    def generate():
+        buffer = ZipStreamBuffer()
+        used_names = set()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for img, content in iter_fetched_images(images):
+                name = img['public_id'].split('/')[-1]
+                entry_name = f"{name}.jpg"
+                counter = 1
+                while entry_name in used_names:
+                    counter += 1
+                    entry_name = f"{name}_{counter}.jpg"
+                used_names.add(entry_name)
+                
+                archive.writestr(entry_name, content)
+                yield buffer.drain()
+        yield buffer.drain()
+        logger.info(f"Streamed ZIP for {zone}: {len(used_names)}/{len(images)} images")
+    
+    return Response(stream_with_context(generate()), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{ZIP_NAMES[zone]}"',
+        'Cache-Control': 'no-store'
+    })
 
 # ==========================================
 # 🔐 โซน Login
@@ -319,53 +2933,45 @@ def admin():
     if not session.get('logged_in'):
         return redirect(url_for('login'))
     
-    # --- ดึงรูปมาจับคู่ (Sync Logic) ---
+    # --- ดึงรูปมาจับคู่ (Sync Logic) - จับคู่ไว้แล้วใน menu model ---
     try:
-        data = get_cached_images()
-        
-        # 1. ดึงข้อมูลทั้ง 3 โฟลเดอร์
-        res_wm = data['watermarked']
-        res_cl = data['clean']
-        res_pm = data['premium']
+        model = get_menu_model()
+        sorted_items = model['items']
         
-        # 2. สร้าง Dictionary เพื่อจับคู่
-        # Key = ชื่อไฟล์, Value = ข้อมูลครบชุด
-        menu_items = {}
-
-        # วนลูปโซนลายน้ำ
-        for img in res_wm:
-            filename = img['public_id'].split('/')[-1]
-            if filename not in menu_items:
-                menu_items[filename] = {'name': filename, 'wm': None, 'cl': None, 'pm': None, 'created_at': img['created_at']}
-            menu_items[filename]['wm'] = img['secure_url']
-
-        # วนลูปโซนต้นฉบับ
-        for img in res_cl:
-            filename = img['public_id'].split('/')[-1]
-            if filename not in menu_items:
-                menu_items[filename] = {'name': filename, 'wm': None, 'cl': None, 'pm': None, 'created_at': img['created_at']}
-            menu_items[filename]['cl'] = img['secure_url']
-
-        # วนลูปโซนพรีเมี่ยม
-        for img in res_pm:
-            filename = img['public_id'].split('/')[-1]
-            if filename not in menu_items:
-                menu_items[filename] = {'name': filename, 'wm': None, 'cl': None, 'pm': None, 'created_at': img['created_at']}
-            menu_items[filename]['pm'] = img['secure_url']
-
-        # 3. เรียงตามวันที่ล่าสุด
-        sorted_items = sorted(menu_items.values(), key=lambda x: x['created_at'], reverse=True)
+        # ฝัง visibility ของทุกเมนูไปกับหน้าเลย (ไม่ต้องยิง /get_visibility ทีละเมนู)
+        visibility_map = model['visibility']
+        metadata_version = model['metadata_version']
 
     except cloudinary.exceptions.Error as e:
         logger.error(f"Cloudinary error in admin: {e}")
         sorted_items = []
+        visibility_map = {}
+        metadata_version = None
         flash('เกิดข้อผิดพลาดในการโหลดข้อมูล', 'error')
     except Exception as e:
         logger.error(f"Unexpected error in admin: {e}")
         sorted_items = []
+        visibility_map = {}
+        metadata_version = None
         flash('เกิดข้อผิดพลาดที่ไม่คาดคิด', 'error')
         
-    return render_template('admin.html', items=sorted_items)
+    try:
+        watermark_enabled = bool(usable_watermark_styles())
+    except WatermarkNotConfigured:
+        watermark_enabled = False
+    
+    return render_template('admin.html', items=sorted_items, visibility_map=visibility_map, metadata_version=metadata_version,
+                           watermark_enabled=watermark_enabled)
+
+# --- รีเฟรช cache (โหลดรายการรูปจาก Cloudinary ใหม่ทั้งหมด) ---
+@app.route('/refresh_cache')
+def refresh_cache():
+    if not session.get('logged_in'):
+        return redirect(url_for('login'))
+    
+    clear_cache()
+    flash('🔄 โหลดข้อมูลรูปใหม่จาก Cloudinary แล้ว')
+    return redirect(url_for('admin'))
 
 # --- API อัปโหลดรูป (รับจาก Queue) ---
 @app.route('/upload_api', methods=['POST'])
@@ -389,46 +2995,19 @@ def upload_api():
         return {'status': 'error', 'message': f'ไฟล์ใหญ่เกินไป (สูงสุด {MAX_FILE_SIZE // (1024*1024)}MB)'}, 400
 
     try:
-        # ตั้งชื่อไฟล์
-        if custom_name:
-            final_name = f"{custom_name}_{index}" if int(index) > 0 else custom_name
-        else:
-            final_name = os.path.splitext(file.filename)[0]
-        
-        # Normalize Thai characters (แก้ปัญหาสระแยก)
-        final_name = normalize_thai_filename(final_name)
-        
-        # Sanitize filename - รองรับภาษาไทย
-        final_name = "".join(c for c in final_name if c.isalnum() or c in (' ', '-', '_') or '\u0E00' <= c <= '\u0E7F').strip()
-
-        # Process Image with proper resource management
-        with Image.open(file) as img:
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            img.draft('RGB', (2048, 2048))
-            if img.width > 2048 or img.height > 2048:
-                img.thumbnail((2048, 2048), Image.Resampling.LANCZOS)
-
-            # เลือกโฟลเดอร์ตาม type
-            if upload_type == 'watermarked':
-                folder = "menu/watermarked"
-            elif upload_type == 'premium':
-                folder = "menu/premium"
-            else:
-                folder = "menu/clean"
-
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='JPEG', quality=85, optimize=True)
-            img_byte_arr.seek(0)
-            
-            cloudinary.uploader.upload(img_byte_arr, public_id=f"{folder}/{final_name}")
+        final_name = menu_upload_name(file.filename, custom_name, index)
         
-        # ล้าง cache
-        clear_cache()
-        logger.info(f"Uploaded {final_name} to {folder}")
+        # Process Image ใน image pool (ไม่บล็อก worker) แล้วอัปโหลด
+        dedup = upload_menu_image(file.read(), upload_type, final_name, request.form.get('watermark') == '1')
         
-        return {'status': 'success', 'file': final_name}
+        return {'status': 'success', 'file': final_name, 'dedup': dedup}
 
+    except (ImageTooLarge, WatermarkNotConfigured) as e:
+        logger.warning(f"Upload rejected ({file.filename}): {e}")
+        return {'status': 'error', 'message': str(e)}, 400
+    except ImagePoolBusy as e:
+        logger.warning(f"Upload rejected, image pool busy: {file.filename}")
+        return {'status': 'busy', 'message': str(e)}, 503, {'Retry-After': '2'}
     except cloudinary.exceptions.Error as e:
         logger.error(f"Cloudinary upload error: {e}")
         return {'status': 'error', 'message': f'เกิดข้อผิดพลาดในการอัปโหลด: {str(e)}'}, 500
@@ -449,31 +3028,8 @@ def rename_sync():
         return {'status': 'error', 'message': 'ข้อมูลไม่ครบ'}, 400
 
     try:
-        errors = []
-        
-        # เปลี่ยนชื่อในโซนลายน้ำ
-        try:
-            cloudinary.uploader.rename(f"menu/watermarked/{old_name}", f"menu/watermarked/{new_name}", overwrite=True)
-        except cloudinary.exceptions.Error as e:
-            logger.warning(f"Failed to rename watermarked/{old_name}: {e}")
-            errors.append(f"watermarked: {str(e)}")
-
-        # เปลี่ยนชื่อในโซนต้นฉบับ
-        try:
-            cloudinary.uploader.rename(f"menu/clean/{old_name}", f"menu/clean/{new_name}", overwrite=True)
-        except cloudinary.exceptions.Error as e:
-            logger.warning(f"Failed to rename clean/{old_name}: {e}")
-            errors.append(f"clean: {str(e)}")
-        
-        # เปลี่ยนชื่อในโซนพรีเมี่ยม
-        try:
-            cloudinary.uploader.rename(f"menu/premium/{old_name}", f"menu/premium/{new_name}", overwrite=True)
-        except cloudinary.exceptions.Error as e:
-            logger.warning(f"Failed to rename premium/{old_name}: {e}")
-            errors.append(f"premium: {str(e)}")
-
-        # ล้าง cache
-        clear_cache()
+        # เปลี่ยนชื่อทั้ง 3 โซนพร้อมกัน (ลายน้ำ / ต้นฉบับ / พรีเมี่ยม)
+        errors = [f"{folder}: {str(error)}" for folder, error in rename_menu(old_name, new_name).items()]
         
         if errors:
             return {'status': 'partial', 'message': 'เปลี่ยนชื่อบางส่วนสำเร็จ', 'errors': errors}
@@ -493,49 +3049,58 @@ def replace_sync():
     file_cl = request.files.get('file_cl')
     file_pm = request.files.get('file_pm')
     target_name = request.form.get('target_name')
+    auto_watermark = request.form.get('auto_watermark') == '1'
 
     if not target_name:
         return {'status': 'error', 'message': 'No name provided'}, 400
 
     try:
-        # ทับลายน้ำ
-        if file_wm:
-            with Image.open(file_wm) as img:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                img.thumbnail((2048, 2048), Image.Resampling.LANCZOS)
-                byte_arr = io.BytesIO()
-                img.save(byte_arr, format='JPEG', quality=85, optimize=True)
-                byte_arr.seek(0)
-                cloudinary.uploader.upload(byte_arr, public_id=f"menu/watermarked/{target_name}", overwrite=True, invalidate=True)
-
-        # ทับต้นฉบับ
-        if file_cl:
-            with Image.open(file_cl) as img:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                img.thumbnail((2048, 2048), Image.Resampling.LANCZOS)
-                byte_arr = io.BytesIO()
-                img.save(byte_arr, format='JPEG', quality=85, optimize=True)
-                byte_arr.seek(0)
-                cloudinary.uploader.upload(byte_arr, public_id=f"menu/clean/{target_name}", overwrite=True, invalidate=True)
-        
-        # ทับพรีเมี่ยม
-        if file_pm:
-            with Image.open(file_pm) as img:
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                img.thumbnail((2048, 2048), Image.Resampling.LANCZOS)
-                byte_arr = io.BytesIO()
-                img.save(byte_arr, format='JPEG', quality=85, optimize=True)
-                byte_arr.seek(0)
-                cloudinary.uploader.upload(byte_arr, public_id=f"menu/premium/{target_name}", overwrite=True, invalidate=True)
-
-        # ล้าง cache
-        clear_cache()
+        # ส่งทุกรูปเข้า image pool พร้อมกันก่อน แล้วอัปโหลดทุกโฟลเดอร์พร้อมกัน
+        # (ลายน้ำ / ต้นฉบับ / พรีเมี่ยม) - รูปที่ต้นฉบับตรงกับ content index ไม่ต้อง encode
+        files = {folder: file for folder, file in (('watermarked', file_wm), ('clean', file_cl), ('premium', file_pm)) if file}
+        # ไม่ได้แนบรูปลายน้ำมา - สร้างจากรูปต้นฉบับแทน
+        watermarks = ()
+        if auto_watermark and 'clean' in files:
+            watermarks = tuple(folder for folder in usable_watermark_styles() if folder not in files)
+        
+        # จองคิว image pool ให้ทุกไฟล์ก่อน - คิวเต็มแล้วไม่มีงานของไฟล์แรกๆ ค้างอยู่ใน pool ทั้งที่ตอบ 503 ไปแล้ว
+        jobs = {}
+        with ImagePoolReservation(len(files)) as reservation:
+            for folder, file in files.items():
+                jobs.update(plan_menu_uploads(file.read(), target_name, (folder,), watermarks if folder == 'clean' else (),
+                                              reservation=reservation))
+        
+        def replace_folder(folder):
+            public_id, digest, encode = jobs[folder]
+            _, dedup = store_menu_image(public_id, digest, encode, overwrite=True, invalidate=True)
+            return dedup
+        
+        replaced = []
+        errors = []
+        dedup = {}
+        for folder, (folder_dedup, error) in run_per_folder(replace_folder, tuple(jobs)).items():
+            if error is None:
+                replaced.append(folder)
+                if folder_dedup:
+                    dedup[folder] = folder_dedup
+            else:
+                logger.error(f"Failed to replace {folder}/{target_name}: {error}")
+                errors.append(f"{folder}: {str(error)}")
+        
+        if errors and not replaced:
+            return {'status': 'error', 'message': '; '.join(errors)}, 500
+        if errors:
+            return {'status': 'partial', 'message': f'แทนที่รูปบางส่วนสำเร็จ ({", ".join(replaced)}). ข้อผิดพลาด: {"; ".join(errors)}', 'errors': errors, 'dedup': dedup}
+
         logger.info(f"Replaced images for {target_name}")
         
-        return {'status': 'success'}
+        return {'status': 'success', 'dedup': dedup}
+    except WatermarkNotConfigured as e:
+        logger.warning(f"Replace rejected ({target_name}): {e}")
+        return {'status': 'error', 'message': str(e)}, 400
+    except ImagePoolBusy as e:
+        logger.warning(f"Replace rejected, image pool busy: {target_name}")
+        return {'status': 'busy', 'message': str(e)}, 503, {'Retry-After': '2'}
     except cloudinary.exceptions.Error as e:
         logger.error(f"Cloudinary replace error: {e}")
         return {'status': 'error', 'message': str(e)}, 500
@@ -550,8 +3115,7 @@ def delete_image(public_id):
         return redirect(url_for('login'))
     
     try:
-        cloudinary.uploader.destroy(public_id, invalidate=True)
-        clear_cache()
+        remove_menu_asset(public_id)
         flash('🗑️ ลบรูปเรียบร้อยแล้ว')
         logger.info(f"Deleted image: {public_id}")
     except cloudinary.exceptions.Error as e:
@@ -569,31 +3133,8 @@ def delete_sync(filename):
         return redirect(url_for('login'))
     
     try:
-        errors = []
-        
-        # 1. ลบโซนลายน้ำ
-        try:
-            cloudinary.uploader.destroy(f"menu/watermarked/{filename}", invalidate=True)
-        except cloudinary.exceptions.Error as e:
-            logger.warning(f"Failed to delete watermarked/{filename}: {e}")
-            errors.append("watermarked")
-        
-        # 2. ลบโซนต้นฉบับ
-        try:
-            cloudinary.uploader.destroy(f"menu/clean/{filename}", invalidate=True)
-        except cloudinary.exceptions.Error as e:
-            logger.warning(f"Failed to delete clean/{filename}: {e}")
-            errors.append("clean")
-        
-        # 3. ลบโซนพรีเมี่ยม
-        try:
-            cloudinary.uploader.destroy(f"menu/premium/{filename}", invalidate=True)
-        except cloudinary.exceptions.Error as e:
-            logger.warning(f"Failed to delete premium/{filename}: {e}")
-            errors.append("premium")
-        
-        # ล้าง cache
-        clear_cache()
+        # ลบทั้ง 3 โซนพร้อมกัน (ลายน้ำ / ต้นฉบับ / พรีเมี่ยม)
+        errors = list(delete_menu(filename))
         
         if errors:
             flash(f'🗑️ ลบเมนู "{filename}" บางส่วน (ไม่พบใน: {", ".join(errors)})')
@@ -606,7 +3147,7 @@ def delete_sync(filename):
         
     return redirect(url_for('admin'))
 
-# --- API Duplicate Menu (คัดลอกเมนู - ใช้รูปเดิม เปลี่ยนชื่อ) ---
+# --- API Duplicate Menu (คัดลอกเมนู - alias ชี้ไปที่รูปเดิม ไม่อัปโหลดซ้ำ) ---
 @app.route('/duplicate_menu', methods=['POST'])
 def duplicate_menu():
     if not session.get('logged_in'):
@@ -623,70 +3164,32 @@ def duplicate_menu():
     
     try:
         # Normalize ชื่อใหม่
-        new_name = normalize_thai_filename(new_name)
-        new_name = "".join(c for c in new_name if c.isalnum() or c in (' ', '-', '_') or '\u0E00' <= c <= '\u0E7F').strip()
-        
-        duplicated = []
-        errors = []
+        new_name = menu_upload_name('', new_name)
         
-        # 1. Duplicate โซนลายน้ำ
-        try:
-            result = cloudinary.api.resource(f"menu/watermarked/{original_name}")
-            url = result['secure_url']
-            cloudinary.uploader.upload(url, public_id=f"menu/watermarked/{new_name}")
-            duplicated.append("watermarked")
-        except cloudinary.exceptions.NotFound:
-            logger.info(f"Watermarked image not found for {original_name}")
-        except Exception as e:
-            logger.error(f"Error duplicating watermarked: {e}")
-            errors.append(f"watermarked: {str(e)}")
-        
-        # 2. Duplicate โซนต้นฉบับ
-        try:
-            result = cloudinary.api.resource(f"menu/clean/{original_name}")
-            url = result['secure_url']
-            cloudinary.uploader.upload(url, public_id=f"menu/clean/{new_name}")
-            duplicated.append("clean")
-        except cloudinary.exceptions.NotFound:
-            logger.info(f"Clean image not found for {original_name}")
-        except Exception as e:
-            logger.error(f"Error duplicating clean: {e}")
-            errors.append(f"clean: {str(e)}")
+        # รูปต้นฉบับทุกโซนมีอยู่แล้วใน image index (ไม่ต้องถาม Admin API ทีละโซน)
+        by_name = get_menu_model()['by_name']
+        record = by_name.get(original_name)
+        if record is None:
+            return {'status': 'error', 'message': 'ไม่พบรูปต้นฉบับที่จะคัดลอก'}, 404
+        if new_name in by_name:
+            return {'status': 'error', 'message': f'มีเมนูชื่อ "{new_name}" อยู่แล้ว'}, 400
+        sources = record['images']
         
-        # 3. Duplicate โซนพรีเมี่ยม (ถ้ามี)
-        try:
-            result = cloudinary.api.resource(f"menu/premium/{original_name}")
-            url = result['secure_url']
-            cloudinary.uploader.upload(url, public_id=f"menu/premium/{new_name}")
-            duplicated.append("premium")
-        except cloudinary.exceptions.NotFound:
-            logger.info(f"Premium image not found for {original_name}")
-        except Exception as e:
-            logger.error(f"Error duplicating premium: {e}")
-            errors.append(f"premium: {str(e)}")
+        # 1-3. บันทึก alias ทุกโซนที่มีรูปเป็นรายการเดียวใน journal - ต้นฉบับที่เป็น alias อยู่แล้วชี้ไปที่ asset จริงเลย
+        created_at = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        aliases = {f"menu/{folder}/{new_name}": {'source': img.get('alias_of', img['public_id']), 'created_at': created_at}
+                   for folder, img in sources.items()}
+        save_aliases(aliases)
+        for (alias_id, alias), img in zip(aliases.items(), sources.values()):
+            index_upsert(alias_resource(alias_id, alias, img))
+        duplicated = list(sources)
         
-        # 4. คัดลอก visibility settings
+        # 4. คัดลอก visibility (mask เดียว บันทึกเป็นรายการเดียวใน journal)
         try:
-            visibility = get_menu_visibility(original_name)
-            set_menu_visibility(
-                new_name,
-                visibility['show_normal_watermark'],
-                visibility['show_normal_clean'],
-                visibility['show_premium_watermark'],
-                visibility['show_premium_clean']
-            )
+            save_metadata({new_name: load_metadata()['visibility'].get(original_name)})
         except Exception as e:
             logger.warning(f"Could not copy visibility settings: {e}")
         
-        # ล้าง cache
-        clear_cache()
-        
-        if not duplicated:
-            return {'status': 'error', 'message': 'ไม่พบรูปต้นฉบับที่จะคัดลอก'}, 404
-        
-        if errors:
-            return {'status': 'partial', 'message': f'คัดลอกบางส่วนสำเร็จ ({", ".join(duplicated)}). ข้อผิดพลาด: {"; ".join(errors)}'}
-        
         logger.info(f"Duplicated {original_name} to {new_name}: {duplicated}")
         return {'status': 'success', 'message': f'✅ คัดลอกเมนู "{original_name}" เป็น "{new_name}" สำเร็จ ({len(duplicated)} โซน)'}
         
@@ -710,14 +3213,317 @@ def toggle_visibility():
         return {'status': 'error', 'message': 'ไม่มีชื่อไฟล์'}, 400
     
     try:
-        set_menu_visibility(filename, show_normal_watermark, show_normal_clean, 
-                          show_premium_watermark, show_premium_clean)
+        version = set_menu_visibility(filename, show_normal_watermark, show_normal_clean, 
+                                      show_premium_watermark, show_premium_clean)
         logger.info(f"Updated visibility for {filename}: normal_wm={show_normal_watermark}, normal_cl={show_normal_clean}, premium_wm={show_premium_watermark}, premium_cl={show_premium_clean}")
-        return {'status': 'success', 'message': 'อัปเดตการแสดงผลเรียบร้อย'}
+        return {'status': 'success', 'message': 'อัปเดตการแสดงผลเรียบร้อย', 'version': version}
     except Exception as e:
         logger.error(f"Error toggling visibility: {e}")
         return {'status': 'error', 'message': str(e)}, 500
 
+# --- API Toggle Visibility แบบหลายเมนู (บันทึกครั้งเดียว) ---
+@app.route('/toggle_visibility_bulk', methods=['POST'])
+def toggle_visibility_bulk():
+    if not session.get('logged_in'):
+        return {'status': 'error', 'message': 'Unauthorized'}, 401
+    
+    payload = request.get_json(silent=True) or {}
+    items = payload.get('items')
+    # version ของ metadata ที่ client เห็นตอนโหลดหน้า - ถ้ามีคนแก้ไปก่อนจะตอบ 409
+    expected_version = payload.get('version')
+    
+    if not isinstance(items, list) or not items:
+        return {'status': 'error', 'message': 'ไม่มีรายการที่จะบันทึก'}, 400
+    
+    # ตรวจสอบทีละรายการ แล้วรวบรวมเฉพาะรายการที่ถูกต้อง
+    changes = {}
+    results = []
+    for item in items:
+        filename = item.get('filename') if isinstance(item, dict) else None
+        if not filename:
+            results.append({'filename': filename, 'status': 'error', 'message': 'ไม่มีชื่อไฟล์'})
+            continue
+        changes[filename] = {
+            'show_normal_watermark': parse_visibility_flag(item.get('show_normal_watermark', False)),
+            'show_normal_clean': parse_visibility_flag(item.get('show_normal_clean', False)),
+            'show_premium_watermark': parse_visibility_flag(item.get('show_premium_watermark', False)),
+            'show_premium_clean': parse_visibility_flag(item.get('show_premium_clean', False))
+        }
+        results.append({'filename': filename, 'status': 'success'})
+    
+    try:
+        version = set_menus_visibility_bulk(changes, expected_version) if changes else load_metadata()['version']
+        logger.info(f"Updated visibility for {len(changes)} menus in bulk")
+    except MetadataConflict as e:
+        logger.warning(f"Rejected bulk visibility update: {e}")
+        return {'status': 'conflict', 'message': 'มีการแก้ไขการแสดงผลจากที่อื่นก่อนหน้านี้ กรุณาโหลดหน้าใหม่', 'version': load_metadata()['version']}, 409
+    except Exception as e:
+        logger.error(f"Error toggling visibility in bulk: {e}")
+        return {'status': 'error', 'message': str(e)}, 500
+    
+    failed = sum(1 for r in results if r['status'] != 'success')
+    status = 'success' if failed == 0 else 'partial'
+    return {'status': status, 'updated': len(changes), 'failed': failed, 'results': results, 'version': version}
+
+# --- Metrics ของการเรียก Cloudinary (ต่อ worker process) ---
+@app.route('/metrics/cloudinary')
+def cloudinary_metrics():
+    if not session.get('logged_in'):
+        return {'status': 'error', 'message': 'Unauthorized'}, 401
+    return {'status': 'success', 'data': cloudinary_client.metrics()}
+
+# --- Background Jobs: สร้างงาน bulk (rename / delete / visibility) ---
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    if not session.get('logged_in'):
+        return {'status': 'error', 'message': 'Unauthorized'}, 401
+    
+    payload = request.get_json(silent=True) or {}
+    kind = payload.get('kind')
+    items = payload.get('items')
+    
+    # สร้างลายน้ำใหม่ทั้งแคตตาล็อก (ทุกเมนูที่มีรูปต้นฉบับ)
+    if kind == 'watermark' and payload.get('all'):
+        items = [{'filename': item['name']} for item in get_menu_model()['items'] if 'clean' in item['images']]
+    
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        return {'status': 'error', 'message': 'ไม่มีรายการที่จะทำ'}, 400
+    
+    if kind == 'rename':
+        payloads = [{'old_name': item.get('old_name'), 'new_name': str(item.get('new_name') or '').strip()} for item in items]
+        if not all(p['old_name'] and p['new_name'] for p in payloads):
+            return {'status': 'error', 'message': 'ข้อมูลไม่ครบ'}, 400
+    elif kind == 'delete':
+        payloads = [{'filename': item.get('filename')} for item in items]
+        if not all(p['filename'] for p in payloads):
+            return {'status': 'error', 'message': 'ไม่มีชื่อไฟล์'}, 400
+    elif kind == 'watermark':
+        try:
+            usable_watermark_styles()
+        except WatermarkNotConfigured as e:
+            return {'status': 'error', 'message': str(e)}, 400
+        payloads = [{'filename': item.get('filename')} for item in items]
+        if not all(p['filename'] for p in payloads):
+            return {'status': 'error', 'message': 'ไม่มีชื่อไฟล์'}, 400
+    elif kind == 'visibility':
+        if not all(item.get('filename') for item in items):
+            return {'status': 'error', 'message': 'ไม่มีชื่อไฟล์'}, 400
+        # ทั้งชุดบันทึกเป็นรายการเดียวใน metadata journal
+        payloads = [{'changes': {
+            item['filename']: {key: parse_visibility_flag(item.get(key, False)) for key in VISIBILITY_BITS}
+            for item in items
+        }}]
+    else:
+        return {'status': 'error', 'message': 'ไม่รู้จักประเภทงานนี้'}, 400
+    
+    try:
+        job_id = job_queue.create(kind, payloads)
+        job_wakeup.set()
+        logger.info(f"Queued {kind} job {job_id} ({len(payloads)} items)")
+        return {'status': 'success', 'job_id': job_id, 'total': len(payloads)}, 202
+    except Exception as e:
+        logger.error(f"Error creating job: {e}")
+        return {'status': 'error', 'message': str(e)}, 500
+
+# --- Background Jobs: อัปโหลดหลายรูปเป็นงานเดียว (ไฟล์ถูกพักไว้บนดิสก์) ---
+@app.route('/jobs/upload', methods=['POST'])
+def create_upload_job():
+    if not session.get('logged_in'):
+        return {'status': 'error', 'message': 'Unauthorized'}, 401
+    
+    files = request.files.getlist('files')
+    custom_name = request.form.get('name', '').strip()
+    upload_type = request.form.get('type')
+    watermark = request.form.get('watermark') == '1'
+    
+    if not files:
+        return {'status': 'error', 'message': 'No file'}, 400
+    
+    if watermark and upload_folder_for(upload_type).endswith('/clean'):
+        try:
+            usable_watermark_styles()
+        except WatermarkNotConfigured as e:
+            return {'status': 'error', 'message': str(e)}, 400
+    
+    try:
+        # ไฟล์พักไว้ใต้ job id (ลบทิ้งทั้งโฟลเดอร์เมื่อ job เสร็จ)
+        job_id = uuid.uuid4().hex
+        spool_dir = os.path.join(JOBS_SPOOL_DIR, job_id)
+        os.makedirs(spool_dir, exist_ok=True)
+        
+        payloads = []
+        rejected = []
+        for index, file in enumerate(files, start=1):
+            if not allowed_file(file.filename):
+                rejected.append({'filename': file.filename, 'message': 'ประเภทไฟล์ไม่ถูกต้อง (รองรับเฉพาะ jpg, png, gif, webp)'})
+                continue
+            if not validate_file_size(file):
+                rejected.append({'filename': file.filename, 'message': f'ไฟล์ใหญ่เกินไป (สูงสุด {MAX_FILE_SIZE // (1024*1024)}MB)'})
+                continue
+            spool_path = os.path.join(spool_dir, str(index))
+            file.save(spool_path)
+            payloads.append({'spool': spool_path, 'type': upload_type, 'watermark': watermark,
+                             'name': menu_upload_name(file.filename, custom_name, index)})
+        
+        if not payloads:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+            return {'status': 'error', 'message': 'ไม่มีไฟล์ที่อัปโหลดได้', 'rejected': rejected}, 400
+        
+        job_queue.create('upload', payloads, job_id)
+        job_wakeup.set()
+        logger.info(f"Queued upload job {job_id} ({len(payloads)} files, {len(rejected)} rejected)")
+        return {'status': 'success', 'job_id': job_id, 'total': len(payloads), 'rejected': rejected}, 202
+    except Exception as e:
+        logger.error(f"Error creating upload job: {e}")
+        return {'status': 'error', 'message': str(e)}, 500
+
+# --- อัปโหลดตรงจาก browser ไป Cloudinary: ขอพารามิเตอร์ที่เซ็นแล้ว ---
+@app.route('/upload_signature', methods=['POST'])
+def upload_signature():
+    if not session.get('logged_in'):
+        return {'status': 'error', 'message': 'Unauthorized'}, 401
+    
+    # demo mode (ไม่มี api secret) - ให้ browser กลับไปใช้คิวอัปโหลดผ่านเซิร์ฟเวอร์
+    if not cloudinary.config().api_secret:
+        return {'status': 'unavailable', 'message': 'ไม่ได้ตั้งค่า Cloudinary'}, 501
+    
+    payload = request.get_json(silent=True) or {}
+    files = payload.get('files')
+    custom_name = str(payload.get('name') or '').strip()
+    folder = upload_folder_for(payload.get('type'))
+    
+    if not isinstance(files, list) or not files or not all(isinstance(item, dict) for item in files):
+        return {'status': 'error', 'message': 'No file'}, 400
+    
+    uploads = []
+    deduped = []
+    rejected = []
+    for index, item in enumerate(files, start=1):
+        filename = str(item.get('filename') or '')
+        if not allowed_file(filename):
+            rejected.append({'filename': filename, 'message': 'ประเภทไฟล์ไม่ถูกต้อง (รองรับเฉพาะ jpg, png, gif, webp)'})
+            continue
+        if int(item.get('size') or 0) > MAX_FILE_SIZE:
+            rejected.append({'filename': filename, 'message': f'ไฟล์ใหญ่เกินไป (สูงสุด {MAX_FILE_SIZE // (1024*1024)}MB)'})
+            continue
+        final_name = menu_upload_name(filename, custom_name, index)
+        public_id = f"{folder}/{final_name}"
+        # sha256 ที่ browser คำนวณ - ใช้ข้ามไฟล์ที่เคยอัปโหลดแล้ว
+        source_hash = str(item.get('sha256') or '').lower()
+        if not re.fullmatch(r'[0-9a-f]{64}', source_hash):
+            source_hash = None
+        try:
+            dedup = dedup_direct_upload(public_id, source_hash) if source_hash else None
+        except Exception as e:
+            logger.warning(f"Direct upload dedup failed for {public_id}: {e}")
+            dedup = None
+        if dedup:
+            deduped.append({'index': index, 'filename': filename, 'file': final_name, 'dedup': dedup})
+            continue
+        # alias ที่ชี้มาที่รูปเดิมต้องไม่เปลี่ยนตามเมื่อ browser อัปโหลดทับ
+        detach_aliases(public_id, keep=True)
+        uploads.append({'index': index, 'filename': filename, 'file': final_name,
+                        **direct_upload_params(public_id, source_hash)})
+    
+    if not uploads and not deduped:
+        return {'status': 'error', 'message': 'ไม่มีไฟล์ที่อัปโหลดได้', 'rejected': rejected}, 400
+    
+    # งานในคิวติดตามไฟล์ที่ browser จะส่งเอง - /upload_complete ปิดทีละไฟล์ ที่ไม่มีใครแจ้งผล worker ตรวจกับ Cloudinary หลังลายเซ็นหมดอายุ
+    job_id = None
+    if uploads:
+        job_id = job_queue.create('direct_upload', [
+            {'public_id': upload['fields']['public_id'], 'file': upload['file'], 'timestamp': upload['fields']['timestamp']}
+            for upload in uploads
+        ], run_after=time.time() + DIRECT_UPLOAD_RECONCILE)
+        for idx, upload in enumerate(uploads):
+            upload['job_idx'] = idx
+        logger.info(f"Signed direct upload job {job_id} ({len(uploads)} files)")
+    return {'status': 'success', 'job_id': job_id, 'uploads': uploads, 'deduped': deduped, 'rejected': rejected}
+
+# --- อัปโหลดตรงจาก browser ไป Cloudinary: แจ้งผล (สำเร็จ/error) เพื่ออัปเดต index และปิดงานในคิว ---
+@app.route('/upload_complete', methods=['POST'])
+def upload_complete():
+    if not session.get('logged_in'):
+        return {'status': 'error', 'message': 'Unauthorized'}, 401
+    
+    payload = request.get_json(silent=True) or {}
+    job_id = str(payload.get('job_id') or '')
+    job_idx = payload.get('job_idx')
+    item = job_queue.item(job_id, job_idx) if job_id else None
+    if job_id and (item is None or item['kind'] != 'direct_upload'):
+        return {'status': 'error', 'message': 'ไม่พบงานนี้'}, 404
+    
+    try:
+        # browser อัปโหลดไม่สำเร็จ - ปิด item เลย ไม่ต้องรอตรวจตอนลายเซ็นหมดอายุ
+        if payload.get('error'):
+            if item is None:
+                return {'status': 'error', 'message': 'ไม่พบงานนี้'}, 404
+            if job_queue.fail(job_id, job_idx, payload['error']):
+                logger.info(f"Job {job_id} finished")
+            return {'status': 'success'}
+        
+        if item is not None and item['payload']['public_id'] != payload.get('public_id'):
+            return {'status': 'error', 'message': 'ผลอัปโหลดไม่ตรงกับงาน'}, 400
+        resource = complete_direct_upload(payload)
+        if resource is None:
+            return {'status': 'error', 'message': 'ลายเซ็นผลอัปโหลดไม่ถูกต้อง'}, 400
+        if item is not None and job_queue.complete(job_id, job_idx, {'file': item['payload']['file'], 'dedup': None}):
+            logger.info(f"Job {job_id} finished")
+        return {'status': 'success', 'file': resource['public_id'].split('/')[-1], 'bytes': resource['bytes']}
+    except cloudinary.exceptions.NotFound:
+        return {'status': 'error', 'message': 'ไม่พบรูปที่อัปโหลดใน Cloudinary'}, 400
+    except Exception as e:
+        logger.error(f"Direct upload completion error: {e}")
+        return {'status': 'error', 'message': str(e)}, 500
+
+# --- Background Jobs: ดูความคืบหน้า (polling) ---
+@app.route('/jobs/<string:job_id>')
+def job_status(job_id):
+    if not session.get('logged_in'):
+        return {'status': 'error', 'message': 'Unauthorized'}, 401
+    
+    job = job_queue.progress(job_id)
+    if job is None:
+        return {'status': 'error', 'message': 'ไม่พบงานนี้'}, 404
+    return {'status': 'success', 'job': job}
+
+# --- Background Jobs: ความคืบหน้าแบบ Server-Sent Events ---
+@app.route('/jobs/<string:job_id>/events')
+def job_events(job_id):
+    if not session.get('logged_in'):
+        return {'status': 'error', 'message': 'Unauthorized'}, 401
+    
+    if job_queue.progress(job_id) is None:
+        return {'status': 'error', 'message': 'ไม่พบงานนี้'}, 404
+    
+    def generate():
+        reported = set()  # item ที่ส่งผลไปแล้ว (เชื่อมต่อใหม่ = ส่งทั้งหมดอีกรอบ)
+        last_sent = None
+        idle = 0
+        while True:
+            job = job_queue.progress(job_id)
+            if job is None:
+                return
+            # ส่งเฉพาะ item ที่เพิ่งจบ + ตัวนับ
+            items = [item for item in job['items'] if item['status'] in ('done', 'failed') and item['idx'] not in reported]
+            reported.update(item['idx'] for item in items)
+            event = dict(job, items=items)
+            state = (job['done'], job['failed'], job['running'], job['finished'])
+            if state != last_sent or items:
+                last_sent = state
+                idle = 0
+                yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+            else:
+                idle += 1
+                if idle % 15 == 0:
+                    yield ": keep-alive\n\n"
+            if job['finished']:
+                return
+            time.sleep(1)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 # --- API ดึงข้อมูล Visibility ---
 @app.route('/get_visibility/<string:filename>')
 def get_visibility(filename):
@@ -731,6 +3537,33 @@ def get_visibility(filename):
         logger.error(f"Error getting visibility: {e}")
         return {'status': 'error', 'message': str(e)}, 500
 
+# --- API ดึงข้อมูล Visibility ทุกเมนู (ครั้งเดียว รองรับ ETag) ---
+@app.route('/get_visibility_all')
+def get_visibility_all():
+    if not session.get('logged_in'):
+        return {'status': 'error', 'message': 'Unauthorized'}, 401
+    
+    try:
+        data = get_cached_images()
+        metadata = load_metadata()
+        filenames = set(metadata['visibility'].names)
+        for folder in IMAGE_FOLDERS:
+            filenames.update(img['public_id'].split('/')[-1] for img in data[folder])
+        
+        visibility_map = get_all_menu_visibility(sorted(filenames))
+        
+        # ETag จากเนื้อหา + version - ถ้าไม่มีอะไรเปลี่ยน client จะได้ 304 กลับไป
+        # (version ขยับได้โดยที่ map เหมือนเดิม เช่น บันทึกค่าเดิมซ้ำ - client ต้องได้ version ใหม่ไม่งั้นจะ 409 ตอนบันทึก)
+        body = {'status': 'success', 'data': visibility_map, 'version': metadata['version']}
+        etag = hashlib.sha1(json.dumps(body, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+        response = jsonify(body)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
+    except Exception as e:
+        logger.error(f"Error getting all visibility: {e}")
+        return {'status': 'error', 'message': str(e)}, 500
+
 if __name__ == '__main__':
     app.run(debug=True)
 
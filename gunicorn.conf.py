@@ -0,0 +1,7 @@
+# gunicorn โหลดไฟล์นี้เองจาก working directory (render.yaml ไม่ต้องระบุ -c)
+
+
+def worker_exit(server, worker):
+    """ปิด image pool ก่อน worker จบ - ใต้ eventlet ไม่งั้น worker ค้างจนโดน kill หลัง graceful timeout"""
+    import app
+    app.shutdown_image_pool()
@@ -0,0 +1,76 @@
+# ตั้ง env ก่อน import app - ทุกไฟล์ของแอปอยู่ใน temp dir ของรอบทดสอบ และไม่ต่อ Cloudinary จริง
+# และไม่ start job worker thread (test เรียก run_job_item เอง)
+import os
+import sys
+import tempfile
+
+import pytest
+
+WORKDIR = tempfile.mkdtemp(prefix='drink-menu-test-')
+os.environ.update({
+    'SECRET_KEY': 'test-secret',
+    'ADMIN_PASSWORD': 'test-password',
+    'METADATA_DIR': os.path.join(WORKDIR, 'metadata'),
+    'JOBS_DB': os.path.join(WORKDIR, 'jobs.sqlite3'),
+    'JOBS_SPOOL_DIR': os.path.join(WORKDIR, 'spool'),
+    'CATALOG_SNAPSHOT': os.path.join(WORKDIR, 'catalog.json.gz'),
+    'CACHE_BACKEND': 'memory',
+    'JOB_WORKERS': '0'
+})
+for key in ('CLOUD_NAME', 'CLOUD_API_KEY', 'CLOUD_API_SECRET', 'WATERMARK_TEXT', 'WATERMARK_LOGO', 'WATERMARK_STYLES'):
+    os.environ.pop(key, None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    return app_module
+
+
+def make_image(folder, name, created_at, version=1):
+    """resource แบบเดียวกับที่ Cloudinary Admin API คืนมา (เฉพาะ field ที่แอปใช้)"""
+    public_id = f"menu/{folder}/{name}"
+    return {
+        'public_id': public_id,
+        'version': version,
+        'format': 'jpg',
+        'created_at': created_at,
+        'secure_url': f"https://res.cloudinary.com/demo/image/upload/v{version}/{public_id}.jpg",
+        'width': 800,
+        'height': 600,
+        'bytes': 1000
+    }
+
+
+@pytest.fixture
+def metadata_store(app, tmp_path, monkeypatch):
+    """metadata store ว่างใน tmp_path - ไม่ดึง/อัปโหลด snapshot กับ Cloudinary"""
+    store = app.MetadataStore(str(tmp_path / 'metadata'))
+    monkeypatch.setattr(app, 'metadata_store', store)
+    monkeypatch.setattr(app, 'fetch_remote_metadata', lambda conditional=False: None)
+    monkeypatch.setattr(app, 'revalidate_remote_metadata', lambda: None)
+    monkeypatch.setattr(app, 'schedule_metadata_upload', lambda: None)
+    monkeypatch.setattr(app, 'schedule_catalog_snapshot', lambda: None)
+    return store
+
+
+@pytest.fixture
+def catalog(app, metadata_store, monkeypatch):
+    """รายการรูปที่ Cloudinary จะคืนให้ {folder: [resource]} - แก้ใน test ได้ก่อนโหลด cache"""
+    data = {folder: [] for folder in app.IMAGE_FOLDERS}
+    monkeypatch.setattr(app, 'fetch_all_images', lambda: {folder: list(images) for folder, images in data.items()})
+    app.cache_backend.delete('images')
+    monkeypatch.setitem(app.last_good_images, 'data', None)
+    yield data
+    app.cache_backend.delete('images')
+
+
+@pytest.fixture
+def client(app, catalog):
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+    return client
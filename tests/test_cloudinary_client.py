@@ -0,0 +1,79 @@
+import cloudinary.exceptions
+import pytest
+
+
+@pytest.fixture
+def file_backend(app, tmp_path, monkeypatch):
+    """cache backend แบบไฟล์ - เหมือน gunicorn หลาย worker บนเครื่องเดียวกัน"""
+    backend = app.FileCacheBackend(str(tmp_path / 'cache'))
+    monkeypatch.setattr(app, 'cache_backend', backend)
+    return backend
+
+
+def test_shared_bucket_splits_budget_between_workers(app, file_backend):
+    # bucket สองตัว key เดียวกัน = worker สองตัว ต้องได้ token รวมกันไม่เกิน capacity
+    first = app.SharedTokenBucket('test-bucket', rate=0.001, capacity=3)
+    second = app.SharedTokenBucket('test-bucket', rate=0.001, capacity=3)
+    granted = [bucket.acquire(timeout=0) for bucket in (first, second, first, second)]
+    assert granted == [True, True, True, False]
+
+
+def test_shared_bucket_respects_remaining_quota(app, file_backend):
+    bucket = app.SharedTokenBucket('test-bucket', rate=0.001, capacity=5)
+    bucket.limit(1)
+    assert app.SharedTokenBucket('test-bucket', rate=0.001, capacity=5).acquire(timeout=0) is True
+    assert bucket.acquire(timeout=0) is False
+
+
+
+def test_shared_bucket_reserves_tokens_in_batches(app, file_backend, monkeypatch):
+    updates = []
+    update = file_backend.update
+    monkeypatch.setattr(file_backend, 'update', lambda key, fn: updates.append(key) or update(key, fn))
+    bucket = app.SharedTokenBucket('test-bucket', rate=0.001, capacity=10, batch=3)
+    assert all(bucket.acquire(timeout=0) for _ in range(3))
+    # 3 token จากการจองครั้งเดียว
+    assert len(updates) == 1
+    
+    # จองแล้วไม่ได้ใช้จนหมดเวลา - คืนเข้า bucket กลาง
+    bucket.acquire(timeout=0)
+    monkeypatch.setattr(bucket, 'allowance_until', 0.0)
+    bucket.acquire(timeout=0)
+    other = app.SharedTokenBucket('test-bucket', rate=0.001, capacity=10, batch=10)
+    assert sum(other.acquire(timeout=0) for _ in range(10)) == 10 - 3 - 1 - 3
+
+@pytest.mark.parametrize('error, transient', [
+    (cloudinary.exceptions.RateLimited('Rate limit'), True),
+    (cloudinary.exceptions.GeneralError('Server error'), True),
+    (Exception('Socket error: timed out'), True),
+    (Exception('Error 502 - Bad Gateway'), True),
+    (cloudinary.exceptions.Error('Error parsing server response (504) - <html>'), True),
+    (cloudinary.exceptions.NotFound('Resource not found'), False),
+    (cloudinary.exceptions.BadRequest('Invalid public_id'), False),
+    (ValueError('bad value'), False)
+])
+def test_transient_error_classification(app, error, transient):
+    assert app.is_transient_cloudinary_error(error) is transient
+
+
+def test_client_retries_transient_errors_only(app, monkeypatch):
+    monkeypatch.setattr(app, 'CLOUDINARY_RETRY_BASE', 0)
+    client = app.CloudinaryClient()
+    calls = []
+    
+    def flaky(public_id, **options):
+        calls.append(public_id)
+        if len(calls) == 1:
+            raise Exception('Error 503 - Service Unavailable')
+        return {'result': 'ok'}
+    monkeypatch.setattr(app.cloudinary.uploader, 'destroy', flaky)
+    assert client.destroy('menu/clean/x') == {'result': 'ok'}
+    assert len(calls) == 2
+    
+    def missing(public_id, **options):
+        calls.append(public_id)
+        raise cloudinary.exceptions.NotFound('Resource not found')
+    monkeypatch.setattr(app.cloudinary.uploader, 'destroy', missing)
+    with pytest.raises(cloudinary.exceptions.NotFound):
+        client.destroy('menu/clean/x')
+    assert len(calls) == 3
@@ -0,0 +1,54 @@
+import pytest
+
+from conftest import make_image
+
+
+@pytest.fixture
+def uploads(app, catalog, monkeypatch):
+    """Upload API ปลอม - จด public_id ที่อัปโหลดและคืน resource ที่ version เพิ่มขึ้นทุกครั้ง"""
+    calls = []
+    
+    def upload(file, public_id, **options):
+        calls.append((file, public_id))
+        _, folder, name = public_id.split('/')
+        return make_image(folder, name, '2026-01-01T00:00:00Z', version=len(calls))
+    monkeypatch.setattr(app.cloudinary_client, 'upload', upload)
+    # โหลด image cache ก่อน - index_upsert แก้เฉพาะ cache ที่โหลดอยู่แล้ว
+    app.get_cached_images()
+    return calls
+
+
+def store(app, raw_bytes, public_id):
+    return app.store_menu_image(public_id, app.content_hash(raw_bytes), lambda: b'encoded:' + raw_bytes)
+
+
+def test_same_content_is_not_uploaded_twice(app, uploads):
+    _, dedup = store(app, b'photo', 'menu/clean/ชาเย็น')
+    assert dedup is None
+    _, dedup = store(app, b'photo', 'menu/clean/ชาเย็น')
+    assert dedup == 'unchanged'
+    
+    # asset อื่นที่มีเนื้อหาเดียวกัน - Cloudinary คัดลอกจาก URL ของรูปที่มีอยู่แล้ว
+    _, dedup = store(app, b'photo', 'menu/premium/ชาเย็น')
+    assert dedup == 'copied'
+    assert uploads[-1][0].startswith('https://')
+    assert len(uploads) == 2
+
+
+def test_removed_assets_leave_the_content_index(app, uploads):
+    store(app, b'photo', 'menu/clean/ชาเย็น')
+    app.index_remove('menu/clean/ชาเย็น')
+    
+    assert app.load_metadata()['hashes'] == {}
+    _, dedup = store(app, b'photo', 'menu/clean/ชาเย็น')
+    assert dedup is None
+
+
+def test_hash_commits_keep_the_menu_model(app, catalog):
+    catalog['clean'].append(make_image('clean', 'ชาเย็น', '2026-01-01T00:00:00Z'))
+    model = app.get_menu_model()
+    app.save_content_hashes({'a' * 64: {'menu/clean/ชาเย็น': 1}})
+    assert app.get_menu_model() is model
+    
+    app.save_metadata({'ชาเย็น': 0})
+    assert app.get_menu_model() is not model
@@ -0,0 +1,109 @@
+import cloudinary
+import cloudinary.utils
+import pytest
+
+from conftest import make_image
+
+SOURCE_HASH = 'a' * 64
+
+
+@pytest.fixture
+def cloudinary_keys(monkeypatch):
+    config = cloudinary.config()
+    for key, value in (('cloud_name', 'demo'), ('api_key', '1234'), ('api_secret', 'test-secret')):
+        monkeypatch.setattr(config, key, value, raising=False)
+    return config
+
+
+def signed_response(public_id, version):
+    """ผลอัปโหลดที่ Cloudinary ส่งกลับให้ browser (ลายเซ็นครอบคลุม public_id + version)"""
+    signature = cloudinary.utils.api_sign_request({'public_id': public_id, 'version': version}, 'test-secret')
+    return {'public_id': public_id, 'version': version, 'signature': signature}
+
+
+def test_signature_covers_source_hash(app, cloudinary_keys):
+    fields = app.direct_upload_params('menu/clean/ชาเย็น', SOURCE_HASH)['fields']
+    assert fields['context'] == f"source_sha256={SOURCE_HASH}"
+    
+    signed = {key: value for key, value in fields.items() if key not in ('signature', 'api_key')}
+    assert cloudinary.utils.api_sign_request(signed, 'test-secret') == fields['signature']
+    # browser เปลี่ยน hash หลังได้ลายเซ็นไม่ได้
+    assert cloudinary.utils.api_sign_request(dict(signed, context='source_sha256=' + 'b' * 64),
+                                             'test-secret') != fields['signature']
+
+
+def test_upload_complete_rejects_bad_signature(app, client, cloudinary_keys):
+    response = client.post('/upload_complete', json={'public_id': 'menu/clean/ชาเย็น', 'version': 5, 'signature': 'forged'})
+    assert response.status_code == 400
+
+
+def test_upload_complete_trusts_cloudinary_over_the_browser(app, client, catalog, cloudinary_keys, monkeypatch):
+    app.get_cached_images()
+    name = app.menu_upload_name('a.jpg', 'ชาเย็น', 1)
+    stored = dict(make_image('clean', name, '2026-01-01T00:00:00Z', version=5), bytes=2048,
+                  context={'custom': {'source_sha256': SOURCE_HASH}})
+    monkeypatch.setattr(app.cloudinary_client, 'resource', lambda public_id, **options: stored)
+    
+    response = client.post('/upload_complete', json=dict(signed_response(f"menu/clean/{name}", 5), bytes=1))
+    assert response.get_json()['bytes'] == 2048
+    assert app.load_metadata()['hashes'] == {SOURCE_HASH: {f"menu/clean/{name}": 5}}
+    
+    # ไฟล์เดิมอีกรอบ - ไม่ต้องออกลายเซ็นให้อัปโหลดซ้ำ
+    signature = client.post('/upload_signature', json={
+        'type': 'clean', 'name': 'ชาเย็น', 'files': [{'filename': 'a.jpg', 'size': 100, 'sha256': SOURCE_HASH}]
+    }).get_json()
+    assert signature['uploads'] == []
+    assert signature['deduped'][0]['dedup'] == 'unchanged'
+
+
+def sign_upload(client, name='ชาเย็น'):
+    return client.post('/upload_signature', json={
+        'type': 'clean', 'name': name, 'files': [{'filename': 'a.jpg', 'size': 100}]
+    }).get_json()
+
+
+def test_direct_uploads_are_tracked_by_the_job_queue(app, client, catalog, cloudinary_keys, monkeypatch):
+    app.get_cached_images()
+    signature = sign_upload(client)
+    upload = signature['uploads'][0]
+    job_id = signature['job_id']
+    # worker ยังไม่หยิบไปตรวจระหว่างที่ browser อัปโหลดได้
+    assert app.job_queue.claim() is None
+    assert app.job_queue.progress(job_id)['pending'] == 1
+    
+    public_id = upload['fields']['public_id']
+    stored = make_image('clean', public_id.split('/')[-1], '2026-01-01T00:00:00Z', version=int(upload['fields']['timestamp']))
+    monkeypatch.setattr(app.cloudinary_client, 'resource', lambda public_id, **options: stored)
+    response = client.post('/upload_complete', json=dict(signed_response(public_id, stored['version']),
+                                                          job_id=job_id, job_idx=upload['job_idx']))
+    assert response.get_json()['status'] == 'success'
+    job = app.job_queue.progress(job_id)
+    assert job['finished'] and job['done'] == 1
+    
+    # ผลอัปโหลดของไฟล์อื่นปิดงานนี้ไม่ได้
+    other = sign_upload(client, 'ชาไทย')
+    response = client.post('/upload_complete', json=dict(signed_response(public_id, stored['version']),
+                                                          job_id=other['job_id'], job_idx=0))
+    assert response.status_code == 400
+
+
+def test_failed_direct_upload_closes_its_job_item(app, client, catalog, cloudinary_keys):
+    signature = sign_upload(client)
+    response = client.post('/upload_complete', json={'job_id': signature['job_id'], 'job_idx': 0, 'error': 'HTTP 500'})
+    assert response.get_json()['status'] == 'success'
+    job = app.job_queue.progress(signature['job_id'])
+    assert job['finished'] and job['failed'] == 1
+
+
+def test_unreported_direct_upload_is_reconciled_with_cloudinary(app, catalog, monkeypatch):
+    app.get_cached_images()
+    payload = {'public_id': 'menu/clean/ชาเย็น', 'file': 'ชาเย็น', 'timestamp': '1000'}
+    stored = make_image('clean', 'ชาเย็น', '2026-01-01T00:00:00Z', version=999)
+    monkeypatch.setattr(app.cloudinary_client, 'resource', lambda public_id, **options: stored)
+    # รูปเดิมที่อยู่ก่อนออกลายเซ็น - browser ไม่ได้อัปโหลด
+    with pytest.raises(ValueError):
+        app.job_direct_upload(payload)
+    
+    stored['version'] = 1001
+    assert app.job_direct_upload(payload) == {'file': 'ชาเย็น', 'dedup': None}
+    assert app.cached_image('menu/clean/ชาเย็น')['version'] == 1001
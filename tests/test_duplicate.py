@@ -0,0 +1,72 @@
+from conftest import make_image
+
+
+def duplicate(client, original_name, new_name):
+    return client.post('/duplicate_menu', data={'original_name': original_name, 'new_name': new_name})
+
+
+def test_duplicate_is_an_alias_of_the_original_assets(app, client, catalog, monkeypatch):
+    for folder in ('watermarked', 'clean'):
+        catalog[folder].append(make_image(folder, 'ชาเย็น', '2026-01-01T00:00:00Z'))
+    app.save_metadata({'ชาเย็น': 0b0101})
+    # ไม่อัปโหลดและไม่ถาม Admin API - ใช้รูปเดิมจาก image index
+    monkeypatch.setattr(app.cloudinary_client, 'upload', None)
+    monkeypatch.setattr(app.cloudinary_client, 'resource', None)
+    
+    response = duplicate(client, 'ชาเย็น', 'ชาเย็นหวานน้อย')
+    assert response.get_json()['status'] == 'success'
+    assert app.load_metadata()['aliases']['menu/clean/ชาเย็นหวานน้อย']['source'] == 'menu/clean/ชาเย็น'
+    assert app.load_metadata()['visibility'].get('ชาเย็นหวานน้อย') == 0b0101
+    
+    # ทั้งจาก cache ที่แก้ตรงจุด และหลังโหลดรายการใหม่จาก Cloudinary
+    for _ in range(2):
+        record = app.get_menu_model()['by_name']['ชาเย็นหวานน้อย']
+        assert sorted(record['images']) == ['clean', 'watermarked']
+        assert '/menu/clean/ชาเย็น.' in app.image_url(record['images']['clean'], 400)
+        assert 'ชาเย็นหวานน้อย' in app.get_search_index().search('หวานน้อย')
+        app.clear_cache()
+
+
+def test_duplicate_of_an_alias_points_at_the_real_asset(app, client, catalog):
+    catalog['clean'].append(make_image('clean', 'ชาเย็น', '2026-01-01T00:00:00Z'))
+    duplicate(client, 'ชาเย็น', 'ชาเย็นหวานน้อย')
+    duplicate(client, 'ชาเย็นหวานน้อย', 'ชาเย็นไม่หวาน')
+    assert app.load_metadata()['aliases']['menu/clean/ชาเย็นไม่หวาน']['source'] == 'menu/clean/ชาเย็น'
+
+
+def test_deleting_the_original_hands_the_asset_to_its_alias(app, client, catalog, monkeypatch):
+    catalog['clean'].append(make_image('clean', 'ชาเย็น', '2026-01-01T00:00:00Z'))
+    duplicate(client, 'ชาเย็น', 'ชาเย็นหวานน้อย')
+    
+    renames = []
+    def rename(from_id, to_id, **options):
+        renames.append((from_id, to_id))
+        return make_image('clean', to_id.split('/')[-1], '2026-01-01T00:00:00Z')
+    monkeypatch.setattr(app.cloudinary_client, 'rename', rename)
+    monkeypatch.setattr(app.cloudinary_client, 'destroy', None)
+    
+    assert app.delete_menu('ชาเย็น', ('clean',)) == {}
+    assert renames == [('menu/clean/ชาเย็น', 'menu/clean/ชาเย็นหวานน้อย')]
+    assert app.load_metadata()['aliases'] == {}
+    by_name = app.get_menu_model()['by_name']
+    assert 'ชาเย็น' not in by_name
+    assert 'alias_of' not in by_name['ชาเย็นหวานน้อย']['images']['clean']
+    
+    # alias ที่ไม่มีใครชี้มา ลบแค่ record
+    duplicate(client, 'ชาเย็นหวานน้อย', 'ชาเย็นไม่หวาน')
+    assert app.delete_menu('ชาเย็นไม่หวาน', ('clean',)) == {}
+    assert app.load_metadata()['aliases'] == {}
+    assert 'ชาเย็นไม่หวาน' not in app.get_menu_model()['by_name']
+
+
+def test_duplicate_onto_an_existing_menu_is_rejected(app, client, catalog):
+    for name in ('ชาเย็น', 'ชาไทย'):
+        catalog['clean'].append(make_image('clean', name, '2026-01-01T00:00:00Z'))
+    response = duplicate(client, 'ชาเย็น', 'ชาไทย')
+    assert response.status_code == 400
+    assert app.load_metadata()['aliases'] == {}
+
+
+def test_duplicate_of_unknown_menu_is_404(app, client, catalog):
+    response = duplicate(client, 'ไม่มี', 'ใหม่')
+    assert response.status_code == 404
@@ -0,0 +1,24 @@
+from datetime import datetime, timedelta
+
+from conftest import make_image
+
+
+def test_refresh_keeps_index_patches_made_during_the_fetch(app, catalog, monkeypatch):
+    catalog['clean'] += [make_image('clean', name, '2026-01-01T00:00:00Z') for name in ('ชาเย็น', 'ชาไทย')]
+    data = app.get_cached_images()
+    # cache หมดอายุแล้ว - รอบถัดไปดึงรายการใหม่
+    app.cache_backend.set('images', data, datetime.now() - timedelta(hours=1))
+    
+    fetch = app.fetch_all_images
+    def slow_fetch():
+        # รายการที่ดึงได้เป็นของก่อนการแก้ด้านล่าง (Cloudinary ยังไม่ทันเห็น)
+        listing = fetch()
+        app.index_upsert(make_image('clean', 'โกโก้', '2026-01-02T00:00:00Z'))
+        app.index_remove('menu/clean/ชาไทย')
+        app.index_upsert(make_image('clean', 'ชาเย็น', '2026-01-01T00:00:00Z', version=2))
+        return listing
+    monkeypatch.setattr(app, 'fetch_all_images', slow_fetch)
+    
+    refreshed = {img['public_id']: img['version'] for img in app._refresh_images()['clean']}
+    assert refreshed == {'menu/clean/ชาเย็น': 2, 'menu/clean/โกโก้': 1}
+    assert app.cache_backend.get('images')['data']['clean'] == app._refresh_images()['clean']
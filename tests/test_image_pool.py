@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def slots(app, monkeypatch):
+    """คิว image pool ขนาด 2 ที่ไม่รอคิวว่าง"""
+    semaphore = threading.BoundedSemaphore(2)
+    monkeypatch.setattr(app, 'image_pool_slots', semaphore)
+    monkeypatch.setattr(app, 'IMAGE_WORKERS', 1)
+    monkeypatch.setattr(app, 'IMAGE_QUEUE_LIMIT', 1)
+    monkeypatch.setattr(app, 'IMAGE_QUEUE_TIMEOUT', 0)
+    return semaphore
+
+
+def free_slots(semaphore):
+    count = 0
+    while semaphore.acquire(blocking=False):
+        count += 1
+    for _ in range(count):
+        semaphore.release()
+    return count
+
+
+def test_busy_reservation_keeps_no_slots(app, slots):
+    slots.acquire()
+    with pytest.raises(app.ImagePoolBusy):
+        app.ImagePoolReservation(2)
+    assert free_slots(slots) == 1
+
+
+def test_unused_reserved_slots_are_returned(app, slots):
+    # ขอเกินขนาดคิว - จองเท่าที่มี
+    with app.ImagePoolReservation(3) as reservation:
+        assert free_slots(slots) == 0
+        assert reservation.take() is True
+    # ช่องที่ใช้ไปคืนเมื่องานเสร็จ (done callback) ส่วนที่เหลือคืนตอนออกจาก block
+    assert free_slots(slots) == 1
+
+
+def test_pool_works_under_eventlet_monkey_patching(app, tmp_path):
+    # gunicorn -k eventlet (render.yaml) patch threading/select ก่อนโหลดแอป - process ลูกแบบ spawn ต้องยังทำงานได้
+    pytest.importorskip('eventlet')
+    script = tmp_path / 'run_pool.py'
+    script.write_text(
+        "import eventlet\n"
+        "eventlet.monkey_patch()\n"
+        "import io, sys\n"
+        f"sys.path.insert(0, {os.path.dirname(app.__file__)!r})\n"
+        "from PIL import Image\n"
+        "import app\n"
+        "if __name__ == '__main__':\n"
+        "    buf = io.BytesIO()\n"
+        "    Image.new('RGB', (64, 64)).save(buf, 'PNG')\n"
+        "    futures = [app.submit_image_task(app.encode_menu_image, buf.getvalue()) for _ in range(3)]\n"
+        "    print(all(f.result(timeout=60)[:2] == b'\\xff\\xd8' for f in futures))\n"
+        # worker_exit ใน gunicorn.conf.py - ไม่ปิดเองแล้ว process ค้างตอนจบ
+        "    app.shutdown_image_pool()\n"
+    )
+    result = subprocess.run([sys.executable, str(script)], capture_output=True, text=True, timeout=60,
+                            env=dict(os.environ, PYTHONWARNINGS='ignore'))
+    assert result.stdout.strip() == 'True', result.stderr[-2000:]
@@ -0,0 +1,130 @@
+import pytest
+
+
+@pytest.fixture
+def queue(app, tmp_path, monkeypatch):
+    queue = app.JobQueue(str(tmp_path / 'jobs.sqlite3'))
+    monkeypatch.setattr(app, 'job_queue', queue)
+    monkeypatch.setattr(app, 'JOBS_SPOOL_DIR', str(tmp_path / 'spool'))
+    return queue
+
+
+@pytest.fixture
+def clock(app, monkeypatch):
+    """เวลาของคิวงาน - เรียก clock.advance() เพื่อข้ามเวลารอ backoff"""
+    now = [app.time.time()]
+    monkeypatch.setattr(app.time, 'time', lambda: now[0])
+    
+    class Clock:
+        @staticmethod
+        def advance(seconds=app.JOB_RETRY_MAX * 2):
+            now[0] += seconds
+    return Clock
+
+
+@pytest.fixture
+def handler(app, monkeypatch):
+    """handler ของงานประเภท 'test' - ตั้ง outcomes เป็นลำดับผลลัพธ์ (Exception = raise)"""
+    outcomes = []
+    calls = []
+    
+    def run(payload):
+        calls.append(payload)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    
+    monkeypatch.setitem(app.JOB_HANDLERS, 'test', run)
+    run.outcomes, run.calls = outcomes, calls
+    return run
+
+
+def test_claim_runs_items_in_order_then_empties(app, queue):
+    job_id = queue.create('test', [{'n': 0}, {'n': 1}])
+    first, second = queue.claim(), queue.claim()
+    
+    assert (first['idx'], first['payload'], first['attempts']) == (0, {'n': 0}, 1)
+    assert second['idx'] == 1
+    assert queue.claim() is None
+    
+    assert not queue.complete(job_id, 0, {'ok': True})
+    assert queue.complete(job_id, 1, {'ok': True})
+    progress = queue.progress(job_id)
+    assert progress['finished'] and progress['done'] == 2
+
+
+def test_transient_error_is_retried_with_backoff(app, queue, handler, clock):
+    job_id = queue.create('test', [{'n': 0}])
+    handler.outcomes.extend([ConnectionError('reset'), {'ok': True}])
+    
+    app.run_job_item(queue.claim())
+    item = queue.progress(job_id)['items'][0]
+    assert (item['status'], item['attempts'], item['error']) == ('pending', 1, 'reset')
+    # ยังไม่ถึงเวลาลองใหม่
+    assert queue.claim() is None
+    
+    clock.advance()
+    app.run_job_item(queue.claim())
+    progress = queue.progress(job_id)
+    assert progress['finished'] and progress['items'][0]['attempts'] == 2
+    assert progress['items'][0]['result'] == {'ok': True}
+
+
+def test_permanent_error_fails_without_retry(app, queue, handler):
+    job_id = queue.create('test', [{'n': 0}])
+    handler.outcomes.append(ValueError('bad input'))
+    
+    app.run_job_item(queue.claim())
+    progress = queue.progress(job_id)
+    assert progress['finished'] and progress['failed'] == 1
+    assert progress['items'][0]['error'] == 'bad input'
+
+
+def test_job_retry_resumes_with_remaining_payload(app, queue, handler, clock):
+    job_id = queue.create('test', [{'folders': ['clean', 'premium']}])
+    handler.outcomes.extend([app.JobRetry(ConnectionError('reset'), {'folders': ['premium']}), {'ok': True}])
+    
+    app.run_job_item(queue.claim())
+    clock.advance()
+    app.run_job_item(queue.claim())
+    
+    assert handler.calls == [{'folders': ['clean', 'premium']}, {'folders': ['premium']}]
+    assert queue.progress(job_id)['done'] == 1
+
+
+def test_gives_up_after_max_attempts(app, queue, handler, clock):
+    job_id = queue.create('test', [{'n': 0}])
+    handler.outcomes.extend([ConnectionError('reset')] * app.JOB_MAX_ATTEMPTS)
+    
+    for _ in range(app.JOB_MAX_ATTEMPTS):
+        app.run_job_item(queue.claim())
+        clock.advance()
+    progress = queue.progress(job_id)
+    assert progress['failed'] == 1 and progress['items'][0]['attempts'] == app.JOB_MAX_ATTEMPTS
+    assert queue.claim() is None
+
+
+def test_expired_lease_is_claimed_again(app, queue, monkeypatch):
+    job_id = queue.create('test', [{'n': 0}])
+    # worker แรกตายหลังจองไปแล้ว (lease หมดอายุทันที)
+    monkeypatch.setattr(app, 'JOB_LEASE', -1)
+    assert queue.claim()['attempts'] == 1
+    
+    resumed = queue.claim()
+    assert (resumed['job_id'], resumed['idx'], resumed['attempts']) == (job_id, 0, 2)
+
+
+def test_live_lease_is_not_claimed_twice(app, queue):
+    queue.create('test', [{'n': 0}])
+    assert queue.claim() is not None
+    assert queue.claim() is None
+
+
+def test_queue_survives_restart(app, queue, tmp_path):
+    job_id = queue.create('test', [{'n': 0}, {'n': 1}])
+    queue.complete(job_id, 0, {'ok': True})
+    
+    restarted = app.JobQueue(queue.path)
+    item = restarted.claim()
+    assert (item['job_id'], item['idx']) == (job_id, 1)
@@ -0,0 +1,126 @@
+from conftest import make_image
+
+
+def stamp(n):
+    return f"2026-01-01T00:{n // 60:02d}:{n % 60:02d}Z"
+
+
+def build_model(app, data, state=None):
+    return app.build_menu_model(data, state or app.MetadataStore.empty_state())
+
+
+def walk(app, data, zone, limit, mutate=None):
+    """เลื่อนทีละหน้าจนจบ - mutate(หน้าที่) แก้ data ระหว่างเลื่อน (เหมือนแอดมินอัปโหลด/ลบระหว่างที่ลูกค้าดูอยู่)"""
+    seen = []
+    cursor = None
+    page_number = 0
+    while True:
+        page, cursor, _ = app.paginate_zone(build_model(app, data), zone, cursor=cursor, limit=limit)
+        seen.extend(img['public_id'] for img in page)
+        page_number += 1
+        if cursor is None:
+            return seen
+        if mutate:
+            mutate(page_number)
+
+
+def test_cursor_walks_every_image_once(app):
+    data = {'watermarked': [make_image('watermarked', f"menu-{n}", stamp(n)) for n in range(25)], 'clean': [], 'premium': []}
+    seen = walk(app, data, 'normal-wm', limit=10)
+    assert seen == [f"menu/watermarked/menu-{n}" for n in reversed(range(25))]
+
+
+def test_cursor_survives_inserts_between_pages(app):
+    data = {'watermarked': [make_image('watermarked', f"menu-{n}", stamp(n)) for n in range(25)], 'clean': [], 'premium': []}
+    
+    def insert(page_number):
+        # รูปใหม่ขึ้นหน้าแรก ไม่ดันรูปที่เห็นแล้วกลับมาในหน้าถัดไป
+        data['watermarked'].append(make_image('watermarked', f"new-{page_number}", stamp(100 + page_number)))
+    
+    seen = walk(app, data, 'normal-wm', limit=10, mutate=insert)
+    assert seen == [f"menu/watermarked/menu-{n}" for n in reversed(range(25))]
+
+
+def test_cursor_continues_after_its_image_is_deleted(app):
+    data = {'watermarked': [make_image('watermarked', f"menu-{n}", stamp(n)) for n in range(25)], 'clean': [], 'premium': []}
+    
+    def delete_last_seen(page_number):
+        last = 25 - 10 * page_number
+        data['watermarked'] = [img for img in data['watermarked'] if img['public_id'] != f"menu/watermarked/menu-{last}"]
+    
+    seen = walk(app, data, 'normal-wm', limit=10, mutate=delete_last_seen)
+    assert seen == [f"menu/watermarked/menu-{n}" for n in reversed(range(25))]
+
+
+def test_cursor_respects_visibility_and_search(app, catalog):
+    # search index อ่านชื่อจาก image cache
+    catalog['clean'].extend(make_image('clean', name, stamp(n)) for n, name in
+                            enumerate(['ชาเย็น', 'ชาเขียว', 'กาแฟเย็น', 'โกโก้เย็น']))
+    data = app.get_cached_images()
+    state = app.MetadataStore.empty_state()
+    state['visibility'].set('โกโก้เย็น', 0)
+    model = build_model(app, data, state)
+    
+    page, cursor, total = app.paginate_zone(model, 'normal-cl', limit=1, term='เย็น')
+    assert total == 2 and [img['public_id'] for img in page] == ['menu/clean/กาแฟเย็น']
+    page, cursor, _ = app.paginate_zone(model, 'normal-cl', cursor=cursor, limit=1, term='เย็น')
+    assert [img['public_id'] for img in page] == ['menu/clean/ชาเย็น'] and cursor is None
+
+
+def test_menu_api_pages_and_rejects_bad_cursor(app, client, catalog):
+    catalog['watermarked'].extend(make_image('watermarked', f"menu-{n}", stamp(n)) for n in range(5))
+    
+    first = client.get('/api/menu/normal-wm?limit=3').get_json()
+    assert [item['name'] for item in first['items']] == ['menu-4', 'menu-3', 'menu-2']
+    second = client.get(f"/api/menu/normal-wm?limit=3&cursor={first['next_cursor']}").get_json()
+    assert [item['name'] for item in second['items']] == ['menu-1', 'menu-0'] and second['next_cursor'] is None
+    
+    assert client.get('/api/menu/normal-wm?cursor=not-a-cursor').status_code == 400
+
+
+def test_menu_api_reports_internal_errors_as_500(app, client, monkeypatch):
+    def broken(*args, **kwargs):
+        raise KeyError('zones')
+    monkeypatch.setattr(app, 'paginate_zone', broken)
+    assert client.get('/api/menu/normal-wm').status_code == 500
+
+
+def test_stale_version_gets_409(app, client, catalog):
+    catalog['clean'].append(make_image('clean', 'ชาเย็น', stamp(0)))
+    version = client.get('/get_visibility_all').get_json()['version']
+    item = {'filename': 'ชาเย็น', 'show_normal_watermark': True, 'show_normal_clean': False}
+    
+    saved = client.post('/toggle_visibility_bulk', json={'items': [item], 'version': version})
+    assert saved.status_code == 200
+    
+    # แท็บที่ยังถือ version เดิมอยู่
+    stale = client.post('/toggle_visibility_bulk', json={'items': [dict(item, show_normal_clean=True)], 'version': version})
+    assert stale.status_code == 409
+    assert stale.get_json()['version'] == saved.get_json()['version']
+    assert app.get_menu_visibility('ชาเย็น')['show_normal_clean'] is False
+
+
+def test_visibility_etag_changes_with_version(app, client, catalog):
+    catalog['clean'].append(make_image('clean', 'ชาเย็น', stamp(0)))
+    first = client.get('/get_visibility_all')
+    
+    assert client.get('/get_visibility_all', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    
+    # บันทึกค่าเดิมซ้ำ - map เหมือนเดิมแต่ version ขยับ
+    flags = first.get_json()['data']['ชาเย็น']
+    client.post('/toggle_visibility_bulk', json={'items': [dict(flags, filename='ชาเย็น')], 'version': first.get_json()['version']})
+    
+    refreshed = client.get('/get_visibility_all', headers={'If-None-Match': first.headers['ETag']})
+    assert refreshed.status_code == 200
+    assert refreshed.get_json()['version'] == first.get_json()['version'] + 1
+
+
+def test_zip_download_is_rate_limited_per_ip(app, client, catalog, monkeypatch):
+    catalog['clean'].append(make_image('clean', 'ชาเย็น', stamp(0)))
+    monkeypatch.setattr(app, 'fetch_image_bytes', lambda url: b'jpeg')
+    app.cache_backend.delete('zip-rate')
+    
+    statuses = [client.get('/download_zip/normal-cl', environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code
+                for _ in range(app.ZIP_BURST + 1)]
+    assert statuses == [200] * app.ZIP_BURST + [429]
+    assert client.get('/download_zip/normal-cl', environ_base={'REMOTE_ADDR': '10.0.0.2'}).status_code == 200
@@ -0,0 +1,138 @@
+import json
+import os
+
+import pytest
+
+
+def open_store(app, store):
+    """store ใหม่บนไดเรกทอรีเดียวกัน - เหมือน worker อีกตัวที่เพิ่งเริ่ม"""
+    return app.MetadataStore(store.directory, compact_every=store.compact_every)
+
+
+def journal_lines(store):
+    if not os.path.exists(store.journal_path):
+        return []
+    with open(store.journal_path, 'rb') as f:
+        return f.read().splitlines()
+
+
+def test_journal_replay_matches_writer(app, tmp_path):
+    store = app.MetadataStore(str(tmp_path), compact_every=100)
+    store.commit({'ชาเย็น': 0})
+    store.commit({'ชาเขียว': 15, 'ชาเย็น': None})
+    store.commit({}, hashes={'a' * 64: {'menu/clean/ชาเขียว': 3}})
+    
+    state = open_store(app, store).read()
+    assert state['version'] == 2
+    assert state['seq'] == 3
+    assert state['visibility'].get('ชาเย็น') == app.DEFAULT_VISIBILITY_MASK
+    assert state['visibility'].get('ชาเขียว') == 15
+    assert state['hashes'] == {'a' * 64: {'menu/clean/ชาเขียว': 3}}
+    assert len(journal_lines(store)) == 3
+
+
+def test_reader_picks_up_appended_records(app, tmp_path):
+    writer = app.MetadataStore(str(tmp_path), compact_every=100)
+    reader = open_store(app, writer)
+    writer.commit({'ชาเย็น': 1})
+    assert reader.read()['visibility'].get('ชาเย็น') == 1
+    writer.commit({'ชาเย็น': 2})
+    assert reader.read()['visibility'].get('ชาเย็น') == 2
+
+
+def test_compaction_folds_journal_into_snapshot(app, tmp_path):
+    store = app.MetadataStore(str(tmp_path), compact_every=3)
+    for mask in range(4):
+        store.commit({f"menu-{mask}": mask})
+    
+    # 3 รายการแรกรวมเข้า snapshot แล้ว เหลือรายการที่ 4 ใน journal
+    assert len(journal_lines(store)) == 1
+    with open(store.snapshot_path, encoding='utf-8') as f:
+        snapshot = json.load(f)
+    assert snapshot['seq'] == 3
+    
+    state = open_store(app, store).read()
+    assert state['version'] == 4
+    assert [state['visibility'].get(f"menu-{mask}") for mask in range(4)] == [0, 1, 2, 3]
+
+
+def test_torn_and_corrupt_lines_are_skipped(app, tmp_path):
+    store = app.MetadataStore(str(tmp_path), compact_every=100)
+    store.commit({'ชาเย็น': 1})
+    with open(store.journal_path, 'ab') as f:
+        f.write(b'not json\n{"seq": 9, "version"')
+    
+    state = open_store(app, store).read()
+    assert state['seq'] == 1
+    assert state['visibility'].get('ชาเย็น') == 1
+    
+    # บรรทัดที่เขียนค้างถูกตัดทิ้งก่อนต่อท้ายรายการใหม่
+    store.commit({'ชาเย็น': 2})
+    assert open_store(app, store).read()['visibility'].get('ชาเย็น') == 2
+
+
+def test_legacy_journal_records_are_replayed(app, tmp_path):
+    store = app.MetadataStore(str(tmp_path), compact_every=100)
+    with open(store.journal_path, 'w', encoding='utf-8') as f:
+        # journal รุ่นก่อน: ไม่มี seq และค่าเป็น dict show_*
+        f.write(json.dumps({'version': 1, 'changes': {'ชาเย็น': {'show_premium_clean': True}}}) + '\n')
+    
+    state = store.read()
+    assert state['seq'] == 1
+    assert state['visibility'].flags('ชาเย็น')['show_premium_clean'] is True
+    assert state['visibility'].flags('ชาเย็น')['show_normal_watermark'] is True
+
+
+def test_stale_version_raises_conflict(app, tmp_path):
+    store = app.MetadataStore(str(tmp_path), compact_every=100)
+    version = store.commit({'ชาเย็น': 1})
+    other = open_store(app, store)
+    other.commit({'ชาเย็น': 2}, expected_version=version)
+    
+    with pytest.raises(app.MetadataConflict):
+        store.commit({'ชาเย็น': 3}, expected_version=version)
+    assert store.read()['visibility'].get('ชาเย็น') == 2
+
+
+def test_hash_commits_do_not_bump_version(app, tmp_path):
+    store = app.MetadataStore(str(tmp_path), compact_every=100)
+    version = store.commit({'ชาเย็น': 1})
+    store.commit({}, hashes={'a' * 64: {'menu/clean/ชาเย็น': 1}})
+    # ยังบันทึก visibility ด้วย version เดิมได้
+    store.commit({'ชาเย็น': 2}, expected_version=version)
+
+
+def test_null_hash_entries_prune_the_index(app, tmp_path):
+    store = app.MetadataStore(str(tmp_path), compact_every=100)
+    store.commit({}, hashes={'a' * 64: {'menu/clean/x': 1, 'menu/premium/x': 1}, 'b' * 64: {'menu/clean/x': 1}})
+    store.commit({}, hashes={'a' * 64: {'menu/clean/x': None}, 'b' * 64: {'menu/clean/x': None}})
+    assert open_store(app, store).read()['hashes'] == {'a' * 64: {'menu/premium/x': 1}}
+
+
+def test_legacy_menus_schema_migrates_to_masks(app):
+    raw = {'version': 7, 'menus': {
+        'ชาเย็น': {'show_normal_watermark': False, 'show_normal_clean': True,
+                   'show_premium_watermark': True, 'show_premium_clean': True},
+        'ชาเขียว': {'show_premium_clean': True}
+    }}
+    state = app.MetadataStore.state_from_json(raw)
+    table = state['visibility']
+    
+    assert state['version'] == 7 and state['seq'] == 7 and state['hashes'] == {}
+    assert table.flags('ชาเย็น') == {'show_normal_watermark': False, 'show_normal_clean': True,
+                                     'show_premium_watermark': True, 'show_premium_clean': True}
+    # key ที่ไม่มีใช้ค่า default
+    assert table.flags('ชาเขียว') == {**app.VISIBILITY_DEFAULTS, 'show_premium_clean': True}
+    assert table.flags('ไม่มีในไฟล์') == app.VISIBILITY_DEFAULTS
+
+
+def test_visibility_table_round_trip_drops_defaults(app):
+    table = app.VisibilityTable()
+    table.set('ชาเย็น', 15)
+    table.set('ชาเขียว', app.DEFAULT_VISIBILITY_MASK)
+    raw = table.to_json()
+    
+    assert raw['names'] == ['ชาเย็น']
+    restored = app.VisibilityTable.from_json(raw)
+    assert restored.get('ชาเย็น') == 15
+    assert restored.get('ชาเขียว') == app.DEFAULT_VISIBILITY_MASK
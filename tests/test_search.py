@@ -0,0 +1,56 @@
+import itertools
+
+import pytest
+
+THAI_NAMES = [
+    'ชาเย็น', 'ชาเขียว', 'ชาไทย', 'ชามะนาว', 'น้ำแข็งใส', 'น้ำผึ้งมะนาว', 'โกโก้เย็น', 'กาแฟเย็น',
+    'นมสดปั่น', 'เผือกหอม', 'แตงโมปั่น', 'ชานมไข่มุก', 'น้ำเก๊กฮวย', 'ลิ้นจี่โซดา', 'Thai Tea เย็น'
+]
+
+
+def build_index(app, names):
+    index = app.MenuSearchIndex()
+    data = {'watermarked': [{'public_id': f"menu/watermarked/{name}", 'created_at': f"2026-01-01T00:00:{i:02d}Z"}
+                            for i, name in enumerate(names)]}
+    index.rebuild(data, 1)
+    return index
+
+
+@pytest.mark.parametrize('term, expected', [
+    ('ชาเย', {'ชาเย็น'}),
+    ('แข', {'น้ำแข็งใส'}),
+    ('เย', {'ชาเย็น', 'โกโก้เย็น', 'กาแฟเย็น', 'Thai Tea เย็น'}),
+    ('ใส', {'น้ำแข็งใส'}),
+    ('thai', {'Thai Tea เย็น'}),
+])
+def test_partial_syllables_match(app, term, expected):
+    assert set(build_index(app, THAI_NAMES).search(term)) == expected
+
+
+def test_index_matches_brute_force_substring(app):
+    index = build_index(app, THAI_NAMES)
+    keys = {name: app.normalize_search_term(name) for name in THAI_NAMES}
+    # ทุก substring ยาว 1-3 ตัวอักษรของทุกชื่อ (รวมที่ตัดกลางสระ/วรรณยุกต์) และตัวอักษรที่ไม่มีในชื่อไหนเลย
+    terms = {key[i:j] for key in keys.values() for i, j in itertools.combinations(range(len(key) + 1), 2) if j - i <= 3}
+    terms |= {'ฮ', 'zz', 'ชาa'}
+    for term in sorted(terms):
+        # search() ตัดช่องว่างหัวท้ายของ term เหมือนตอนรับจาก query string
+        query = app.normalize_search_term(term)
+        if not query:
+            continue
+        expected = {name for name, key in keys.items() if query in key}
+        assert set(index.search(term)) == expected, term
+
+
+def test_ranking_prefers_exact_then_prefix(app):
+    index = build_index(app, ['ชานมไข่มุก', 'ชา', 'ไข่มุกชา', 'ชาไทย'])
+    assert index.search('ชา')[:2] == ['ชา', 'ชาไทย']
+    assert index.search('ชา')[-1] == 'ไข่มุกชา'
+
+
+def test_patch_keeps_index_in_sync(app):
+    index = build_index(app, ['ชาเย็น'])
+    index.apply_patch(1, 2, add={'public_id': 'menu/clean/น้ำแข็งใส', 'created_at': '2026-01-02T00:00:00Z'})
+    assert index.search('แข็ง') == ['น้ำแข็งใส']
+    index.apply_patch(2, 3, discard=['menu/watermarked/ชาเย็น'])
+    assert index.search('เย') == []
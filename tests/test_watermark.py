@@ -0,0 +1,58 @@
+import io
+
+import pytest
+from PIL import Image
+
+
+def test_default_style_is_not_usable(app):
+    # ค่า default ไม่มีข้อความและโลโก้ - ห้ามได้รูปต้นฉบับกลับมาในโฟลเดอร์ลายน้ำ
+    with pytest.raises(app.WatermarkNotConfigured):
+        app.usable_watermark_styles()
+    with pytest.raises(app.WatermarkNotConfigured):
+        app.apply_watermark(Image.new('RGB', (64, 64)), app.WATERMARK_STYLES['watermarked'])
+
+
+def test_missing_font_fails_instead_of_default_font(app, monkeypatch):
+    style = dict(app.WATERMARK_DEFAULT_STYLE, text='ร้านชา', font='/nonexistent/font.ttf')
+    assert 'ฟอนต์' in app.watermark_style_problem(style)
+    with pytest.raises(app.WatermarkNotConfigured):
+        app.load_watermark_font('/nonexistent/font.ttf', 24)
+
+
+def test_logo_style_watermarks_the_image(app, tmp_path):
+    logo_path = tmp_path / 'logo.png'
+    Image.new('RGBA', (20, 10), (255, 0, 0, 255)).save(logo_path)
+    style = dict(app.WATERMARK_DEFAULT_STYLE, logo=str(logo_path), position='center', opacity=1.0)
+    
+    img = Image.new('RGB', (200, 200), (0, 0, 0))
+    marked = app.apply_watermark(img, style)
+    assert marked.getpixel((100, 100))[0] > 200
+    assert img.getpixel((100, 100)) == (0, 0, 0)
+
+
+def test_watermark_endpoints_reject_unconfigured_style(app, client):
+    assert client.post('/jobs', json={'kind': 'watermark', 'all': True}).status_code == 400
+    
+    upload = io.BytesIO()
+    Image.new('RGB', (32, 32)).save(upload, 'JPEG')
+    upload.seek(0)
+    response = client.post('/jobs/upload', data={'files': [(upload, 'a.jpg')], 'type': 'clean', 'watermark': '1'})
+    assert response.status_code == 400
+
+
+def test_admin_hides_watermark_controls(app, client):
+    html = client.get('/admin').get_data(as_text=True)
+    assert 'id="rewatermarkBtn"' not in html
+    assert 'id="autoWatermark"' not in html
+
+
+@pytest.mark.parametrize('results, dedup', [
+    ({'watermarked': 'unchanged', 'premium': 'unchanged'}, 'unchanged'),
+    ({'watermarked': 'copied', 'premium': 'unchanged'}, 'copied'),
+    ({'watermarked': 'copied', 'premium': None}, None),
+])
+def test_watermark_job_reports_the_actual_dedup(app, monkeypatch, results, dedup):
+    monkeypatch.setattr(app, 'rewatermark_menu', lambda filename: results)
+    result = app.job_watermark({'filename': 'ชาเย็น'})
+    assert result['dedup'] == dedup
+    assert result['folders'] == results